@@ -3,101 +3,266 @@ KIE (Knowledge Is Everything) Telegram Bot
 Basic implementation to start with
 """
 
+import hashlib
 import logging
+from cachetools import TTLCache
 from telegram.ext import Application, CommandHandler, MessageHandler, filters
 import os
 from dotenv import load_dotenv
-from knowledge_storage import KnowledgeStorage
-from kie_client import get_client
+from knowledge_storage import EntryWriteBatcher, KnowledgeStorage
+from kie_client import CircuitBreaker, get_client
+from outbound import OutboundBatcher, TelegramRateLimiter
 import asyncio
+import sys
+import time
+
+# Optional faster event loop (libuv based, not available on Windows)
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = sys.platform != 'win32'
+except ImportError:
+    UVLOOP_AVAILABLE = False
 
 # Load environment variables FIRST
 load_dotenv()
 
 # Enable logging
+# LOG_LEVEL=WARNING skips formatting of the per-update INFO records entirely
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    force=True
 )
 
 logger = logging.getLogger(__name__)
 
 # Bot token from environment variable
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# KIE model used by /ask when the knowledge base has no answer
+KIE_MODEL = os.getenv('KIE_DEFAULT_MODEL') or os.getenv('KIE_MODEL')
+# Start the KIE call for /ask alongside the knowledge base search instead of
+# after it; costs a KIE request even when a local entry answers the question
+KIE_SPECULATIVE_ASK = os.getenv('KIE_SPECULATIVE_ASK', '').lower() in ('1', 'true', 'yes')
+# Upper bound for a single /ask KIE call, independent of the client timeout
+KIE_ASK_TIMEOUT = float(os.getenv('KIE_ASK_TIMEOUT_SECONDS', '10'))
 
 # Initialize knowledge storage
 storage = KnowledgeStorage()
+# Coalesces concurrent /add writes into one file rewrite per batch
+entry_writer = EntryWriteBatcher(storage)
 # KIE client (async)
 kie = get_client()
+# Coalesces bursts of replies to the same chat into fewer API calls
+outbound = OutboundBatcher(window=float(os.getenv('BATCH_FLUSH_INTERVAL', '0.5')))
+
+# Static reply texts
+_START_SUFFIX = (
+    '! Welcome to KIE (Knowledge Is Everything) bot. '
+    'I am designed to help you find and share knowledge. '
+    'Use /help to see available commands.'
+)
+_HELP_TEXT = (
+    'Available commands:\n'
+    '/start - Start the bot\n'
+    '/help - Show this help message\n'
+    '/search [query] - Search for knowledge\n'
+    '/ask [question] - Ask a question\n'
+    '/add [knowledge] - Contribute new knowledge'
+)
+_SEARCH_USAGE = 'Please provide a search query. Usage: /search [query]'
+_ASK_USAGE = 'Please provide a question. Usage: /ask [question]'
+_ADD_USAGE = 'Please provide knowledge to add. Usage: /add [knowledge]'
+_ADD_FAILED = 'Failed to add knowledge. Please try again.'
+_ADD_BUSY = 'Too many additions are waiting to be saved. Please try again in a moment.'
+_NO_MODELS = 'No KIE models available or KIE API not configured.'
+
+# Successful KIE answers for /ask, keyed by model and normalized question
+# (LRU eviction once full, entries expire after the TTL)
+_kie_answer_cache = TTLCache(
+    maxsize=int(os.getenv('KIE_CACHE_SIZE', '1024')),
+    ttl=int(os.getenv('KIE_CACHE_TTL_SECONDS', '3600'))
+)
+
+
+# Stops /ask from waiting on KIE while it is failing
+_kie_breaker = CircuitBreaker(failure_threshold=5, failure_window=30, reset_timeout=15)
+_KIE_UNAVAILABLE = {'ok': False, 'error': 'KIE is temporarily unavailable, please try again later'}
+
+
+def _question_cache_key(model, question):
+    """Build a cache key from the model id and the normalized question text."""
+    normalized = ' '.join(question.lower().split())
+    return model + ':' + hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+
+
+async def _ask_kie(model, question):
+    """Invoke a KIE model for a question, reusing a cached answer if present."""
+    key = _question_cache_key(model, question)
+    cached = _kie_answer_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if not _kie_breaker.allow():
+        return _KIE_UNAVAILABLE
+
+    try:
+        kie_resp = await asyncio.wait_for(kie.invoke_model(model, {'text': question}), KIE_ASK_TIMEOUT)
+    except asyncio.TimeoutError:
+        _kie_breaker.record_failure()
+        return {'ok': False, 'error': 'Request to KIE timed out'}
+    except Exception:
+        _kie_breaker.record_failure()
+        raise
+
+    if kie_resp.get('ok'):
+        _kie_breaker.record_success()
+        # Errors are not cached so a transient failure is retried next time
+        _kie_answer_cache[key] = kie_resp
+    elif kie_resp.get('network') or (kie_resp.get('status') or 0) >= 500:
+        # Timeouts, network and server errors
+        _kie_breaker.record_failure()
+    else:
+        # A 4xx or a local error (no API key, unknown model) says nothing
+        # about KIE's health
+        _kie_breaker.record_success()
+    return kie_resp
+
+
+# Speculative /ask KIE calls still running; kept referenced so one whose
+# handler stopped waiting can finish and store the (already paid for) answer
+_speculative_kie_tasks = set()
+
+
+def _speculative_kie_done(task):
+    """Forget a finished speculative KIE call, logging an error nobody awaited."""
+    _speculative_kie_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.debug('Speculative KIE request failed: %s', task.exception())
+
+# Recent knowledge-base search results shared by /search and /ask; cleared
+# whenever /add changes the knowledge base
+_search_cache = TTLCache(maxsize=1024, ttl=30)
+_search_inflight = {}
+_search_generation = 0
+
+
+async def _cached_search(tokens):
+    """Search the knowledge base for entries containing every token, sharing
+    results between identical queries."""
+    key = tuple(token.lower() for token in tokens)
+    results = _search_cache.get(key)
+    if results is not None:
+        return results
+
+    task = _search_inflight.get(key)
+    if task is None:
+        generation = _search_generation
+        task = asyncio.ensure_future(storage.search_entries_async(key))
+        _search_inflight[key] = task
+
+        def _store(done):
+            if _search_inflight.get(key) is done:
+                del _search_inflight[key]
+            # Skip results computed before an /add invalidated the cache
+            if generation == _search_generation and not done.cancelled() and done.exception() is None:
+                _search_cache[key] = done.result()
+
+        task.add_done_callback(_store)
+
+    # Concurrent callers with the same query all wait on the one lookup
+    return await asyncio.shield(task)
+
+
+def _invalidate_search_cache():
+    """Forget cached search results after the knowledge base changes."""
+    global _search_generation
+    _search_generation += 1
+    _search_cache.clear()
+    _search_inflight.clear()
+
+
+async def _reply(msg, text):
+    """Reply to a message with plain text through the per-chat outbound batcher."""
+    await outbound.send(msg.chat_id, text, msg.reply_text)
 
 async def start(update, context):
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    await update.message.reply_html(
-        rf'Hi {user.mention_html()}! Welcome to KIE (Knowledge Is Everything) bot. '
-        f'I am designed to help you find and share knowledge. '
-        f'Use /help to see available commands.'
-    )
+    msg = update.message
+    # HTML can't join a plain-text batch; send what is queued first to keep order
+    await outbound.flush(msg.chat_id)
+    await msg.reply_html(f'Hi {user.mention_html()}{_START_SUFFIX}')
 
 async def help_command(update, context):
     """Send a message when the command /help is issued."""
-    await update.message.reply_text(
-        'Available commands:\n'
-        '/start - Start the bot\n'
-        '/help - Show this help message\n'
-        '/search [query] - Search for knowledge\n'
-        '/ask [question] - Ask a question\n'
-        '/add [knowledge] - Contribute new knowledge'
-    )
+    await _reply(update.message, _HELP_TEXT)
 
 async def search(update, context):
     """Handle search queries."""
-    query = ' '.join(context.args) if context.args else ''
+    msg = update.message
+    args = context.args
 
-    if not query:
-        await update.message.reply_text('Please provide a search query. Usage: /search [query]')
+    if not args:
+        await _reply(msg, _SEARCH_USAGE)
         return
 
-    # Perform search using knowledge storage
-    results = storage.search_entries(query)
+    # Perform search using knowledge storage; the tokens are matched
+    # individually, the joined query is only used for display
+    results = await _cached_search(args)
+    query = ' '.join(args)
 
     if results:
-        response = f'Found {len(results)} result(s) for "{query}":\n\n'
+        parts = [f'Found {len(results)} result(s) for "{query}":', '']
         for i, result in enumerate(results[:5], 1):  # Limit to first 5 results
-            response += f'{i}. {result["content"][:100]}...\n'
-            if len(result["content"]) > 100:
-                response += f'   (ID: {result["id"]})\n'
-            else:
-                response += f'   (ID: {result["id"]})\n'
+            content = result["content"]
+            snippet = content[:100] + ('...' if len(content) > 100 else '')
+            parts.append(f'{i}. {snippet}')
+            parts.append(f'   (ID: {result["id"]})')
+        response = '\n'.join(parts)
     else:
         response = f'No results found for "{query}". You can contribute knowledge using /add command.'
 
-    await update.message.reply_text(response)
+    await _reply(msg, response)
 
 async def ask(update, context):
     """Handle questions."""
-    question = ' '.join(context.args) if context.args else ''
+    msg = update.message
+    args = context.args
+    question = ' '.join(args) if args else ''
 
     if not question:
-        await update.message.reply_text('Please provide a question. Usage: /ask [question]')
+        await _reply(msg, _ASK_USAGE)
         return
 
+    kie_task = None
+    if KIE_MODEL and KIE_SPECULATIVE_ASK:
+        kie_task = asyncio.create_task(_ask_kie(KIE_MODEL, question))
+        _speculative_kie_tasks.add(kie_task)
+        kie_task.add_done_callback(_speculative_kie_done)
+
     # Try to find relevant information in knowledge storage
-    results = storage.search_entries(question)
+    results = await _cached_search(args)
 
     if results:
-        response = f'Based on your question "{question}", here are some relevant entries:\n\n'
+        # A speculative KIE request is left to finish instead of being
+        # cancelled: it is billed either way, and its answer goes into the
+        # answer cache (_speculative_kie_tasks keeps it referenced until then)
+        parts = [f'Based on your question "{question}", here are some relevant entries:', '']
         for i, result in enumerate(results[:3], 1):  # Limit to first 3 results
-            response += f'{i}. {result["content"]}\n\n'
-        response += 'If this doesn\'t answer your question, try rephrasing or contribute knowledge using /add.'
+            parts.append(f'{i}. {result["content"]}')
+            parts.append('')
+        parts.append('If this doesn\'t answer your question, try rephrasing or contribute knowledge using /add.')
+        response = '\n'.join(parts)
     else:
         # No local results — ask KIE models
-        kie_model = os.getenv('KIE_DEFAULT_MODEL') or os.getenv('KIE_MODEL')
-
-        if kie_model:
+        if KIE_MODEL:
             # invoke kie model asynchronously
             try:
-                kie_resp = await kie.invoke_model(kie_model, {'text': question})
+                if kie_task is not None:
+                    kie_resp = await kie_task
+                else:
+                    kie_resp = await _ask_kie(KIE_MODEL, question)
                 if kie_resp.get('ok'):
                     result = kie_resp.get('result')
                     # attempt to extract human-readable text
@@ -114,27 +279,47 @@ async def ask(update, context):
         else:
             response = f'Question: {question}\n\nI couldn\'t find relevant information in my knowledge base. You can contribute knowledge using /add or rephrase your question.\nNote: No KIE model configured (set KIE_DEFAULT_MODEL or KIE_MODEL env var)'
 
-    await update.message.reply_text(response)
+    await _reply(msg, response)
 
 async def add_knowledge(update, context):
     """Add new knowledge."""
-    knowledge = ' '.join(context.args) if context.args else ''
+    msg = update.message
+    args = context.args
+    knowledge = ' '.join(args) if args else ''
 
     if not knowledge:
-        await update.message.reply_text('Please provide knowledge to add. Usage: /add [knowledge]')
+        await _reply(msg, _ADD_USAGE)
+        return
+
+    if entry_writer.is_full():
+        await _reply(msg, _ADD_BUSY)
         return
 
     # Add to knowledge storage
-    success = storage.add_entry(knowledge, update.effective_user.id)
+    uid = update.effective_user.id
+    success = await entry_writer.add(knowledge, uid)
 
     if success:
-        await update.message.reply_text(f'Knowledge added successfully: "{knowledge[:50]}..."')
+        _invalidate_search_cache()
+        snippet = knowledge[:50] + ('...' if len(knowledge) > 50 else '')
+        await _reply(msg, f'Knowledge added successfully: "{snippet}"')
     else:
-        await update.message.reply_text('Failed to add knowledge. Please try again.')
+        await _reply(msg, _ADD_FAILED)
 
 async def echo_non_commands(update, context):
     """Echo back non-command messages."""
-    await update.message.reply_text(f'Received your message: "{update.message.text}"\n\nUse /help to see available commands.')
+    msg = update.message
+    await _reply(msg, f'Received your message: "{msg.text}"\n\nUse /help to see available commands.')
+
+async def _post_stop(application):
+    """Save queued entries and send replies still waiting in the outbound batcher."""
+    await entry_writer.close()
+    await outbound.flush_all()
+
+async def _post_shutdown(application):
+    """Release resources held outside of the Application."""
+    await kie.close()
+    storage.close()
 
 def main():
     """Start the bot."""
@@ -142,8 +327,18 @@ def main():
         logger.error("No TELEGRAM_BOT_TOKEN found in environment variables!")
         return
 
+    if UVLOOP_AVAILABLE:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(TelegramRateLimiter())
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -151,26 +346,44 @@ def main():
     application.add_handler(CommandHandler("search", search))
     application.add_handler(CommandHandler("ask", ask))
     application.add_handler(CommandHandler("add", add_knowledge))
+    application.add_handler(CommandHandler("models", models_command))
 
     # Add message handler for non-commands
     application.add_handler(MessageHandler(~filters.COMMAND, echo_non_commands))
 
-    # register extra handlers (models etc.)
-    try:
-        _register_extra_handlers(application)
-    except Exception:
-        # ignore if function missing or fails
-        pass
-
     # Run the bot until the user presses Ctrl-C
     application.run_polling()
 
 
+# Model list shared by every /models call, refreshed at most once per TTL
+MODELS_CACHE_TTL = 60
+_models_cache = {"ts": 0.0, "val": None}
+_models_lock = asyncio.Lock()
+
+
+async def _get_models():
+    """Return the KIE model list, fetching it only when the cached copy is stale."""
+    if _models_cache["val"] is not None and time.monotonic() - _models_cache["ts"] < MODELS_CACHE_TTL:
+        return _models_cache["val"]
+
+    async with _models_lock:
+        # Another caller may have refreshed the cache while we waited
+        if _models_cache["val"] is not None and time.monotonic() - _models_cache["ts"] < MODELS_CACHE_TTL:
+            return _models_cache["val"]
+        models = await kie.list_models()
+        if models:
+            # An empty list usually means the API is unavailable; retry next time
+            _models_cache["val"] = models
+            _models_cache["ts"] = time.monotonic()
+        return models
+
+
 async def models_command(update, context):
     """List available models from KIE (if configured)."""
-    models = await kie.list_models()
+    msg = update.message
+    models = await _get_models()
     if not models:
-        await update.message.reply_text('No KIE models available or KIE API not configured.')
+        await _reply(msg, _NO_MODELS)
         return
 
     resp_lines = []
@@ -179,12 +392,8 @@ async def models_command(update, context):
         desc = m.get('description', '')
         resp_lines.append(f"- {name}: {desc[:200]}")
 
-    await update.message.reply_text('Available KIE models:\n' + '\n'.join(resp_lines))
-
+    await _reply(msg, 'Available KIE models:\n' + '\n'.join(resp_lines))
 
-def _register_extra_handlers(application):
-    # Register async command handler for models
-    application.add_handler(CommandHandler('models', models_command))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,47 +5,158 @@ Enhanced version with KIE AI model selection and generation
 
 import logging
 import asyncio
+import bisect
+import contextlib
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
-    ConversationHandler, CallbackQueryHandler
+    ConversationHandler, CallbackQueryHandler, BaseUpdateProcessor
 )
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
 from telegram.ext import ContextTypes
 import os
 from dotenv import load_dotenv
+from cachetools import LRUCache, TTLCache
 from knowledge_storage import KnowledgeStorage
+from generation_store import GenerationStore
 from kie_client import get_client
-from kie_models import KIE_MODELS, get_model_by_id, get_models_by_category, get_categories
+from outbound import OutboundBatcher, TelegramRateLimiter
+from kie_models import (
+    KIE_MODELS, TOTAL_MODELS, CATEGORIES, CATEGORY_META, DEFAULT_PARAMS_BY_MODEL,
+    get_model_by_id, get_models_by_category
+)
 import json
 import aiohttp
 import io
+import mmap
 from io import BytesIO
 import re
 import platform
+import sys
+import importlib.util
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from dataclasses import dataclass, field
+from functools import lru_cache, partial, wraps
+from typing import Mapping, Optional
+
+# Optional faster event loop (libuv based, not available on Windows)
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = sys.platform != 'win32'
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+# Optional faster JSON (C implementation, emits UTF-8 bytes directly)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
 
 # Load environment variables FIRST
 load_dotenv()
 
 # Enable logging
+# LOG_LEVEL=WARNING skips formatting of the per-update INFO records entirely
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    datefmt='%Y-%m-%d %H:%M:%S',
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    force=True
 )
 
 logger = logging.getLogger(__name__)
 
-# Try to import PIL/Pillow
-try:
-    from PIL import Image
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
+
+def _lazy_import(name: str):
+    """
+    Return module name without executing it yet, or None if it isn't installed.
+    
+    The module body runs on first attribute access, so the OCR stack only
+    costs import time and memory once a screenshot actually needs it.
+    """
+    try:
+        spec = importlib.util.find_spec(name)
+    except ImportError:
+        return None
+    if spec is None:
+        return None
+    if name in sys.modules:
+        return sys.modules[name]
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# PIL/Pillow and pytesseract are loaded lazily (Tesseract itself is located on first use)
+Image = _lazy_import('PIL.Image')
+PIL_AVAILABLE = Image is not None
+if not PIL_AVAILABLE:
     logger.warning("PIL/Pillow not available. Image analysis will be limited.")
 
-# Try to import pytesseract and configure Tesseract path
+pytesseract = _lazy_import('pytesseract')
+OCR_AVAILABLE = pytesseract is not None
+if not OCR_AVAILABLE:
+    logger.warning("pytesseract not available. OCR analysis will be disabled.")
+
+# Optional in-process Tesseract binding: no subprocess per image and the
+# language data stays loaded between screenshots. It is an extension module,
+# so it is imported in _get_tess_api() rather than lazily here.
+TESSEROCR_AVAILABLE = importlib.util.find_spec('tesserocr') is not None
+
+# Optional multi-pattern matcher for the payment keyword scan
 try:
-    import pytesseract
-    OCR_AVAILABLE = True
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# Result of the Tesseract probe, None until _ensure_tesseract() runs
+_TESSERACT_READY = None
+
+# Shared tesserocr API (not thread-safe, use under _tess_api_lock)
+_tess_api = None
+_tess_api_lock = threading.Lock()
+
+
+def _get_tess_api():
+    """Return the shared tesserocr API, or None if tesserocr can't be used."""
+    global _tess_api, TESSEROCR_AVAILABLE
+    if _tess_api is None and TESSEROCR_AVAILABLE:
+        with _tess_api_lock:
+            if _tess_api is None:
+                try:
+                    import tesserocr
+                    _tess_api = tesserocr.PyTessBaseAPI(lang='rus+eng', psm=tesserocr.PSM.AUTO)
+                except Exception as e:
+                    logger.warning("tesserocr unavailable, falling back to pytesseract: %s", e)
+                    TESSEROCR_AVAILABLE = False
+    return _tess_api
+
+
+def _ensure_tesseract() -> bool:
+    """
+    Locate Tesseract and check that it runs, once; later calls return the cached result.
+    
+    Done lazily because the probe spawns a subprocess, which would otherwise
+    slow down every import of this module.
+    """
+    global _TESSERACT_READY
+    if _TESSERACT_READY is not None:
+        return _TESSERACT_READY
+    if _get_tess_api() is not None:
+        logger.info("Tesseract OCR is available (tesserocr).")
+        _TESSERACT_READY = True
+        return True
+    if not OCR_AVAILABLE:
+        _TESSERACT_READY = False
+        return False
     
     # Try to set Tesseract path for Windows
     if platform.system() == 'Windows':
@@ -55,58 +166,150 @@ try:
             r'C:\Program Files (x86)\Tesseract-OCR\tesseract.exe',
             r'C:\Users\{}\AppData\Local\Programs\Tesseract-OCR\tesseract.exe'.format(os.getenv('USERNAME', '')),
         ]
-        tesseract_found = False
-        for path in possible_paths:
-            if os.path.exists(path):
-                pytesseract.pytesseract.tesseract_cmd = path
-                tesseract_found = True
-                logger.info(f"Tesseract found at: {path}")
-                break
-        
-        if not tesseract_found:
+        tesseract_path = next((path for path in possible_paths if os.path.exists(path)), None)
+        if tesseract_path is None:
             # Try to find in PATH
-            try:
-                import shutil
-                tesseract_path = shutil.which('tesseract')
-                if tesseract_path:
-                    pytesseract.pytesseract.tesseract_cmd = tesseract_path
-                    logger.info(f"Tesseract found in PATH: {tesseract_path}")
-                    tesseract_found = True
-            except:
-                pass
-        
-        if not tesseract_found:
+            import shutil
+            tesseract_path = shutil.which('tesseract')
+        if tesseract_path:
+            pytesseract.pytesseract.tesseract_cmd = tesseract_path
+            logger.info("Tesseract found at: %s", tesseract_path)
+        else:
             logger.warning("Tesseract not found in common locations. Make sure it's installed and in PATH.")
     
     # Test if Tesseract works
     try:
         pytesseract.get_tesseract_version()
         logger.info("Tesseract OCR is available and working.")
+        _TESSERACT_READY = True
     except Exception as e:
-        OCR_AVAILABLE = False
-        logger.warning(f"Tesseract OCR is not working: {e}")
-except ImportError:
-    OCR_AVAILABLE = False
-    logger.warning("pytesseract not available. OCR analysis will be disabled.")
+        logger.warning("Tesseract OCR is not working: %s", e)
+        _TESSERACT_READY = False
+    return _TESSERACT_READY
 
 # Bot token from environment variable
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
+# Maximum number of updates processed at the same time
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
 # Admin user ID (can be set via environment variable)
 ADMIN_ID = int(os.getenv('ADMIN_ID', '6913446846'))
 
+# SBP phone number for payments: shown in the payment details and looked for on
+# payment screenshots (empty if not set)
+PAYMENT_PHONE = os.getenv('PAYMENT_PHONE', '').strip()
+
 # Price conversion constants
 # Based on: 18 credits = $0.09 = 6.95 ₽
 CREDIT_TO_USD = 0.005  # 1 credit = $0.005 ($0.09 / 18)
 USD_TO_RUB = 6.95 / 0.09  # 1 USD = 77.2222... RUB (calculated from 6.95 ₽ / $0.09)
+CREDIT_RATE = CREDIT_TO_USD * USD_TO_RUB  # RUB per credit
 
 # Initialize knowledge storage
 storage = KnowledgeStorage()
 # KIE client (async)
 kie = get_client()
+# Coalesces bursts of keyboard-less texts to the same chat into fewer API calls
+outbound = OutboundBatcher(window=float(os.getenv('BATCH_FLUSH_INTERVAL', '0.5')), separator='\n\n')
+
+@dataclass(slots=True)
+class UserSession:
+    """Conversation state of one user: model being configured, pending input, mode flags."""
+    model_id: Optional[str] = None
+    model_info: dict = field(default_factory=dict)
+    # Read-only input_params of the model (shared with KIE_MODELS, never mutated)
+    properties: Mapping = field(default_factory=dict)
+    required: tuple = ()
+    params: dict = field(default_factory=dict)
+    current_param: Optional[str] = None
+    waiting_for: Optional[str] = None
+    has_image_input: bool = False
+    # Image URLs uploaded so far for the image parameter named by waiting_for
+    images: list = field(default_factory=list)
+    # Admin viewing the bot as a regular user
+    admin_user_mode: bool = False
+    topup_amount: float = 0
+    task_id: Optional[str] = None
+    poll_attempts: int = 0
+    max_poll_attempts: int = 0
+
+
+class UserSessions(TTLCache):
+    """
+    user_id -> UserSession; indexing an unknown user starts an empty session.
+    
+    Sessions of users who stop interacting expire after ttl seconds, and the
+    least recently used ones are dropped beyond maxsize, so abandoned
+    conversations don't accumulate forever. The ttl counts from the last time
+    a session was looked up, not from when it was created, so a long
+    conversation doesn't lose its session halfway through.
+    """
+    
+    def __getitem__(self, user_id):
+        session = super().__getitem__(user_id)
+        # Re-inserting restarts the session's ttl; TTLCache also drops
+        # expired sessions on every insert, so no separate sweep is needed
+        super().__setitem__(user_id, session)
+        return session
+    
+    def __missing__(self, user_id):
+        session = UserSession()
+        self[user_id] = session
+        return session
+
 
 # Store user sessions
-user_sessions = {}
+user_sessions = UserSessions(
+    maxsize=int(os.getenv('USER_SESSIONS_MAX', '50000')),
+    ttl=int(os.getenv('USER_SESSION_TTL_SECONDS', '7200'))
+)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates of different users concurrently, but one user's in order.
+
+    ConversationHandler and UserSession assume a user's updates are handled one
+    at a time: two confirms of one generation must not both charge the
+    balance, and the photos of an album must not race on the session. Updates
+    are keyed by user (or by chat when there is no user) and wait on that key's
+    lock; updates without either run straight away. A queued update still holds
+    one of the max_concurrent_updates slots while it waits.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                key = ('user', update.effective_user.id)
+            elif update.effective_chat is not None:
+                key = ('chat', update.effective_chat.id)
+        if key is None:
+            await coroutine
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 
 def get_admin_limits() -> dict:
@@ -148,9 +351,10 @@ def add_admin_spent(user_id: int, amount: float):
     if user_id == ADMIN_ID:
         return  # Main admin doesn't have limits
     admin_limits = get_admin_limits()
-    if str(user_id) not in admin_limits:
+    admin_data = admin_limits.get(str(user_id))
+    if admin_data is None:
         return
-    admin_limits[str(user_id)]['spent'] = admin_limits[str(user_id)].get('spent', 0.0) + amount
+    admin_data['spent'] = admin_data.get('spent', 0.0) + amount
     save_admin_limits(admin_limits)
 
 
@@ -172,7 +376,8 @@ def get_is_admin(user_id: int) -> bool:
     """
     if is_admin(user_id):
         # Check if admin is in user mode (viewing as regular user)
-        if user_id in user_sessions and user_sessions[user_id].get('admin_user_mode', False):
+        session = user_sessions.get(user_id)
+        if session is not None and session.admin_user_mode:
             return False  # Show as regular user
         else:
             return True
@@ -219,6 +424,12 @@ def calculate_price_rub(model_id: str, params: dict = None, is_admin: bool = Fal
     return price_rub
 
 
+@lru_cache(maxsize=256)
+def min_price_rub(model_id: str, is_admin: bool = False) -> float:
+    """Price of a model with its cheapest params (DEFAULT_PARAMS_BY_MODEL), cached."""
+    return calculate_price_rub(model_id, DEFAULT_PARAMS_BY_MODEL.get(model_id, {}), is_admin)
+
+
 def format_price_rub(price: float, is_admin: bool = False) -> str:
     """Format price in rubles with appropriate text (rounded to 2 decimal places)."""
     # Always round to 2 decimal places
@@ -230,8 +441,31 @@ def format_price_rub(price: float, is_admin: bool = False) -> str:
         return f"💰 <b>{price_str} ₽</b>"
 
 
+@lru_cache(maxsize=1024)
+def format_rub(amount: float) -> str:
+    """Amount in rubles with 2 decimals and trailing zeros dropped (e.g. 12.5, 100)."""
+    return f"{amount:.2f}".rstrip('0').rstrip('.')
+
+
+def available_generations(balance: float, price: float) -> int:
+    """Number of generations at price that balance covers."""
+    if price <= 0:
+        return 0
+    # Rubles are floats, so a whole quotient can come out a hair below the
+    # integer; floor division is no better here (69.5 // 13.9 == 4.0)
+    return int(balance / price + 1e-9)
+
+
 def get_model_price_text(model_id: str, params: dict = None, is_admin: bool = False) -> str:
     """Get formatted price text for a model."""
+    params_key = tuple(sorted(params.items())) if params else None
+    return _model_price_text(model_id, params_key, is_admin)
+
+
+@lru_cache(maxsize=256)
+def _model_price_text(model_id: str, params_key: tuple = None, is_admin: bool = False) -> str:
+    """get_model_price_text with params passed as a hashable tuple of items (cached)."""
+    params = dict(params_key) if params_key else None
     if model_id == "z-image":
         price = calculate_price_rub(model_id, params, is_admin)
         return format_price_rub(price, is_admin) + " за изображение"
@@ -264,14 +498,49 @@ SELECTING_AMOUNT, WAITING_PAYMENT_SCREENSHOT = range(3, 5)
 # Admin test OCR state
 ADMIN_TEST_OCR = 5
 
-# Store user sessions
-user_sessions = {}
+# Last generation of each user for the "generate again" feature, kept across restarts
+saved_generations = GenerationStore(
+    os.getenv('SAVED_GENERATIONS_DB', 'saved_generations.db'),
+    ttl=int(os.getenv('SAVED_GENERATIONS_TTL_SECONDS', '86400'))
+)
+
+# user_id -> callback_data of the user's last button press. A press of the same
+# button again within CALLBACK_DEDUP_WINDOW seconds (button mashing) is dropped.
+CALLBACK_DEDUP_WINDOW = 0.5
+_recent_callbacks = TTLCache(maxsize=10000, ttl=CALLBACK_DEDUP_WINDOW)
+
+# Last successful KIE credits response, reused for CREDITS_CACHE_TTL seconds so
+# repeated balance / stats refreshes don't each wait for the API
+CREDITS_CACHE_TTL = 2.0
+_credits_cache = TTLCache(maxsize=1, ttl=CREDITS_CACHE_TTL)
+
+
+async def get_kie_credits() -> dict:
+    """kie.get_credits(), with a successful result cached for CREDITS_CACHE_TTL seconds."""
+    result = _credits_cache.get('credits')
+    if result is None:
+        result = await kie.get_credits()
+        if result.get('ok'):
+            _credits_cache['credits'] = result
+    return result
 
-# Store saved generation data for "generate again" feature
-saved_generations = {}
 
-# Store saved generation data for "generate again" feature
-saved_generations = {}
+# Recently downloaded Telegram files by file_id, bounded by total size, so a
+# photo sent again (e.g. a screenshot after an error) isn't fetched twice
+FILE_CACHE_BYTES = 32 * 1024 * 1024
+_file_cache = LRUCache(maxsize=FILE_CACHE_BYTES, getsizeof=len)
+
+
+async def download_telegram_file(bot, file_id: str) -> bytes:
+    """Contents of a Telegram file (get_file + download), cached by file_id."""
+    data = _file_cache.get(file_id)
+    if data is None:
+        file = await bot.get_file(file_id)
+        data = bytes(await file.download_as_bytearray())
+        if len(data) <= FILE_CACHE_BYTES:
+            _file_cache[file_id] = data
+    return data
+
 
 # Payment data files
 BALANCES_FILE = "user_balances.json"
@@ -282,28 +551,153 @@ BLOCKED_USERS_FILE = "blocked_users.json"
 
 # ==================== Payment System Functions ====================
 
+# Parsed contents of the JSON data files, loaded once; writes go to the cache
+# and are flushed to disk in the background (see save_json_file)
+_json_cache = {}
+_json_dirty = set()
+_json_flush_task = None
+# Background write of the last flush, running in a worker thread
+_json_write = None
+JSON_FLUSH_INTERVAL = float(os.getenv('JSON_FLUSH_INTERVAL', '2'))
+JSON_FSYNC = os.getenv('JSON_FSYNC', '1') != '0'
+# Files at least this large are memory-mapped when loaded
+JSON_MMAP_MIN_SIZE = 64 * 1024
+
+
+def _load_json_from_disk(filename: str, default: dict) -> dict:
+    """Read a JSON file, return default if it doesn't exist. Raises on bad data."""
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            if ORJSON_AVAILABLE and os.fstat(f.fileno()).st_size >= JSON_MMAP_MIN_SIZE:
+                # Parse straight from the mapped pages instead of copying the
+                # whole file into a bytes object first
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    with memoryview(mm) as view:
+                        return orjson.loads(view)
+            raw = f.read()
+        if ORJSON_AVAILABLE:
+            return orjson.loads(raw)
+        return json.loads(raw)
+    return default
+
+
+def _write_json_file(filename: str, payload: bytes):
+    """
+    Write serialized JSON next to the target and move it into place.
+    
+    A crash mid-write leaves the previous file intact instead of a truncated
+    one (which would load as empty balances). With JSON_FSYNC the data is on
+    disk before the rename; writes are debounced, so this isn't per update.
+    """
+    tmp_path = filename + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            if JSON_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+def _serialize_json(data: dict) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+
 def load_json_file(filename: str, default: dict = None) -> dict:
-    """Load JSON file, return default if file doesn't exist."""
+    """
+    Load JSON file, return default if file doesn't exist.
+    
+    The file is read from disk only on first use; later calls return the
+    cached dict, which callers may modify and pass back to save_json_file.
+    """
     if default is None:
         default = {}
+    data = _json_cache.get(filename)
+    if data is not None:
+        return data
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        return default
+        data = _load_json_from_disk(filename, default)
     except Exception as e:
-        logger.error(f"Error loading {filename}: {e}")
+        logger.error("Error loading %s: %s", filename, e)
+        # Don't cache the default, so a later call can retry the read
         return default
+    _json_cache[filename] = data
+    return data
 
 
 def save_json_file(filename: str, data: dict):
-    """Save data to JSON file."""
+    """Save data to JSON file (written to disk within JSON_FLUSH_INTERVAL)."""
+    _json_cache[filename] = data
+    _json_dirty.add(filename)
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Error saving {filename}: {e}")
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No event loop (scripts, shutdown): write through immediately
+        flush_json_files()
+        return
+    global _json_flush_task
+    if _json_flush_task is None or _json_flush_task.done():
+        _json_flush_task = asyncio.create_task(_flush_json_files_later())
+
+
+async def _flush_json_files_later():
+    """
+    Coalesce the writes made during one interval into a single flush.
+    
+    Keeps going until nothing is dirty, so saves made while a flush is being
+    written (and files whose write failed) go out in the next round.
+    """
+    global _json_write
+    while _json_dirty:
+        await asyncio.sleep(JSON_FLUSH_INTERVAL)
+        # Serialize on the loop thread so each file is a consistent snapshot
+        pending = _take_dirty_json()
+        if not pending:
+            continue
+        _json_write = asyncio.ensure_future(asyncio.to_thread(_write_pending_json, pending))
+        # Shielded so cancelling this task doesn't abandon a write that is
+        # already running in its thread; _post_shutdown waits for it instead
+        _json_dirty.update(await asyncio.shield(_json_write))
+
+
+def _take_dirty_json() -> list:
+    pending = []
+    for filename in list(_json_dirty):
+        _json_dirty.discard(filename)
+        try:
+            pending.append((filename, _serialize_json(_json_cache[filename])))
+        except Exception as e:
+            logger.error("Error saving %s: %s", filename, e)
+    return pending
+
 
+def _write_pending_json(pending: list) -> list:
+    """Write serialized files, return the names of those that failed."""
+    failed = []
+    for filename, payload in pending:
+        try:
+            _write_json_file(filename, payload)
+        except Exception as e:
+            logger.error("Error saving %s: %s", filename, e)
+            failed.append(filename)
+    return failed
+
+
+def flush_json_files():
+    """Write every modified JSON file to disk now."""
+    _write_pending_json(_take_dirty_json())
+
+
+# The balance, limit and payment helpers below are synchronous and never await
+# between reading and writing the cached data, so with concurrent_updates they
+# still run atomically with respect to other handlers on the event loop
+# (don't add awaits inside them, or wrap them in an asyncio.Lock if you do).
 
 def get_user_balance(user_id: int) -> float:
     """Get user balance in rubles."""
@@ -341,6 +735,20 @@ def is_user_blocked(user_id: int) -> bool:
     return blocked.get(str(user_id), False)
 
 
+UserContext = namedtuple('UserContext', 'balance is_admin blocked')
+
+
+def get_user_context(user_id: int) -> UserContext:
+    """
+    Balance, admin status (with admin user mode) and blocked flag of a user.
+    
+    All three come from the in-memory JSON caches, so this is cheap and always
+    current; it is not cached further, which would only let a fresh top-up or
+    block show up late.
+    """
+    return UserContext(get_user_balance(user_id), get_is_admin(user_id), is_user_blocked(user_id))
+
+
 def block_user(user_id: int):
     """Block a user."""
     blocked = load_json_file(BLOCKED_USERS_FILE, {})
@@ -356,11 +764,38 @@ def unblock_user(user_id: int):
         save_json_file(BLOCKED_USERS_FILE, blocked)
 
 
+# Payments ordered by timestamp (oldest first), built once from the cached
+# payments dict and kept in order by add_payment, so listing doesn't re-sort
+_payments_by_time = []
+_payments_by_time_source = None
+
+# Highest payment id handed out, read from the payments file on first use
+_last_payment_id = None
+
+
+def _payment_time(payment: dict) -> float:
+    return payment.get("timestamp", 0)
+
+
+def _get_payments_by_time() -> list:
+    global _payments_by_time, _payments_by_time_source
+    payments = load_json_file(PAYMENTS_FILE, {})
+    if payments is not _payments_by_time_source:
+        _payments_by_time = sorted(payments.values(), key=_payment_time)
+        _payments_by_time_source = payments
+    return _payments_by_time
+
+
 def add_payment(user_id: int, amount: float, screenshot_file_id: str = None) -> dict:
     """Add a payment record. Returns payment dict with id, timestamp, etc."""
+    global _last_payment_id
     payments = load_json_file(PAYMENTS_FILE, {})
-    payment_id = len(payments) + 1
-    import time
+    payments_by_time = _get_payments_by_time()
+    # Ids only ever grow, even if the history is trimmed by hand
+    if _last_payment_id is None:
+        _last_payment_id = max((int(key) for key in payments), default=0)
+    _last_payment_id += 1
+    payment_id = _last_payment_id
     payment = {
         "id": payment_id,
         "user_id": user_id,
@@ -371,6 +806,7 @@ def add_payment(user_id: int, amount: float, screenshot_file_id: str = None) ->
     }
     payments[str(payment_id)] = payment
     save_json_file(PAYMENTS_FILE, payments)
+    bisect.insort(payments_by_time, payment, key=_payment_time)
     
     # Auto-add balance
     add_user_balance(user_id, amount)
@@ -380,10 +816,7 @@ def add_payment(user_id: int, amount: float, screenshot_file_id: str = None) ->
 
 def get_all_payments() -> list:
     """Get all payments sorted by timestamp (newest first)."""
-    payments = load_json_file(PAYMENTS_FILE, {})
-    payment_list = list(payments.values())
-    payment_list.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    return payment_list
+    return _get_payments_by_time()[::-1]
 
 
 def get_user_payments(user_id: int) -> list:
@@ -404,10 +837,11 @@ def get_payment_stats() -> dict:
     }
 
 
+@lru_cache(maxsize=1)
 def get_payment_details() -> str:
-    """Get payment details from .env (СБП - Система быстрых платежей)."""
+    """Get payment details from .env (СБП - Система быстрых платежей), built once."""
     card_holder = os.getenv('PAYMENT_CARD_HOLDER', '')
-    phone = os.getenv('PAYMENT_PHONE', '')
+    phone = PAYMENT_PHONE
     bank = os.getenv('PAYMENT_BANK', '')
     
     details = "💳 <b>Реквизиты для оплаты (СБП):</b>\n\n"
@@ -425,8 +859,9 @@ def get_payment_details() -> str:
     return details
 
 
+@lru_cache(maxsize=1)
 def get_support_contact() -> str:
-    """Get support contact information from .env (only Telegram)."""
+    """Get support contact information from .env (only Telegram), built once."""
     support_telegram = os.getenv('SUPPORT_TELEGRAM', '')
     support_text = os.getenv('SUPPORT_TEXT', '')
     
@@ -447,12 +882,238 @@ def get_support_contact() -> str:
     return contact
 
 
+# Payment-related keywords (Russian and English) expected in a lowercased receipt
+_PAYMENT_KEYWORDS = (
+    'перевод', 'оплата', 'платеж', 'спб', 'сбп', 'payment', 'transfer',
+    'отправлено', 'успешно', 'success', 'получатель', 'получатель:',
+    'сумма', 'итого', 'amount', 'total', 'сумма перевода', 'переведено',
+    'квитанция', 'receipt', 'статус', 'status', 'комиссия', 'commission'
+)
+
+# All keywords are matched in one pass over the text, with an Aho-Corasick
+# automaton if pyahocorasick is installed or a regex alternation otherwise
+if AHOCORASICK_AVAILABLE:
+    _PAYMENT_KEYWORDS_AUTOMATON = ahocorasick.Automaton()
+    for _keyword in _PAYMENT_KEYWORDS:
+        _PAYMENT_KEYWORDS_AUTOMATON.add_word(_keyword, _keyword)
+    _PAYMENT_KEYWORDS_AUTOMATON.make_automaton()
+else:
+    _PAYMENT_KEYWORDS_RE = re.compile('|'.join(map(re.escape, _PAYMENT_KEYWORDS)))
+
+
+def _has_payment_keywords(text: str) -> bool:
+    """True if the (lowercased) text contains any payment keyword."""
+    if AHOCORASICK_AVAILABLE:
+        return next(_PAYMENT_KEYWORDS_AUTOMATON.iter(text), None) is not None
+    return _PAYMENT_KEYWORDS_RE.search(text) is not None
+
+
+# Patterns used to find the paid amount in OCR text of a payment screenshot,
+# each with exactly one capture group for the number
+_AMOUNT_PATTERNS = (
+    # With currency symbols
+    r'(\d+[.,]\d+)\s*[₽рубР]',
+    r'(\d+)\s*[₽рубР]',
+    r'[₽рубР]\s*(\d+[.,]\d+)',
+    r'[₽рубР]\s*(\d+)',
+    # Near payment keywords
+    r'(?:сумма|итого|перевод|amount|total)[:\s]+(\d+[.,]?\d*)',
+    r'(\d+[.,]?\d*)\s*(?:сумма|итого|перевод|amount|total)',
+    # Standalone numbers near payment context (more flexible)
+    r'(?:сумма|итого|перевод|amount|total)[:\s]*\s*(\d+[.,]?\d*)\s*[₽рубР]?',
+    # Just numbers in context of payment (last resort); tried before the
+    # misrecognition patterns so 1200 isn't read as "1" followed by "2"
+    r'\b(\d{2,6})\b',  # 2-6 digit numbers (likely amounts)
+    # Numbers that might be misrecognized (B instead of Р, 2 instead of Р)
+    r'(\d+)\s*[B2]',  # 500 B or 500 2 might be 500 Р
+    r'(\d+)\s*[₽рубРB2]',
+)
+# All amount patterns as one alternation, so the text is scanned only once
+_AMOUNT_RE = re.compile('|'.join(f'(?:{p})' for p in _AMOUNT_PATTERNS), re.IGNORECASE)
+
+
+def _extract_amounts(text: str) -> list:
+    """All numbers matched by _AMOUNT_PATTERNS in OCR text, in order of appearance."""
+    amounts = []
+    for match in _AMOUNT_RE.finditer(text):
+        try:
+            amounts.append(float(match.group(match.lastindex).replace(',', '.')))
+        except ValueError:
+            continue
+    return amounts
+
+# Phone number patterns and the characters stripped before comparing numbers
+_PHONE_PATTERNS = [re.compile(p) for p in (
+    r'\+?7\d{10}',
+    r'\+?7\s?\d{3}\s?\d{3}\s?\d{2}\s?\d{2}',
+    r'\d{11}',
+    r'\+?\d{1}\s?\d{3}\s?\d{3}\s?\d{2}\s?\d{2}',
+)]
+_PHONE_NORMALIZE = re.compile(r'[+\s\-()]')
+
+
+# Screenshots with a longer side than this are scaled down before OCR
+OCR_MAX_SIDE = 1500
+
+
+def _otsu_threshold(histogram: list) -> int:
+    """Grey level that best separates a 256-bin histogram into two classes."""
+    total = sum(histogram)
+    sum_all = sum(i * count for i, count in enumerate(histogram))
+    sum_back = 0
+    weight_back = 0
+    best_threshold, best_variance = 0, 0.0
+    for level, count in enumerate(histogram):
+        weight_back += count
+        if weight_back == 0:
+            continue
+        weight_fore = total - weight_back
+        if weight_fore == 0:
+            break
+        sum_back += level * count
+        mean_back = sum_back / weight_back
+        mean_fore = (sum_all - sum_back) / weight_fore
+        variance = weight_back * weight_fore * (mean_back - mean_fore) ** 2
+        if variance > best_variance:
+            best_threshold, best_variance = level, variance
+    return best_threshold
+
+
+def _preprocess_for_ocr(image):
+    """Grayscale, downscale and binarize a screenshot so Tesseract has less to do."""
+    image = image.convert('L')
+    w, h = image.size
+    if max(w, h) > OCR_MAX_SIDE:
+        scale = OCR_MAX_SIDE / max(w, h)
+        image = image.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+    threshold = _otsu_threshold(image.histogram())
+    return image.point(lambda p: 255 if p > threshold else 0, mode='1')
+
+
+def _ocr_image_bytes(image_data: bytes) -> str:
+    """Decode an image and extract its text with Tesseract (blocking)."""
+    # Convert bytes to PIL Image
+    image = _preprocess_for_ocr(Image.open(BytesIO(image_data)))
+    
+    api = _get_tess_api()
+    if api is not None:
+        with _tess_api_lock:
+            api.SetImage(image)
+            return api.GetUTF8Text()
+    
+    # Use OCR to extract text
+    try:
+        return pytesseract.image_to_string(image, lang='rus+eng')
+    except Exception as e:
+        logger.error("OCR error: %s", e)
+        # Try with English only if Russian fails
+        try:
+            return pytesseract.image_to_string(image, lang='eng')
+        except:
+            return pytesseract.image_to_string(image)
+
+
+def _ocr_image_batch(images: list) -> list:
+    """
+    Extract the text of several images with one Tesseract run (blocking).
+    
+    The preprocessed images go to a temp dir and Tesseract reads them from a
+    list file, so its startup and language data load are paid once per batch.
+    Falls back to one run per image if the batch run fails.
+    """
+    if _get_tess_api() is not None:
+        # In-process OCR has no startup cost to share
+        return [_ocr_image_bytes(image_data) for image_data in images]
+    try:
+        with tempfile.TemporaryDirectory(prefix='ocr_batch_') as tmp_dir:
+            paths = []
+            for i, image_data in enumerate(images):
+                path = os.path.join(tmp_dir, f'{i}.png')
+                _preprocess_for_ocr(Image.open(BytesIO(image_data))).save(path)
+                paths.append(path)
+            list_path = os.path.join(tmp_dir, 'batch.txt')
+            with open(list_path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(paths) + '\n')
+            # Tesseract ends every page with a form feed
+            pages = pytesseract.image_to_string(list_path, lang='rus+eng').split('\x0c')
+        if len(pages) >= len(images):
+            return pages[:len(images)]
+        logger.warning("Batch OCR returned %s pages for %s images", len(pages), len(images))
+    except Exception as e:
+        logger.warning("Batch OCR failed, processing images one by one: %s", e)
+    return [_ocr_image_bytes(image_data) for image_data in images]
+
+
+class _OCRBatcher:
+    """
+    Collects OCR requests arriving within a short window and runs them as one batch.
+    
+    extract_text() waits at most window seconds for other screenshots before
+    Tesseract starts; a window with a single image skips the list file.
+    """
+    
+    def __init__(self, window: float = 0.2, max_batch: int = 16):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._worker = None
+    
+    async def extract_text(self, image_data: bytes) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((image_data, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+    
+    async def _run(self):
+        await asyncio.sleep(self.window)
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            images = [image_data for image_data, _ in batch]
+            try:
+                if len(images) == 1:
+                    texts = [await asyncio.to_thread(_ocr_image_bytes, images[0])]
+                else:
+                    texts = await asyncio.to_thread(_ocr_image_batch, images)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), text in zip(batch, texts):
+                if not future.done():
+                    future.set_result(text)
+
+
+_ocr_batcher = _OCRBatcher()
+
+
+# Cheap checks that reject obvious non-receipts (thumbnails, banners) before OCR
+SCREENSHOT_MIN_BYTES = 5000
+SCREENSHOT_ASPECT_RANGE = (0.3, 3.0)
+
+
+def _looks_like_screenshot(image_data: bytes) -> bool:
+    """
+    Check the byte size and aspect ratio of an image.
+    
+    Image.open only parses the header, so this is cheap enough for the event
+    loop. It can't tell a camera photo from a screenshot; OCR decides that.
+    """
+    if len(image_data) < SCREENSHOT_MIN_BYTES:
+        return False
+    w, h = Image.open(BytesIO(image_data)).size
+    low, high = SCREENSHOT_ASPECT_RANGE
+    return bool(h) and low < w / h < high
+
+
 async def analyze_payment_screenshot(image_data: bytes, expected_amount: float, expected_phone: str = None) -> dict:
     """
     Analyze payment screenshot using OCR.
     Returns dict with 'valid', 'amount_found', 'phone_found', 'message'.
     """
-    if not OCR_AVAILABLE or not PIL_AVAILABLE:
+    if not PIL_AVAILABLE or not _ensure_tesseract():
         # If OCR not available, allow payment without check
         return {
             'valid': True,  # Allow without OCR check
@@ -462,64 +1123,28 @@ async def analyze_payment_screenshot(image_data: bytes, expected_amount: float,
         }
     
     try:
-        # Convert bytes to PIL Image
-        image = Image.open(BytesIO(image_data))
-        
-        # Use OCR to extract text
-        try:
-            extracted_text = pytesseract.image_to_string(image, lang='rus+eng')
-        except Exception as e:
-            logger.error(f"OCR error: {e}")
-            # Try with English only if Russian fails
-            try:
-                extracted_text = pytesseract.image_to_string(image, lang='eng')
-            except:
-                extracted_text = pytesseract.image_to_string(image)
+        # Skip OCR for images that can't be a payment screenshot
+        if not _looks_like_screenshot(image_data):
+            return {
+                'valid': False,
+                'amount_found': False,
+                'phone_found': False,
+                'message': '⚠️ Изображение не похоже на скриншот платежа. Отправьте скриншот перевода из приложения банка.'
+            }
         
+        # Decoding and Tesseract both block, the batcher runs them in a worker thread
+        extracted_text = await _ocr_batcher.extract_text(image_data)
         extracted_text = extracted_text.lower()
-        logger.info(f"Extracted text from screenshot (first 200 chars): {extracted_text[:200]}")
+        logger.info("Extracted text from screenshot (first 200 chars): %s", extracted_text[:200])
         
         # Check for payment-related keywords (Russian and English)
-        payment_keywords = [
-            'перевод', 'оплата', 'платеж', 'спб', 'сбп', 'payment', 'transfer',
-            'отправлено', 'успешно', 'success', 'получатель', 'получатель:',
-            'сумма', 'итого', 'amount', 'total', 'сумма перевода', 'переведено',
-            'квитанция', 'receipt', 'статус', 'status', 'комиссия', 'commission'
-        ]
-        
-        has_payment_keywords = any(keyword in extracted_text for keyword in payment_keywords)
-        
-        # Extract amount from text (look for numbers with ₽, руб, Р, or near payment keywords)
-        amount_patterns = [
-            # With currency symbols
-            r'(\d+[.,]\d+)\s*[₽рубР]',
-            r'(\d+)\s*[₽рубР]',
-            r'[₽рубР]\s*(\d+[.,]\d+)',
-            r'[₽рубР]\s*(\d+)',
-            # Near payment keywords
-            r'(?:сумма|итого|перевод|amount|total)[:\s]+(\d+[.,]?\d*)',
-            r'(\d+[.,]?\d*)\s*(?:сумма|итого|перевод|amount|total)',
-            # Standalone numbers near payment context (more flexible)
-            r'(?:сумма|итого|перевод|amount|total)[:\s]*\s*(\d+[.,]?\d*)\s*[₽рубР]?',
-            # Numbers that might be misrecognized (B instead of Р, 2 instead of Р)
-            r'(\d+)\s*[B2]',  # 500 B or 500 2 might be 500 Р
-            r'(\d+)\s*[₽рубРB2]',
-            # Just numbers in context of payment (last resort)
-            r'\b(\d{2,6})\b',  # 2-6 digit numbers (likely amounts)
-        ]
+        has_payment_keywords = _has_payment_keywords(extracted_text)
         
         amount_found = False
         found_amount = None
-        all_found_amounts = []
         
-        for pattern in amount_patterns:
-            matches = re.findall(pattern, extracted_text, re.IGNORECASE)
-            if matches:
-                try:
-                    amounts = [float(m.replace(',', '.')) for m in matches]
-                    all_found_amounts.extend(amounts)
-                except:
-                    continue
+        # Extract amount from text (look for numbers with ₽, руб, Р, or near payment keywords)
+        all_found_amounts = _extract_amounts(extracted_text)
         
         if all_found_amounts:
             # Remove duplicates and sort
@@ -554,20 +1179,13 @@ async def analyze_payment_screenshot(image_data: bytes, expected_amount: float,
         phone_found = False
         if expected_phone:
             # Normalize phone (remove +, spaces, dashes)
-            normalized_expected = re.sub(r'[+\s\-()]', '', expected_phone)
+            normalized_expected = _PHONE_NORMALIZE.sub('', expected_phone)
             
             # Look for phone patterns
-            phone_patterns = [
-                r'\+?7\d{10}',
-                r'\+?7\s?\d{3}\s?\d{3}\s?\d{2}\s?\d{2}',
-                r'\d{11}',
-                r'\+?\d{1}\s?\d{3}\s?\d{3}\s?\d{2}\s?\d{2}',
-            ]
-            
-            for pattern in phone_patterns:
-                matches = re.findall(pattern, extracted_text)
+            for pattern in _PHONE_PATTERNS:
+                matches = pattern.findall(extracted_text)
                 for match in matches:
-                    normalized_match = re.sub(r'[+\s\-()]', '', match)
+                    normalized_match = _PHONE_NORMALIZE.sub('', match)
                     if normalized_match == normalized_expected or normalized_match.endswith(normalized_expected[-10:]):
                         phone_found = True
                         break
@@ -611,7 +1229,7 @@ async def analyze_payment_screenshot(image_data: bytes, expected_amount: float,
         }
         
     except Exception as e:
-        logger.error(f"Error analyzing payment screenshot: {e}", exc_info=True)
+        logger.error("Error analyzing payment screenshot: %s", e, exc_info=True)
         return {
             'valid': True,  # Allow if analysis fails (fallback)
             'amount_found': False,
@@ -623,8 +1241,99 @@ async def analyze_payment_screenshot(image_data: bytes, expected_amount: float,
 # ==================== End Payment System Functions ====================
 
 
+# Shared HTTP session for image hosting uploads and other outbound requests;
+# keeps connections to the hosting services alive between uploads
+_http_session = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """Return the shared aiohttp session, creating it on first use."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32,
+                limit_per_host=8,
+                ttl_dns_cache=300,
+                keepalive_timeout=75
+            ),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _http_session
+
+
+async def close_http_session():
+    """Close the shared aiohttp session (called on shutdown)."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+
+# Delay before the next hosting service is tried while earlier uploads are
+# still running; a failed upload starts the next one immediately
+UPLOAD_HEDGE_DELAY = 0.5
+
+
+async def _upload_to_service(session: aiohttp.ClientSession, service: dict, image_data: bytes, filename: str) -> str:
+    """Upload image to a single hosting service, return public URL or None."""
+    try:
+        logger.info("Trying to upload to %s", service['url'])
+        if service['data_type'] == 'form':
+            data = aiohttp.FormData()
+            # Add extra params if needed
+            if 'extra_params' in service:
+                for key, value in service['extra_params'].items():
+                    data.add_field(key, value)
+            
+            # Add file (aiohttp sends bytes/bytearray as-is, without copying)
+            data.add_field(
+                service['field_name'],
+                image_data,
+                filename=filename,
+                content_type='image/jpeg'
+            )
+            
+            async with session.post(service['url'], data=data, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                status = resp.status
+                text = await resp.text()
+                logger.info("Response from %s: status=%s, text=%s", service['url'], status, text[:100])
+                
+                if status in [200, 201]:
+                    text = text.strip()
+                    # catbox.moe and 0x0.st respond with the direct URL
+                    if text.startswith('http'):
+                        return text
+                else:
+                    logger.warning("Upload to %s failed with status %s: %s", service['url'], status, text[:200])
+        else:  # raw
+            headers = {'Content-Type': 'image/jpeg', 'Max-Downloads': '1', 'Max-Days': '7'}
+            async with session.put(service['url'], data=image_data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
+                status = resp.status
+                text = await resp.text()
+                logger.info("Response from %s: status=%s, text=%s", service['url'], status, text[:100])
+                
+                if status in [200, 201]:
+                    text = text.strip()
+                    if text.startswith('http'):
+                        return text
+                else:
+                    logger.warning("Upload to %s failed with status %s: %s", service['url'], status, text[:200])
+    except asyncio.TimeoutError:
+        logger.warning("Timeout uploading to %s", service['url'])
+    except Exception as e:
+        logger.error("Exception uploading to %s: %s", service['url'], e, exc_info=True)
+    return None
+
+
 async def upload_image_to_hosting(image_data: bytes, filename: str = "image.jpg") -> str:
-    """Upload image to public hosting and return public URL."""
+    """
+    Upload image to public hosting and return public URL.
+    
+    Services are tried as a staggered hedge: the next one starts when the
+    earlier attempts fail or are still running after UPLOAD_HEDGE_DELAY, and
+    the first URL returned wins (the remaining uploads are cancelled).
+    """
     if not image_data or len(image_data) == 0:
         logger.error("Empty image data provided")
         return None
@@ -655,187 +1364,281 @@ async def upload_image_to_hosting(image_data: bytes, filename: str = "image.jpg"
         }
     ]
     
-    for service in hosting_services:
-        try:
-            logger.info(f"Trying to upload to {service['url']}")
-            async with aiohttp.ClientSession() as session:
-                if service['data_type'] == 'form':
-                    data = aiohttp.FormData()
-                    # Add extra params if needed
-                    if 'extra_params' in service:
-                        for key, value in service['extra_params'].items():
-                            data.add_field(key, value)
-                    
-                    # Add file
-                    data.add_field(
-                        service['field_name'],
-                        BytesIO(image_data),
-                        filename=filename,
-                        content_type='image/jpeg'
-                    )
-                    
-                    async with session.post(service['url'], data=data, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                        status = resp.status
-                        text = await resp.text()
-                        logger.info(f"Response from {service['url']}: status={status}, text={text[:100]}")
-                        
-                        if status in [200, 201]:
-                            text = text.strip()
-                            # For catbox.moe, response is direct URL
-                            if 'catbox.moe' in service['url']:
-                                if text.startswith('http'):
-                                    return text
-                            # For 0x0.st, response is direct URL
-                            elif text.startswith('http'):
-                                return text
-                        else:
-                            logger.warning(f"Upload to {service['url']} failed with status {status}: {text[:200]}")
-                else:  # raw
-                    headers = {'Content-Type': 'image/jpeg', 'Max-Downloads': '1', 'Max-Days': '7'}
-                    async with session.put(service['url'], data=image_data, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as resp:
-                        status = resp.status
-                        text = await resp.text()
-                        logger.info(f"Response from {service['url']}: status={status}, text={text[:100]}")
-                        
-                        if status in [200, 201]:
-                            text = text.strip()
-                            if text.startswith('http'):
-                                return text
-                        else:
-                            logger.warning(f"Upload to {service['url']} failed with status {status}: {text[:200]}")
-        except asyncio.TimeoutError:
-            logger.warning(f"Timeout uploading to {service['url']}")
-            continue
-        except Exception as e:
-            logger.error(f"Exception uploading to {service['url']}: {e}", exc_info=True)
-            continue
+    session = await get_http_session()
+    services = iter(hosting_services)
+    pending = set()
+    try:
+        while True:
+            service = next(services, None)
+            if service is not None:
+                pending.add(asyncio.create_task(_upload_to_service(session, service, image_data, filename)))
+            if not pending:
+                break
+            # Once every service has been started just wait for the rest
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=UPLOAD_HEDGE_DELAY if service is not None else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                public_url = task.result()
+                if public_url:
+                    return public_url
+    finally:
+        for task in pending:
+            task.cancel()
     
     # If all services fail, return None
-    logger.error("All image hosting services failed. Image size: {} bytes".format(len(image_data)))
+    logger.error("All image hosting services failed. Image size: %s bytes", len(image_data))
     return None
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send a marketing welcome message with model selection."""
-    user = update.effective_user
-    user_id = user.id
-    
-    # Check if admin is in user mode (viewing as regular user)
-    if user_id == ADMIN_ID:
-        if user_id in user_sessions and user_sessions[user_id].get('admin_user_mode', False):
-            is_admin = False  # Show as regular user
-        else:
-            is_admin = True
-    else:
-        is_admin = False
-    
-    # Get categories and models count
-    categories = get_categories()
-    total_models = len(KIE_MODELS)
-    
-    if is_admin:
-        # Admin menu - extended version
-        welcome_text = (
-            f'👑 <b>Панель администратора</b>\n\n'
-            f'Привет, {user.mention_html()}! 👋\n\n'
-            f'🚀 <b>Расширенное меню управления</b>\n\n'
-            f'📊 <b>Статистика:</b>\n'
-            f'✅ <b>{total_models} моделей</b> доступно\n'
-            f'✅ <b>{len(categories)} категорий</b>\n\n'
-            f'⚙️ <b>Административные функции доступны</b>'
-        )
-        
-        # Admin keyboard - extended
-        keyboard = []
-        
-        # All models button first
-        keyboard.append([
-            InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-        ])
-        
-        keyboard.append([])  # Empty row for spacing
-        
-        # Categories
-        for category in categories:
-            models_in_category = get_models_by_category(category)
-            emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-            keyboard.append([InlineKeyboardButton(
-                f"{emoji} {category} ({len(models_in_category)})",
-                callback_data=f"category:{category}"
-            )])
-        
-        # Admin functions row
-        keyboard.append([
-            InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-        ])
-        keyboard.append([
+# Welcome texts of the main menu; %s is the user's mention. Model counts
+# and prices never change at runtime, so they are baked in here. They stay
+# str: PTB only accepts str text and UTF-8 encodes the whole request body
+# (text, mention and markup) in one json.dumps, so pre-encoded bytes would
+# just have to be decoded again.
+_ADMIN_WELCOME_HEAD = (
+    f'👑 <b>Панель администратора</b>\n\n'
+    f'Привет, %s! 👋\n\n'
+    f'🚀 <b>Расширенное меню управления</b>\n\n'
+    f'📊 <b>Статистика:</b>\n'
+    f'✅ <b>{TOTAL_MODELS} моделей</b> доступно\n'
+    f'✅ <b>{len(CATEGORIES)} категорий</b>\n\n'
+)
+_ADMIN_WELCOME_TMPL = _ADMIN_WELCOME_HEAD + '⚙️ <b>Административные функции доступны</b>'
+_ADMIN_WELCOME_FULL_TMPL = (
+    _ADMIN_WELCOME_HEAD +
+    f'🎨 <b>Популярные модели:</b>\n\n'
+    f'🖼️ <b>Z-Image</b> - Фотореалистичные изображения\n'
+    f'   {get_model_price_text("z-image", None, True)}\n\n'
+    f'🍌 <b>Nano Banana Pro</b> - 2K/4K от Google DeepMind\n'
+    f'   {get_model_price_text("nano-banana-pro", None, True)}\n\n'
+    f'⚙️ <b>Административные функции доступны</b>'
+)
+_USER_WELCOME_HEAD = (
+    '🎉 <b>Добро пожаловать в AI Marketplace!</b>\n\n'
+    'Привет, %s! 👋\n\n'
+    '🚀 <b>Доступ к лучшим нейросетям без VPN!</b>\n\n'
+    '✨ <b>Почему выбирают нас:</b>\n'
+    '✅ <b>Без VPN</b> - работаем напрямую\n'
+    '✅ <b>Высокое качество</b> - 2K/4K генерация\n'
+    '✅ <b>Быстрая обработка</b> - результаты за минуты\n\n'
+)
+_USER_WELCOME_TAIL = (
+    '🔥 <b>Начните генерировать прямо сейчас!</b>\n\n'
+    'Выберите все модели или категорию:'
+)
+_USER_WELCOME_TMPL = _USER_WELCOME_HEAD + _USER_WELCOME_TAIL
+_USER_WELCOME_START_TMPL = (
+    _USER_WELCOME_HEAD +
+    f'🎨 <b>Популярные модели:</b>\n\n'
+    f'🖼️ <b>Z-Image</b> - Фотореалистичные изображения\n'
+    f'   {get_model_price_text("z-image", None, False)}\n'
+    f'   ⚡ Быстрая генерация Turbo\n\n'
+    f'🍌 <b>Nano Banana Pro</b> - 2K/4K от Google DeepMind\n'
+    f'   {get_model_price_text("nano-banana-pro", None, False)}\n'
+    f'   🎯 Улучшенное качество и текст\n\n' +
+    _USER_WELCOME_TAIL
+)
+
+# Shown whenever the balance doesn't cover the selected model
+_INSUFFICIENT_BALANCE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
+    [InlineKeyboardButton("◀️ Назад к моделям", callback_data="back_to_menu")]
+])
+
+# Static keyboards shared by several messages
+_BACK_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_menu")]
+])
+_RETURN_TO_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("◀️ Вернуться в меню", callback_data="back_to_menu")]
+])
+_CANCEL_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+_TOPUP_OR_BACK_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_TOPUP_OR_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
+    [InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_menu")]
+])
+_TOPUP_AMOUNTS_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("100 ₽", callback_data="topup_amount:100"),
+        InlineKeyboardButton("500 ₽", callback_data="topup_amount:500")
+    ],
+    [
+        InlineKeyboardButton("1000 ₽", callback_data="topup_amount:1000"),
+        InlineKeyboardButton("2000 ₽", callback_data="topup_amount:2000")
+    ],
+    [
+        InlineKeyboardButton("5000 ₽", callback_data="topup_amount:5000"),
+        InlineKeyboardButton("Другая сумма", callback_data="topup_custom")
+    ],
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_ADMIN_STATS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_OCR_TEST_AGAIN_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Тест еще раз", callback_data="admin_test_ocr")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_OCR_RETRY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Попробовать еще раз", callback_data="admin_test_ocr")],
+    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
+])
+_MORE_IMAGES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📷 Добавить еще", callback_data="add_image")],
+    [InlineKeyboardButton("✅ Готово", callback_data="image_done")]
+])
+_UPLOAD_IMAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📷 Загрузить изображение", callback_data="add_image")]
+])
+_ADD_OR_SKIP_IMAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📷 Добавить изображение", callback_data="add_image")],
+    [InlineKeyboardButton("⏭️ Пропустить", callback_data="skip_image")]
+])
+
+# Main menu variants: welcome text template and keyboard.
+# Everything in them is static, so each variant is built once on first use.
+Menu = namedtuple('Menu', 'text markup')
+_MENU_CACHE = {}
+
+
+def _category_rows() -> list:
+    return [
+        [InlineKeyboardButton(f"{emoji} {category} ({count})", callback_data=f"category:{category}")]
+        for category, (emoji, count) in CATEGORY_META.items()
+    ]
+
+
+def _admin_function_rows() -> list:
+    return [
+        [
             InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
             InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")
-        ])
-        keyboard.append([
+        ],
+        [
             InlineKeyboardButton("🔍 Поиск", callback_data="admin_search"),
             InlineKeyboardButton("📝 Добавить", callback_data="admin_add")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("🧪 Тест OCR", callback_data="admin_test_ocr")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("👤 Режим пользователя", callback_data="admin_user_mode")
-        ])
-        keyboard.append([InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")])
-    else:
-        # Regular user menu - simple version
-        welcome_text = (
-            f'🎉 <b>Добро пожаловать в AI Marketplace!</b>\n\n'
-            f'Привет, {user.mention_html()}! 👋\n\n'
-            f'🚀 <b>Доступ к лучшим нейросетям без VPN!</b>\n\n'
-            f'✨ <b>Почему выбирают нас:</b>\n'
-            f'✅ <b>Без VPN</b> - работаем напрямую\n'
-            f'✅ <b>Высокое качество</b> - 2K/4K генерация\n'
-            f'✅ <b>Быстрая обработка</b> - результаты за минуты\n\n'
-            f'🎨 <b>Популярные модели:</b>\n\n'
-            f'🖼️ <b>Z-Image</b> - Фотореалистичные изображения\n'
-            f'   {get_model_price_text("z-image", None, is_admin)}\n'
-            f'   ⚡ Быстрая генерация Turbo\n\n'
-            f'🍌 <b>Nano Banana Pro</b> - 2K/4K от Google DeepMind\n'
-            f'   {get_model_price_text("nano-banana-pro", None, is_admin)}\n'
-            f'   🎯 Улучшенное качество и текст\n\n'
-            f'🔥 <b>Начните генерировать прямо сейчас!</b>\n\n'
-            f'Выберите все модели или категорию:'
-        )
-        
-        # Regular user keyboard - simple
-        keyboard = []
-        
-        # All models button first
-        keyboard.append([
-            InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-        ])
-        
-        keyboard.append([])  # Empty row for spacing
-        
-        # Categories
-        for category in categories:
-            models_in_category = get_models_by_category(category)
-            emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-            keyboard.append([InlineKeyboardButton(
-                f"{emoji} {category} ({len(models_in_category)})",
-                callback_data=f"category:{category}"
-            )])
-        
-        # Bottom row
-        keyboard.append([
-            InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")
-        ])
-        keyboard.append([InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")])
-    
-    await update.message.reply_html(
-        welcome_text,
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        ],
+        [InlineKeyboardButton("🧪 Тест OCR", callback_data="admin_test_ocr")],
+        [InlineKeyboardButton("👤 Режим пользователя", callback_data="admin_user_mode")],
+        [InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")]
+    ]
+
+
+def _build_menu(variant: str) -> Menu:
+    """
+    Build a main menu variant:
+    'admin' - admin panel (/start, back to admin),
+    'admin_full' - admin panel with popular model prices,
+    'user_start' - user welcome with popular model prices (/start),
+    'user' - user menu, 'admin_as_user' - user menu for an admin in user mode.
+    """
+    # All models button first, then an empty row for spacing and categories
+    head = [[InlineKeyboardButton("📋 Все модели", callback_data="all_models")], [], *_category_rows()]
+    balance = InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
+    
+    if variant == 'admin_full':
+        # Admin menu - extended version
+        return Menu(_ADMIN_WELCOME_FULL_TMPL, InlineKeyboardMarkup([
+            *head,
+            [InlineKeyboardButton("📋 Все модели", callback_data="all_models"), balance],
+            *_admin_function_rows()
+        ]))
+    if variant == 'admin':
+        return Menu(_ADMIN_WELCOME_TMPL, InlineKeyboardMarkup([*head, [balance], *_admin_function_rows()]))
+    
+    # Regular user menu - simple version
+    topup = [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")]
+    if variant == 'user_start':
+        return Menu(_USER_WELCOME_START_TMPL, InlineKeyboardMarkup([
+            *head, [balance], topup,
+            [InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")]
+        ]))
+    back_to_admin = (
+        [[InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="admin_back_to_admin")]]
+        if variant == 'admin_as_user' else []
     )
+    return Menu(_USER_WELCOME_TMPL, InlineKeyboardMarkup([
+        *head, [balance], topup, *back_to_admin,
+        [
+            InlineKeyboardButton("🆘 Помощь", callback_data="help_menu"),
+            InlineKeyboardButton("💬 Поддержка", callback_data="support_contact")
+        ]
+    ]))
+
+
+def _get_menu(variant: str) -> Menu:
+    """Return a cached main menu variant (see _build_menu)."""
+    menu = _MENU_CACHE.get(variant)
+    if menu is None:
+        menu = _MENU_CACHE[variant] = _build_menu(variant)
+    return menu
+
+
+def _render_menu(variant: str, user) -> Menu:
+    """Return a main menu variant with its text filled in for the user."""
+    menu = _get_menu(variant)
+    return Menu(menu.text % user.mention_html(), menu.markup)
+
+
+def _main_menu(user, on_start: bool = False) -> Menu:
+    """
+    Render the main menu the user should see: the admin panel for the admin,
+    the user menu for everyone else (with a way back for the admin in user mode).
+    on_start selects the /start variants.
+    """
+    user_id = user.id
+    session = user_sessions.get(user_id)
+    if user_id != ADMIN_ID:
+        variant = 'user_start' if on_start else 'user'
+    elif session is not None and session.admin_user_mode:
+        variant = 'user_start' if on_start else 'admin_as_user'
+    else:
+        variant = 'admin' if on_start else 'admin_full'
+    return _render_menu(variant, user)
+
+
+async def _show_menu(query, menu: Menu):
+    """
+    Show a rendered menu in place of the message the callback came from.
+    
+    Falls back to sending a new message when the original can't be edited
+    (e.g. it is a photo or video with a caption).
+    """
+    try:
+        await query.edit_message_text(menu.text, reply_markup=menu.markup, parse_mode='HTML')
+    except BadRequest as e:
+        if 'not modified' in str(e).lower():
+            return
+        await query.message.reply_text(menu.text, reply_markup=menu.markup, parse_mode='HTML')
+
+
+def invalidate_menu_cache():
+    """Forget the built menus, e.g. after prices or the model list change."""
+    _MENU_CACHE.clear()
+    _model_price_text.cache_clear()
+    min_price_rub.cache_clear()
+    _admin_model_list.cache_clear()
+    _user_model_list.cache_clear()
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a marketing welcome message with model selection."""
+    # Admin in user mode sees the regular user welcome
+    menu = _main_menu(update.effective_user, on_start=True)
+    await update.message.reply_html(menu.text, reply_markup=menu.markup)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -861,37 +1664,30 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+# /models keyboard: the categories, all models and cancel
+_MODELS_COMMAND_MARKUP = InlineKeyboardMarkup([
+    *_category_rows(),
+    [InlineKeyboardButton("📋 Все модели", callback_data="all_models")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+_SHOW_MODELS_MARKUP = InlineKeyboardMarkup([[
+    InlineKeyboardButton("📋 Показать модели", callback_data="show_models")
+]])
+
+
 async def list_models(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List available models from static menu."""
     user_id = update.effective_user.id
     
-    # Get models grouped by category
-    categories = get_categories()
-    
-    # Create category selection keyboard
-    keyboard = []
-    for category in categories:
-        models_in_category = get_models_by_category(category)
-        emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-        keyboard.append([InlineKeyboardButton(
-            f"{emoji} {category} ({len(models_in_category)})",
-            callback_data=f"category:{category}"
-        )])
-    
-    keyboard.append([InlineKeyboardButton("📋 Все модели", callback_data="all_models")])
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    models_text = "📋 <b>Доступные модели:</b>\n\n"
-    models_text += "Выберите категорию или просмотрите все модели:\n\n"
-    for category in categories:
-        models_in_category = get_models_by_category(category)
-        models_text += f"<b>{category}</b>: {len(models_in_category)} моделей\n"
+    models_text = "".join([
+        "📋 <b>Доступные модели:</b>\n\n",
+        "Выберите категорию или просмотрите все модели:\n\n",
+        *(f"<b>{category}</b>: {count} моделей\n" for category, (_, count) in CATEGORY_META.items())
+    ])
     
     await update.message.reply_text(
         models_text,
-        reply_markup=reply_markup,
+        reply_markup=_MODELS_COMMAND_MARKUP,
         parse_mode='HTML'
     )
 
@@ -910,1260 +1706,972 @@ async def start_generation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         '🚀 Начинаем генерацию!\n\n'
         'Сначала выберите модель из списка:',
-        reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("📋 Показать модели", callback_data="show_models")
-        ]])
+        reply_markup=_SHOW_MODELS_MARKUP
     )
     
     return SELECTING_MODEL
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks."""
-    query = update.callback_query
-    await query.answer()
-    
-    user_id = update.effective_user.id
-    data = query.data
-    
-    # Handle admin user mode toggle (MUST be first, before any other checks)
-    if data == "admin_user_mode":
-        # Toggle user mode for admin
-        if user_id != ADMIN_ID:
+def admin_only(handler):
+    """Answer and stop callbacks from anyone but the admin before running handler."""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+        if user.id != ADMIN_ID:
             await query.answer("Эта функция доступна только администратору.")
             return ConversationHandler.END
+        return await handler(update, context, query, user, arg)
+    return wrapper
+
+
+@admin_only
+async def _cb_admin_user_mode(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Toggle user mode for the admin (viewing the bot as a regular user)."""
+    # Toggle user mode for admin
+    session = user_sessions[user.id]
+    session.admin_user_mode = not session.admin_user_mode
+    
+    if session.admin_user_mode:
+        # Switching to user mode - replace the menu in place
+        menu = _render_menu('admin_as_user', user)
         
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {}
-        
-        current_mode = user_sessions[user_id].get('admin_user_mode', False)
-        user_sessions[user_id]['admin_user_mode'] = not current_mode
+        # The callback answer and the menu edit are independent requests
+        await asyncio.gather(query.answer("Режим пользователя включен"), _show_menu(query, menu))
+        return ConversationHandler.END
+    else:
+        # Switching back to admin mode - replace the menu in place
+        menu = _render_menu('admin_full', user)
         
-        if not current_mode:
-            # Switching to user mode - send new message directly
-            await query.answer("Режим пользователя включен")
-            user = update.effective_user
-            categories = get_categories()
-            total_models = len(KIE_MODELS)
-            
-            welcome_text = (
-                f'🎉 <b>Добро пожаловать в AI Marketplace!</b>\n\n'
-                f'Привет, {user.mention_html()}! 👋\n\n'
-                f'🚀 <b>Доступ к лучшим нейросетям без VPN!</b>\n\n'
-                f'✨ <b>Почему выбирают нас:</b>\n'
-                f'✅ <b>Без VPN</b> - работаем напрямую\n'
-                f'✅ <b>Высокое качество</b> - 2K/4K генерация\n'
-                f'✅ <b>Быстрая обработка</b> - результаты за минуты\n\n'
-                f'🔥 <b>Начните генерировать прямо сейчас!</b>\n\n'
-                f'Выберите все модели или категорию:'
-            )
-            
-            keyboard = []
-            # All models button first
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-            ])
-            
-            keyboard.append([])
-            for category in categories:
-                models_in_category = get_models_by_category(category)
-                emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-                keyboard.append([InlineKeyboardButton(
-                    f"{emoji} {category} ({len(models_in_category)})",
-                    callback_data=f"category:{category}"
-                )])
-            
-            keyboard.append([
-                InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="admin_back_to_admin")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🆘 Помощь", callback_data="help_menu"),
-                InlineKeyboardButton("💬 Поддержка", callback_data="support_contact")
-            ])
-            
-            await query.message.reply_text(
-                welcome_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
+        await asyncio.gather(query.answer("Возврат в админ-панель"), _show_menu(query, menu))
+        return ConversationHandler.END
+
+
+@admin_only
+async def _cb_admin_back_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Return the admin from user mode to the admin panel."""
+    # Return to admin mode - replace the menu in place
+    session = user_sessions.get(user.id)
+    if session is not None:
+        session.admin_user_mode = False
+    menu = _render_menu('admin', user)
+    
+    await asyncio.gather(query.answer("Возврат в админ-панель"), _show_menu(query, menu))
+    return ConversationHandler.END
+
+
+async def _cb_back_to_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the main menu again."""
+    # Return to start menu - replace the menu in place
+    await _show_menu(query, _main_menu(user))
+    return ConversationHandler.END
+
+
+async def _cb_generate_again(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Restore the last generation's model and ask for a new prompt."""
+    user_id = user.id
+    
+    # Generate again - restore model and show model info, then ask for new prompt
+    await query.answer()  # Acknowledge the callback
+    
+    logger.info("Generate again requested by user %s", user_id)
+    
+    saved_data = saved_generations.get(user_id)
+    # The model may have been removed from KIE_MODELS since it was saved
+    model_info = get_model_by_id(saved_data['model_id']) if saved_data else None
+    if model_info is None:
+        logger.warning("No saved generation data for user %s", user_id)
+        await query.edit_message_text(
+            "❌ <b>Данные для повторной генерации не найдены</b>\n\n"
+            "Начните новую генерацию через меню.",
+            parse_mode='HTML'
+        )
+        return ConversationHandler.END
+    
+    model_id = saved_data['model_id']
+    logger.info("Restoring generation data for user %s, model: %s", user_id, model_id)
+    
+    # Restore model info but clear params - user will enter new prompt
+    session = user_sessions[user_id]
+    session.model_id = model_id
+    session.model_info = model_info
+    session.properties = model_info['input_params']
+    session.required = model_info['_required_params']
+    session.params = {}  # Clear params - start fresh
+    
+    # Get user balance and calculate available generations (same as select_model)
+    user_balance, is_admin, _ = get_user_context(user_id)
+    
+    # Calculate price for default parameters (minimum price)
+    min_price = min_price_rub(model_id, is_admin)
+    price_text = format_price_rub(min_price, is_admin)
+    
+    # Calculate how many generations available
+    if is_admin:
+        available_count = "Безлимит"
+    elif user_balance >= min_price:
+        available_count = available_generations(user_balance, min_price)
+    else:
+        available_count = 0
+    
+    # Show model info with price and available generations (same format as select_model)
+    model_name = model_info.get('name', model_id)
+    model_emoji = model_info.get('emoji', '🤖')
+    model_desc = model_info.get('description', '')
+    
+    model_info_text = (
+        f"{model_emoji} <b>{model_name}</b>\n\n"
+        f"{model_desc}\n\n"
+        f"💰 <b>Цена генерации:</b> {price_text} ₽\n"
+    )
+    
+    if is_admin:
+        model_info_text += f"✅ <b>Доступно:</b> Безлимит\n\n"
+    else:
+        if available_count > 0:
+            model_info_text += f"✅ <b>Доступно генераций:</b> {available_count}\n"
+            model_info_text += f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n\n"
         else:
-            # Switching back to admin mode - send new message directly
-            user_sessions[user_id]['admin_user_mode'] = False
-            await query.answer("Возврат в админ-панель")
-            user = update.effective_user
-            categories = get_categories()
-            total_models = len(KIE_MODELS)
-            
-            welcome_text = (
-                f'👑 <b>Панель администратора</b>\n\n'
-                f'Привет, {user.mention_html()}! 👋\n\n'
-                f'🚀 <b>Расширенное меню управления</b>\n\n'
-                f'📊 <b>Статистика:</b>\n'
-                f'✅ <b>{total_models} моделей</b> доступно\n'
-                f'✅ <b>{len(categories)} категорий</b>\n\n'
-                f'🎨 <b>Популярные модели:</b>\n\n'
-                f'🖼️ <b>Z-Image</b> - Фотореалистичные изображения\n'
-                f'   {get_model_price_text("z-image", None, True)}\n\n'
-                f'🍌 <b>Nano Banana Pro</b> - 2K/4K от Google DeepMind\n'
-                f'   {get_model_price_text("nano-banana-pro", None, True)}\n\n'
-                f'⚙️ <b>Административные функции доступны</b>'
+            # Not enough balance - show warning
+            model_info_text += (
+                f"❌ <b>Недостаточно средств</b>\n"
+                f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
+                f"💵 <b>Требуется:</b> {price_text} ₽\n\n"
+                f"Пополните баланс для генерации."
             )
             
-            keyboard = []
-            # All models button first
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-            ])
-            
-            keyboard.append([])
-            for category in categories:
-                models_in_category = get_models_by_category(category)
-                emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-                keyboard.append([InlineKeyboardButton(
-                    f"{emoji} {category} ({len(models_in_category)})",
-                    callback_data=f"category:{category}"
-                )])
-            
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models"),
-                InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-                InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🔍 Поиск", callback_data="admin_search"),
-                InlineKeyboardButton("📝 Добавить", callback_data="admin_add")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🧪 Тест OCR", callback_data="admin_test_ocr")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("👤 Режим пользователя", callback_data="admin_user_mode")
-            ])
-            keyboard.append([InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")])
-            
-            await query.message.reply_text(
-                welcome_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
+            await query.edit_message_text(
+                model_info_text,
+                reply_markup=_INSUFFICIENT_BALANCE_MARKUP,
                 parse_mode='HTML'
             )
             return ConversationHandler.END
     
-    if data == "admin_back_to_admin":
-        # Return to admin mode - send new message directly
-        if user_id != ADMIN_ID:
-            await query.answer("Эта функция доступна только администратору.")
-            return ConversationHandler.END
-        
-        if user_id in user_sessions:
-            user_sessions[user_id]['admin_user_mode'] = False
-        await query.answer("Возврат в админ-панель")
-        user = update.effective_user
-        categories = get_categories()
-        total_models = len(KIE_MODELS)
-        
-        welcome_text = (
-            f'👑 <b>Панель администратора</b>\n\n'
-            f'Привет, {user.mention_html()}! 👋\n\n'
-            f'🚀 <b>Расширенное меню управления</b>\n\n'
-            f'📊 <b>Статистика:</b>\n'
-            f'✅ <b>{total_models} моделей</b> доступно\n'
-            f'✅ <b>{len(categories)} категорий</b>\n\n'
-            f'⚙️ <b>Административные функции доступны</b>'
-        )
-        
-        keyboard = []
-        
-        # All models button first
-        keyboard.append([
-            InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-        ])
-        
-        keyboard.append([])
-        for category in categories:
-            models_in_category = get_models_by_category(category)
-            emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-            keyboard.append([InlineKeyboardButton(
-                f"{emoji} {category} ({len(models_in_category)})",
-                callback_data=f"category:{category}"
-            )])
-        
-        keyboard.append([
-            InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-            InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("🔍 Поиск", callback_data="admin_search"),
-            InlineKeyboardButton("📝 Добавить", callback_data="admin_add")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("🧪 Тест OCR", callback_data="admin_test_ocr")
-        ])
-        keyboard.append([
-            InlineKeyboardButton("👤 Режим пользователя", callback_data="admin_user_mode")
-        ])
-        keyboard.append([InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")])
-        
-        await query.message.reply_text(
-            welcome_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+    # Check balance before starting generation
+    if not is_admin and user_balance < min_price:
+        await query.edit_message_text(
+            f"❌ <b>Недостаточно средств для генерации</b>\n\n"
+            f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
+            f"💵 <b>Требуется минимум:</b> {price_text} ₽\n\n"
+            f"Пополните баланс, чтобы начать генерацию.",
+            reply_markup=_INSUFFICIENT_BALANCE_MARKUP,
             parse_mode='HTML'
         )
         return ConversationHandler.END
     
-    if data == "back_to_menu":
-        # Return to start menu - send new message directly
-        user = update.effective_user
-        user_id = user.id
-        
-        # Check if admin is in user mode
-        if user_id == ADMIN_ID:
-            if user_id in user_sessions and user_sessions[user_id].get('admin_user_mode', False):
-                is_admin = False
-            else:
-                is_admin = True
-        else:
-            is_admin = False
+    # Get input parameters from model info
+    input_params = model_info.get('input_params', {})
+    
+    if not input_params:
+        # If no params defined, ask for simple text input
+        await query.edit_message_text(
+            f"{model_info_text}"
+            f"Введите текст для генерации:",
+            parse_mode='HTML'
+        )
+        user_sessions[user_id].params = {}
+        user_sessions[user_id].waiting_for = 'text'
+        return INPUTTING_PARAMS
+    
+    # Store session data
+    user_sessions[user_id].params = {}
+    user_sessions[user_id].properties = input_params
+    user_sessions[user_id].required = model_info.get('_required_params', ())
+    user_sessions[user_id].current_param = None
+    
+    # Start with prompt parameter first
+    if 'prompt' in input_params:
+        # Check if model supports image input (image_input or image_urls)
+        has_image_input = 'image_input' in input_params or 'image_urls' in input_params
         
-        categories = get_categories()
-        total_models = len(KIE_MODELS)
+        prompt_text = (
+            f"{model_info_text}"
+        )
         
-        if is_admin:
-            welcome_text = (
-                f'👑 <b>Панель администратора</b>\n\n'
-                f'Привет, {user.mention_html()}! 👋\n\n'
-                f'🚀 <b>Расширенное меню управления</b>\n\n'
-                f'📊 <b>Статистика:</b>\n'
-                f'✅ <b>{total_models} моделей</b> доступно\n'
-                f'✅ <b>{len(categories)} категорий</b>\n\n'
-                f'🎨 <b>Популярные модели:</b>\n\n'
-                f'🖼️ <b>Z-Image</b> - Фотореалистичные изображения\n'
-                f'   {get_model_price_text("z-image", None, True)}\n\n'
-                f'🍌 <b>Nano Banana Pro</b> - 2K/4K от Google DeepMind\n'
-                f'   {get_model_price_text("nano-banana-pro", None, True)}\n\n'
-                f'⚙️ <b>Административные функции доступны</b>'
+        if has_image_input:
+            prompt_text += (
+                f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
+                f"Опишите изображение, которое хотите сгенерировать.\n\n"
+                f"💡 <i>После ввода промпта вы сможете добавить изображение (опционально)</i>"
             )
-            
-            keyboard = []
-            # All models button first
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-            ])
-            
-            keyboard.append([])
-            for category in categories:
-                models_in_category = get_models_by_category(category)
-                emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-                keyboard.append([InlineKeyboardButton(
-                    f"{emoji} {category} ({len(models_in_category)})",
-                    callback_data=f"category:{category}"
-                )])
-            
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models"),
-                InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("📊 Статистика", callback_data="admin_stats"),
-                InlineKeyboardButton("⚙️ Настройки", callback_data="admin_settings")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🔍 Поиск", callback_data="admin_search"),
-                InlineKeyboardButton("📝 Добавить", callback_data="admin_add")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("🧪 Тест OCR", callback_data="admin_test_ocr")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("👤 Режим пользователя", callback_data="admin_user_mode")
-            ])
-            keyboard.append([InlineKeyboardButton("🆘 Помощь", callback_data="help_menu")])
         else:
-            welcome_text = (
-                f'🎉 <b>Добро пожаловать в AI Marketplace!</b>\n\n'
-                f'Привет, {user.mention_html()}! 👋\n\n'
-                f'🚀 <b>Доступ к лучшим нейросетям без VPN!</b>\n\n'
-                f'✨ <b>Почему выбирают нас:</b>\n'
-                f'✅ <b>Без VPN</b> - работаем напрямую\n'
-                f'✅ <b>Высокое качество</b> - 2K/4K генерация\n'
-                f'✅ <b>Быстрая обработка</b> - результаты за минуты\n\n'
-                f'🔥 <b>Начните генерировать прямо сейчас!</b>\n\n'
-                f'Выберите все модели или категорию:'
+            prompt_text += (
+                f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
+                f"Опишите изображение, которое хотите сгенерировать:"
             )
-            
-            keyboard = []
-            
-            # All models button first
-            keyboard.append([
-                InlineKeyboardButton("📋 Все модели", callback_data="all_models")
-            ])
-            
-            keyboard.append([])
-            for category in categories:
-                models_in_category = get_models_by_category(category)
-                emoji = models_in_category[0]["emoji"] if models_in_category else "📦"
-                keyboard.append([InlineKeyboardButton(
-                    f"{emoji} {category} ({len(models_in_category)})",
-                    callback_data=f"category:{category}"
-                )])
-            
-            keyboard.append([
-                InlineKeyboardButton("💰 Баланс", callback_data="check_balance")
-            ])
-            keyboard.append([
-                InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")
-            ])
-            # Add admin back button if admin is in user mode
-            if user_id == ADMIN_ID and user_id in user_sessions and user_sessions[user_id].get('admin_user_mode', False):
-                keyboard.append([
-                    InlineKeyboardButton("🔙 Вернуться в админ-панель", callback_data="admin_back_to_admin")
-                ])
-            keyboard.append([
-                InlineKeyboardButton("🆘 Помощь", callback_data="help_menu"),
-                InlineKeyboardButton("💬 Поддержка", callback_data="support_contact")
-            ])
         
-        await query.message.reply_text(
-            welcome_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+        await query.edit_message_text(
+            prompt_text,
             parse_mode='HTML'
         )
+        user_sessions[user_id].current_param = 'prompt'
+        user_sessions[user_id].waiting_for = 'prompt'
+        user_sessions[user_id].has_image_input = has_image_input
+    else:
+        # If no prompt, start with first required parameter
+        await start_next_parameter(update, context, user_id)
+    
+    return INPUTTING_PARAMS
+
+
+async def _cb_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Cancel the current operation."""
+    user_id = user.id
+    
+    user_sessions.pop(user_id, None)
+    await query.edit_message_text("❌ Операция отменена.")
+    return ConversationHandler.END
+
+
+def _build_model_list(category: Optional[str], is_admin: bool, counts: Optional[tuple]):
+    """
+    Text and keyboard of a model list: a category, or all models
+    when category is None. counts holds the number of generations the user
+    can afford per model (None for admins, who are unlimited).
+    """
+    models = get_models_by_category(category)
+    if category:
+        parts = [f"📋 <b>Модели категории {category}:</b>\n\n"]
+    else:
+        parts = ["📋 <b>Все доступные модели:</b>\n\n"]
+    
+    keyboard = []
+    for index, model in enumerate(models):
+        if counts is None:
+            button_text = f"{model['emoji']} {model['name']} (Безлимит)"
+            available_text = "Безлимит"
+        else:
+            button_text = f"{model['emoji']} {model['name']} ({counts[index]} шт)"
+            available_text = f"{counts[index]} генераций"
+        
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"select_model:{model['id']}")])
+        parts.append(
+            f"{model['emoji']} <b>{model['name']}</b>\n"
+            f"{model['description']}\n"
+            f"💰 Цена: {format_price_rub(min_price_rub(model['id'], is_admin), is_admin)} ₽ | "
+            f"✅ Доступно: {available_text}\n\n"
+        )
+    keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")])
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
+    return "".join(parts), InlineKeyboardMarkup(keyboard)
+
+
+@lru_cache(maxsize=None)
+def _admin_model_list(category: Optional[str]):
+    """Model list for admins; it doesn't depend on a balance, so it is built once."""
+    return _build_model_list(category, True, None)
+
+
+@lru_cache(maxsize=512)
+def _user_model_list(category: Optional[str], counts: tuple):
+    """
+    Model list for regular users. Besides the category it only depends on the
+    per-model generation counts, so users with similar balances share entries.
+    """
+    return _build_model_list(category, False, counts)
+
+
+def _render_model_list(category: Optional[str], user_id: int):
+    """
+    Build the text and keyboard of a model list (category or all models):
+    one button per model and a description with its price and how many
+    generations the user's balance covers.
+    """
+    user_balance, is_admin, _ = get_user_context(user_id)
+    if is_admin:
+        return _admin_model_list(category)
+    
+    counts = tuple(
+        available_generations(user_balance, price) if user_balance >= price else 0
+        for price in (min_price_rub(model['id'], False) for model in get_models_by_category(category))
+    )
+    return _user_model_list(category, counts)
+
+
+async def _cb_category(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the models of a category (arg is the category name)."""
+    user_id = user.id
+    
+    # Handle category selection (can be called from main menu)
+    category = arg
+    models = get_models_by_category(category)
+    
+    if not models:
+        await query.edit_message_text(f"❌ В категории {category} нет моделей.")
         return ConversationHandler.END
     
-    if data == "generate_again":
-        # Generate again - restore model and show model info, then ask for new prompt
-        await query.answer()  # Acknowledge the callback
-        
-        logger.info(f"Generate again requested by user {user_id}")
-        
-        if user_id not in saved_generations:
-            logger.warning(f"No saved generation data for user {user_id}")
-            await query.edit_message_text(
-                "❌ <b>Данные для повторной генерации не найдены</b>\n\n"
-                "Начните новую генерацию через меню.",
-                parse_mode='HTML'
-            )
+    models_text, markup = _render_model_list(category, user_id)
+    await query.edit_message_text(models_text, reply_markup=markup, parse_mode='HTML')
+    return SELECTING_MODEL
+
+
+# Generate / cancel buttons under the generation confirmation
+_CONFIRM_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Генерировать", callback_data="confirm_generate")],
+    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
+])
+
+
+def _param_preview(value) -> str:
+    """Short form of a param value for the confirmation: long values cut at 50 chars."""
+    if isinstance(value, (list, tuple)) and len(value) > 3:
+        # Image lists: don't build the string of every URL just to cut it
+        return f"{len(value)} шт."
+    value = str(value)
+    return f"{value[:50]}..." if len(value) > 50 else value
+
+
+def _confirmation_text(session: UserSession) -> str:
+    """Text asking to confirm a generation with the collected params."""
+    lines = [f"  • {name}: {_param_preview(value)}" for name, value in session.params.items()]
+    params_text = "\n".join(lines)
+    return (
+        f"📋 <b>Подтверждение:</b>\n\n"
+        f"Модель: <b>{session.model_info.get('name', 'Unknown')}</b>\n"
+        f"Параметры:\n{params_text}\n\n"
+        f"Продолжить генерацию?"
+    )
+
+
+async def _show_confirmation(query, session: UserSession):
+    """Replace the callback's message with the generation confirmation."""
+    await query.edit_message_text(_confirmation_text(session), reply_markup=_CONFIRM_MARKUP, parse_mode='HTML')
+    return CONFIRMING_GENERATION
+
+
+async def _cb_show_models(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the list of all models."""
+    user_id = user.id
+    
+    # Show all models
+    models_text, markup = _render_model_list(None, user_id)
+    await query.edit_message_text(models_text, reply_markup=markup, parse_mode='HTML')
+    return SELECTING_MODEL
+
+
+_ADD_IMAGE_TEXT = (
+    "📷 <b>Загрузите изображение</b>\n\n"
+    "Отправьте фото, которое хотите использовать как референс или для трансформации.\n"
+    "Можно загрузить до 8 изображений."
+)
+
+
+async def _cb_add_image(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Ask for reference images for the selected model."""
+    user_id = user.id
+    
+    await query.edit_message_text(_ADD_IMAGE_TEXT, parse_mode='HTML')
+    session = user_sessions[user_id]
+    # Determine which parameter name to use (image_input or image_urls)
+    model_info = session.model_info
+    input_params = model_info.get('input_params', {})
+    if 'image_urls' in input_params:
+        image_param_name = 'image_urls'
+    else:
+        image_param_name = 'image_input'
+    session.waiting_for = image_param_name
+    session.images = []  # Initialize as array
+    return INPUTTING_PARAMS
+
+
+async def _cb_image_done(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Store the uploaded images and go on to the next parameter."""
+    user_id = user.id
+    
+    session = user_sessions[user_id]
+    image_param_name = session.waiting_for or 'image_input'
+    if session.images:
+        session.params[image_param_name] = session.images
+        await query.edit_message_text(
+            f"✅ Добавлено изображений: {len(session.images)}\n\n"
+            f"Продолжаю..."
+        )
+    session.waiting_for = None
+    
+    # Move to next parameter
+    try:
+        next_param_result = await start_next_parameter(update, context, user_id)
+        if next_param_result:
+            return next_param_result
+        else:
+            # All parameters collected
+            return await _show_confirmation(query, session)
+    except Exception as e:
+        logger.error("Error after image done: %s", e)
+        await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
+        return INPUTTING_PARAMS
+
+
+async def _cb_skip_image(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Go on to the next parameter without an image."""
+    user_id = user.id
+    
+    await query.answer("Изображение пропущено")
+    # Move to next parameter
+    try:
+        next_param_result = await start_next_parameter(update, context, user_id)
+        if next_param_result:
+            return next_param_result
+        else:
+            # All parameters collected
+            session = user_sessions[user_id]
+            return await _show_confirmation(query, session)
+    except Exception as e:
+        logger.error("Error after skipping image: %s", e)
+        await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
+        return INPUTTING_PARAMS
+
+
+async def _cb_set_param(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Set a parameter chosen with a button (arg is "name:value")."""
+    user_id = user.id
+    
+    # Handle parameter setting via button
+    param_name, separator, param_value = arg.partition(":")
+    if separator:
+        session = user_sessions.get(user_id)
+        if session is None:
+            await query.edit_message_text("❌ Сессия не найдена.")
             return ConversationHandler.END
         
-        saved_data = saved_generations[user_id]
-        logger.info(f"Restoring generation data for user {user_id}, model: {saved_data.get('model_id')}")
-        
-        # Restore session with model info, but clear params to start fresh
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {}
-        
-        model_id = saved_data['model_id']
-        model_info = saved_data['model_info']
-        
-        # Restore model info but clear params - user will enter new prompt
-        user_sessions[user_id].update({
-            'model_id': model_id,
-            'model_info': model_info,
-            'properties': saved_data['properties'].copy(),
-            'required': saved_data['required'].copy(),
-            'params': {}  # Clear params - start fresh
-        })
+        properties = session.properties
+        param_info = properties.get(param_name, {})
+        param_type = param_info.get('type', 'string')
         
-        # Get user balance and calculate available generations (same as select_model)
-        user_balance = get_user_balance(user_id)
-        is_admin = get_is_admin(user_id)
-        
-        # Calculate price for default parameters (minimum price)
-        default_params = {}
-        if model_id == "nano-banana-pro":
-            default_params = {"resolution": "1K"}  # Cheapest option
-        elif model_id == "seedream/4.5-text-to-image" or model_id == "seedream/4.5-edit":
-            default_params = {"quality": "basic"}  # Basic quality (same price, but for consistency)
-        
-        min_price = calculate_price_rub(model_id, default_params, is_admin)
-        price_text = format_price_rub(min_price, is_admin)
-        
-        # Calculate how many generations available
-        if is_admin:
-            available_count = "Безлимит"
-        elif user_balance >= min_price:
-            available_count = int(user_balance / min_price)
-        else:
-            available_count = 0
+        # Convert boolean string to actual boolean
+        if param_type == 'boolean':
+            if param_value.lower() == 'true':
+                param_value = True
+            elif param_value.lower() == 'false':
+                param_value = False
+            else:
+                # Use default if invalid
+                param_value = param_info.get('default', True)
         
-        # Show model info with price and available generations (same format as select_model)
-        model_name = model_info.get('name', model_id)
-        model_emoji = model_info.get('emoji', '🤖')
-        model_desc = model_info.get('description', '')
+        session.params[param_name] = param_value
+        session.current_param = None
         
-        model_info_text = (
-            f"{model_emoji} <b>{model_name}</b>\n\n"
-            f"{model_desc}\n\n"
-            f"💰 <b>Цена генерации:</b> {price_text} ₽\n"
-        )
+        # Check if there are more parameters
+        required = session.required
+        params = session.params
+        missing = [p for p in required if p not in params]
         
-        if is_admin:
-            model_info_text += f"✅ <b>Доступно:</b> Безлимит\n\n"
+        if missing:
+            await query.edit_message_text(f"✅ {param_name} установлен: {param_value}")
+            # Move to next parameter
+            try:
+                next_param_result = await start_next_parameter(update, context, user_id)
+                if next_param_result:
+                    return next_param_result
+            except Exception as e:
+                logger.error("Error starting next parameter: %s", e)
+                await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
+                return INPUTTING_PARAMS
         else:
-            if available_count > 0:
-                model_info_text += f"✅ <b>Доступно генераций:</b> {available_count}\n"
-                model_info_text += f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n\n"
-            else:
-                # Not enough balance - show warning
-                model_info_text += (
-                    f"❌ <b>Недостаточно средств</b>\n"
-                    f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
-                    f"💵 <b>Требуется:</b> {price_text} ₽\n\n"
-                    f"Пополните баланс для генерации."
-                )
-                
-                keyboard = [
-                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                    [InlineKeyboardButton("◀️ Назад к моделям", callback_data="back_to_menu")]
-                ]
-                
-                await query.edit_message_text(
-                    model_info_text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
+            # All parameters collected
+            return await _show_confirmation(query, session)
+
+
+async def _cb_check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the KIE account balance."""
+    # Check balance
+    await query.edit_message_text('💳 Проверяю баланс...')
+    
+    try:
+        result = await get_kie_credits()
         
-        # Check balance before starting generation
-        if not is_admin and user_balance < min_price:
-            keyboard = [
-                [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                [InlineKeyboardButton("◀️ Назад к моделям", callback_data="back_to_menu")]
-            ]
+        if result.get('ok'):
+            credits = result.get('credits', 0)
+            # Convert credits to rubles (no rounding)
+            credits_rub = credits * CREDIT_RATE
+            credits_rub_str = format_rub(credits_rub)
             
             await query.edit_message_text(
-                f"❌ <b>Недостаточно средств для генерации</b>\n\n"
-                f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
-                f"💵 <b>Требуется минимум:</b> {price_text} ₽\n\n"
-                f"Пополните баланс, чтобы начать генерацию.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                f'💳 <b>Баланс:</b> {credits_rub_str} ₽\n'
+                f'<i>({credits} кредитов)</i>\n\n'
+                f'Доступно для генерации контента.',
+                reply_markup=_TOPUP_OR_BACK_MARKUP,
                 parse_mode='HTML'
             )
-            return ConversationHandler.END
-        
-        # Get input parameters from model info
-        input_params = model_info.get('input_params', {})
-        
-        if not input_params:
-            # If no params defined, ask for simple text input
-            await query.edit_message_text(
-                f"{model_info_text}"
-                f"Введите текст для генерации:",
-                parse_mode='HTML'
-            )
-            user_sessions[user_id]['params'] = {}
-            user_sessions[user_id]['waiting_for'] = 'text'
-            return INPUTTING_PARAMS
-        
-        # Store session data
-        user_sessions[user_id]['params'] = {}
-        user_sessions[user_id]['properties'] = input_params
-        user_sessions[user_id]['required'] = [p for p, info in input_params.items() if info.get('required', False)]
-        user_sessions[user_id]['current_param'] = None
-        
-        # Start with prompt parameter first
-        if 'prompt' in input_params:
-            # Check if model supports image input (image_input or image_urls)
-            has_image_input = 'image_input' in input_params or 'image_urls' in input_params
-            
-            prompt_text = (
-                f"{model_info_text}"
-            )
-            
-            if has_image_input:
-                prompt_text += (
-                    f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
-                    f"Опишите изображение, которое хотите сгенерировать.\n\n"
-                    f"💡 <i>После ввода промпта вы сможете добавить изображение (опционально)</i>"
-                )
-            else:
-                prompt_text += (
-                    f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
-                    f"Опишите изображение, которое хотите сгенерировать:"
-                )
-            
+        else:
+            error = result.get('error', 'Unknown error')
             await query.edit_message_text(
-                prompt_text,
+                f'❌ <b>Ошибка проверки баланса:</b>\n{error}',
                 parse_mode='HTML'
             )
-            user_sessions[user_id]['current_param'] = 'prompt'
-            user_sessions[user_id]['waiting_for'] = 'prompt'
-            user_sessions[user_id]['has_image_input'] = has_image_input
-        else:
-            # If no prompt, start with first required parameter
-            await start_next_parameter(update, context, user_id)
-        
-        return INPUTTING_PARAMS
+    except Exception as e:
+        logger.error("Error checking balance: %s", e)
+        await query.edit_message_text(f'❌ Ошибка: {str(e)}')
     
-    if data == "cancel":
-        if user_id in user_sessions:
-            del user_sessions[user_id]
-        await query.edit_message_text("❌ Операция отменена.")
-        return ConversationHandler.END
+    return ConversationHandler.END
+
+
+async def _cb_topup_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the top-up amount choice."""
+    user_id = user.id
+    current_balance, _, blocked = get_user_context(user_id)
     
-    # Handle category selection (can be called from main menu)
-    if data.startswith("category:"):
-        category = data.split(":", 1)[1]
-        models = get_models_by_category(category)
-        
-        if not models:
-            await query.edit_message_text(f"❌ В категории {category} нет моделей.")
-            return ConversationHandler.END
-        
-        # Get user balance for showing available generations
-        user_balance = get_user_balance(user_id)
-        is_admin = get_is_admin(user_id)
-        
-        keyboard = []
-        for model in models:
-            # Calculate price and available count
-            default_params = {}
-            if model['id'] == "nano-banana-pro":
-                default_params = {"resolution": "1K"}
-            min_price = calculate_price_rub(model['id'], default_params, is_admin)
-            
-            if is_admin:
-                button_text = f"{model['emoji']} {model['name']} (Безлимит)"
-            else:
-                if user_balance >= min_price:
-                    available = int(user_balance / min_price)
-                    button_text = f"{model['emoji']} {model['name']} ({available} шт)"
-                else:
-                    button_text = f"{model['emoji']} {model['name']} (0 шт)"
-            
-            keyboard.append([InlineKeyboardButton(
-                button_text,
-                callback_data=f"select_model:{model['id']}"
-            )])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")])
-        keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
-        
-        models_text = f"📋 <b>Модели категории {category}:</b>\n\n"
-        for model in models:
-            default_params = {}
-            if model['id'] == "nano-banana-pro":
-                default_params = {"resolution": "1K"}
-            min_price = calculate_price_rub(model['id'], default_params, is_admin)
-            price_text = format_price_rub(min_price, is_admin)
-            
-            if is_admin:
-                available_text = "Безлимит"
-            else:
-                if user_balance >= min_price:
-                    available = int(user_balance / min_price)
-                    available_text = f"{available} генераций"
-                else:
-                    available_text = "0 генераций"
-            
-            models_text += (
-                f"{model['emoji']} <b>{model['name']}</b>\n"
-                f"{model['description']}\n"
-                f"💰 Цена: {price_text} ₽ | ✅ Доступно: {available_text}\n\n"
-            )
-        
+    # Check if user is blocked
+    if blocked:
         await query.edit_message_text(
-            models_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            "❌ <b>Ваш аккаунт заблокирован</b>\n\n"
+            "Обратитесь к администратору для разблокировки.",
             parse_mode='HTML'
         )
-        return SELECTING_MODEL
+        return ConversationHandler.END
     
-    if data == "show_models" or data == "all_models":
-        # Show all models
-        # Get user balance for showing available generations
-        user_balance = get_user_balance(user_id)
-        is_admin = get_is_admin(user_id)
-        
-        keyboard = []
-        for model in KIE_MODELS:
-            # Calculate price and available count
-            default_params = {}
-            if model['id'] == "nano-banana-pro":
-                default_params = {"resolution": "1K"}
-            min_price = calculate_price_rub(model['id'], default_params, is_admin)
-            
-            if is_admin:
-                button_text = f"{model['emoji']} {model['name']} (Безлимит)"
-            else:
-                if user_balance >= min_price:
-                    available = int(user_balance / min_price)
-                    button_text = f"{model['emoji']} {model['name']} ({available} шт)"
-                else:
-                    button_text = f"{model['emoji']} {model['name']} (0 шт)"
-            
-            keyboard.append([InlineKeyboardButton(
-                button_text,
-                callback_data=f"select_model:{model['id']}"
-            )])
-        keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")])
-        keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="cancel")])
-        
-        models_text = "📋 <b>Все доступные модели:</b>\n\n"
-        for model in KIE_MODELS:
-            default_params = {}
-            if model['id'] == "nano-banana-pro":
-                default_params = {"resolution": "1K"}
-            min_price = calculate_price_rub(model['id'], default_params, is_admin)
-            price_text = format_price_rub(min_price, is_admin)
-            
-            if is_admin:
-                available_text = "Безлимит"
-            else:
-                if user_balance >= min_price:
-                    available = int(user_balance / min_price)
-                    available_text = f"{available} генераций"
-                else:
-                    available_text = "0 генераций"
-            
-            models_text += (
-                f"{model['emoji']} <b>{model['name']}</b>\n"
-                f"{model['description']}\n"
-                f"💰 Цена: {price_text} ₽ | ✅ Доступно: {available_text}\n\n"
-            )
-        
-        await query.edit_message_text(
-            models_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='HTML'
-        )
-        return SELECTING_MODEL
+    # Show amount selection
+    balance_str = format_rub(current_balance)
     
-    if data == "add_image":
-        await query.edit_message_text(
-            "📷 <b>Загрузите изображение</b>\n\n"
-            "Отправьте фото, которое хотите использовать как референс или для трансформации.\n"
-            "Можно загрузить до 8 изображений.",
-            parse_mode='HTML'
-        )
-        session = user_sessions.get(user_id, {})
-        # Determine which parameter name to use (image_input or image_urls)
-        model_info = session.get('model_info', {})
-        input_params = model_info.get('input_params', {})
-        if 'image_urls' in input_params:
-            image_param_name = 'image_urls'
-        else:
-            image_param_name = 'image_input'
-        session['waiting_for'] = image_param_name
-        session[image_param_name] = []  # Initialize as array
-        return INPUTTING_PARAMS
+    await query.edit_message_text(
+        f"💳 <b>Пополнение баланса</b>\n\n"
+        f"💰 <b>Текущий баланс:</b> {balance_str} ₽\n\n"
+        f"Выберите сумму для пополнения:",
+        reply_markup=_TOPUP_AMOUNTS_MARKUP,
+        parse_mode='HTML'
+    )
+    return SELECTING_AMOUNT
+
+
+async def _cb_topup_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show payment details for a preset amount (arg is the amount)."""
+    user_id = user.id
     
-    if data == "image_done":
-        session = user_sessions.get(user_id, {})
-        image_param_name = session.get('waiting_for', 'image_input')
-        if image_param_name in session and session[image_param_name]:
-            session['params'][image_param_name] = session[image_param_name]
-            await query.edit_message_text(
-                f"✅ Добавлено изображений: {len(session[image_param_name])}\n\n"
-                f"Продолжаю..."
-            )
-        session['waiting_for'] = None
-        
-        # Move to next parameter
-        try:
-            next_param_result = await start_next_parameter(update, context, user_id)
-            if next_param_result:
-                return next_param_result
-            else:
-                # All parameters collected
-                model_name = session.get('model_info', {}).get('name', 'Unknown')
-                params = session.get('params', {})
-                params_text = "\n".join([f"  • {k}: {str(v)[:50]}..." for k, v in params.items()])
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ Генерировать", callback_data="confirm_generate")],
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-                ]
-                
-                await query.edit_message_text(
-                    f"📋 <b>Подтверждение:</b>\n\n"
-                    f"Модель: <b>{model_name}</b>\n"
-                    f"Параметры:\n{params_text}\n\n"
-                    f"Продолжить генерацию?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-                return CONFIRMING_GENERATION
-        except Exception as e:
-            logger.error(f"Error after image done: {e}")
-            await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
-            return INPUTTING_PARAMS
+    # User selected a preset amount
+    amount = float(arg)
+    user_sessions[user_id] = UserSession(
+        topup_amount=amount,
+        waiting_for='payment_screenshot'
+    )
     
-    if data == "skip_image":
-        await query.answer("Изображение пропущено")
-        # Move to next parameter
-        try:
-            next_param_result = await start_next_parameter(update, context, user_id)
-            if next_param_result:
-                return next_param_result
-            else:
-                # All parameters collected
-                session = user_sessions[user_id]
-                model_name = session.get('model_info', {}).get('name', 'Unknown')
-                params = session.get('params', {})
-                params_text = "\n".join([f"  • {k}: {str(v)[:50]}..." for k, v in params.items()])
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ Генерировать", callback_data="confirm_generate")],
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-                ]
-                
-                await query.edit_message_text(
-                    f"📋 <b>Подтверждение:</b>\n\n"
-                    f"Модель: <b>{model_name}</b>\n"
-                    f"Параметры:\n{params_text}\n\n"
-                    f"Продолжить генерацию?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-                return CONFIRMING_GENERATION
-        except Exception as e:
-            logger.error(f"Error after skipping image: {e}")
-            await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
-            return INPUTTING_PARAMS
+    payment_details = get_payment_details()
     
-    if data.startswith("set_param:"):
-        # Handle parameter setting via button
-        parts = data.split(":", 2)
-        if len(parts) == 3:
-            param_name = parts[1]
-            param_value = parts[2]
-            
-            if user_id not in user_sessions:
-                await query.edit_message_text("❌ Сессия не найдена.")
-                return ConversationHandler.END
-            
-            session = user_sessions[user_id]
-            properties = session.get('properties', {})
-            param_info = properties.get(param_name, {})
-            param_type = param_info.get('type', 'string')
-            
-            # Convert boolean string to actual boolean
-            if param_type == 'boolean':
-                if param_value.lower() == 'true':
-                    param_value = True
-                elif param_value.lower() == 'false':
-                    param_value = False
-                else:
-                    # Use default if invalid
-                    param_value = param_info.get('default', True)
-            
-            session['params'][param_name] = param_value
-            session['current_param'] = None
-            
-            # Check if there are more parameters
-            required = session.get('required', [])
-            params = session.get('params', {})
-            missing = [p for p in required if p not in params]
-            
-            if missing:
-                await query.edit_message_text(f"✅ {param_name} установлен: {param_value}")
-                # Move to next parameter
-                try:
-                    next_param_result = await start_next_parameter(update, context, user_id)
-                    if next_param_result:
-                        return next_param_result
-                except Exception as e:
-                    logger.error(f"Error starting next parameter: {e}")
-                    await query.edit_message_text("❌ Ошибка при переходе к следующему параметру.")
-                    return INPUTTING_PARAMS
-            else:
-                # All parameters collected
-                model_name = session.get('model_info', {}).get('name', 'Unknown')
-                params_text = "\n".join([f"  • {k}: {v}" for k, v in params.items()])
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ Генерировать", callback_data="confirm_generate")],
-                    [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-                ]
-                
-                await query.edit_message_text(
-                    f"📋 <b>Подтверждение:</b>\n\n"
-                    f"Модель: <b>{model_name}</b>\n"
-                    f"Параметры:\n{params_text}\n\n"
-                    f"Продолжить генерацию?",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-                return CONFIRMING_GENERATION
+    await query.edit_message_text(
+        f"{payment_details}\n\n"
+        f"💵 <b>Сумма к оплате:</b> {amount:.2f} ₽\n\n"
+        f"После оплаты отправьте скриншот перевода в этот чат.\n\n"
+        f"✅ <b>Баланс начислится автоматически</b> после отправки скриншота.",
+        reply_markup=_CANCEL_MARKUP,
+        parse_mode='HTML'
+    )
+    return WAITING_PAYMENT_SCREENSHOT
+
+
+_TOPUP_CUSTOM_TEXT = (
+    "💳 <b>Введите сумму пополнения</b>\n\n"
+    "Отправьте число (например: 1500)\n"
+    "Минимальная сумма: 50 ₽\n"
+    "Максимальная сумма: 50000 ₽"
+)
+
+
+async def _cb_topup_custom(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Ask the user to type a top-up amount."""
+    user_id = user.id
     
-    if data == "check_balance":
-        # Check balance
-        await query.edit_message_text('💳 Проверяю баланс...')
-        
-        try:
-            result = await kie.get_credits()
-            
-            if result.get('ok'):
-                credits = result.get('credits', 0)
-                # Convert credits to rubles (no rounding)
-                credits_rub = credits * CREDIT_TO_USD * USD_TO_RUB
-                credits_rub_str = f"{credits_rub:.2f}".rstrip('0').rstrip('.')
-                
-                keyboard = [
-                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-                ]
-                
-                await query.edit_message_text(
-                    f'💳 <b>Баланс:</b> {credits_rub_str} ₽\n'
-                    f'<i>({credits} кредитов)</i>\n\n'
-                    f'Доступно для генерации контента.',
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-            else:
-                error = result.get('error', 'Unknown error')
-                await query.edit_message_text(
-                    f'❌ <b>Ошибка проверки баланса:</b>\n{error}',
-                    parse_mode='HTML'
-                )
-        except Exception as e:
-            logger.error(f"Error checking balance: {e}")
-            await query.edit_message_text(f'❌ Ошибка: {str(e)}')
-        
-        return ConversationHandler.END
+    # User wants to enter custom amount
+    await query.edit_message_text(_TOPUP_CUSTOM_TEXT, parse_mode='HTML')
+    user_sessions[user_id] = UserSession(
+        waiting_for='topup_amount_input'
+    )
+    return SELECTING_AMOUNT
+
+
+async def _cb_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show bot statistics to the admin."""
+    # Get statistics
+    total_models = TOTAL_MODELS
+    categories = CATEGORIES
+    user_sessions.expire()
+    active_sessions = len(user_sessions)
     
-    if data == "topup_balance":
-        # Check if user is blocked
-        if is_user_blocked(user_id):
-            await query.edit_message_text(
-                "❌ <b>Ваш аккаунт заблокирован</b>\n\n"
-                "Обратитесь к администратору для разблокировки.",
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
-        
-        # Show amount selection
-        keyboard = [
-            [
-                InlineKeyboardButton("100 ₽", callback_data="topup_amount:100"),
-                InlineKeyboardButton("500 ₽", callback_data="topup_amount:500")
-            ],
-            [
-                InlineKeyboardButton("1000 ₽", callback_data="topup_amount:1000"),
-                InlineKeyboardButton("2000 ₽", callback_data="topup_amount:2000")
-            ],
-            [
-                InlineKeyboardButton("5000 ₽", callback_data="topup_amount:5000"),
-                InlineKeyboardButton("Другая сумма", callback_data="topup_custom")
-            ],
-            [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-        ]
-        
-        current_balance = get_user_balance(user_id)
-        balance_str = f"{current_balance:.2f}".rstrip('0').rstrip('.')
-        
-        await query.edit_message_text(
-            f"💳 <b>Пополнение баланса</b>\n\n"
-            f"💰 <b>Текущий баланс:</b> {balance_str} ₽\n\n"
-            f"Выберите сумму для пополнения:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='HTML'
-        )
-        return SELECTING_AMOUNT
-    
-    if data.startswith("topup_amount:"):
-        # User selected a preset amount
-        amount = float(data.split(":")[1])
-        user_sessions[user_id] = {
-            'topup_amount': amount,
-            'waiting_for': 'payment_screenshot'
-        }
-        
-        payment_details = get_payment_details()
-        
-        keyboard = [
-            [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-        ]
-        
-        await query.edit_message_text(
-            f"{payment_details}\n\n"
-            f"💵 <b>Сумма к оплате:</b> {amount:.2f} ₽\n\n"
-            f"После оплаты отправьте скриншот перевода в этот чат.\n\n"
-            f"✅ <b>Баланс начислится автоматически</b> после отправки скриншота.",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode='HTML'
-        )
-        return WAITING_PAYMENT_SCREENSHOT
+    # Try to get balance
+    balance_info = ""
+    try:
+        balance_result = await get_kie_credits()
+        if balance_result.get('ok'):
+            balance = balance_result.get('credits', 0)
+            # Convert credits to rubles (no rounding)
+            balance_rub = balance * CREDIT_RATE
+            balance_rub_str = format_rub(balance_rub)
+            balance_info = f"💰 <b>Баланс:</b> {balance_rub_str} ₽\n<i>({balance} кредитов)</i>\n"
+    except:
+        balance_info = "💰 <b>Баланс:</b> Недоступен\n"
+    
+    stats_text = (
+        f'📊 <b>Статистика бота:</b>\n\n'
+        f'{balance_info}'
+        f'📦 <b>Моделей:</b> {total_models}\n'
+        f'📁 <b>Категорий:</b> {len(categories)}\n'
+        f'👥 <b>Активных сессий:</b> {active_sessions}\n\n'
+        f'🔄 Обновлено: {time.strftime("%H:%M:%S")}'
+    )
+    
+    await query.edit_message_text(
+        stats_text,
+        reply_markup=_ADMIN_STATS_MARKUP,
+        parse_mode='HTML'
+    )
+    return ConversationHandler.END
+
+
+# Admin settings and commands; .env is only read at startup, so the support
+# contact in it is fixed for the life of the process
+_ADMIN_SETTINGS_TEXT = (
+    '⚙️ <b>Настройки администратора:</b>\n\n'
+    '🔧 <b>Доступные функции:</b>\n\n'
+    '✅ Управление моделями\n'
+    '✅ Просмотр статистики\n'
+    '✅ Управление пользователями\n'
+    '✅ Настройки API\n\n'
+    '💡 <b>Команды:</b>\n'
+    '/models - Управление моделями\n'
+    '/balance - Проверка баланса\n'
+    '/search - Поиск в базе знаний\n'
+    '/add - Добавление знаний\n'
+    '/payments - Просмотр платежей\n'
+    '/block_user - Заблокировать пользователя\n'
+    '/unblock_user - Разблокировать пользователя\n'
+    '/user_balance - Баланс пользователя\n\n'
+    '💬 <b>Настройки поддержки:</b>\n\n'
+    f'💬 Telegram: {os.getenv("SUPPORT_TELEGRAM") or "Не указано"}\n\n'
+    '💡 Для изменения настроек поддержки отредактируйте файл .env'
+)
+
+
+async def _cb_admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the admin settings and commands."""
+    await query.edit_message_text(
+        _ADMIN_SETTINGS_TEXT,
+        reply_markup=_BACK_MARKUP,
+        parse_mode='HTML'
+    )
+    return ConversationHandler.END
+
+
+_ADMIN_SEARCH_TEXT = (
+    '🔍 <b>Поиск в базе знаний</b>\n\n'
+    'Используйте команду:\n'
+    '<code>/search [запрос]</code>\n\n'
+    'Пример:\n'
+    '<code>/search нейросети</code>'
+)
+_ADMIN_ADD_TEXT = (
+    '📝 <b>Добавление знаний</b>\n\n'
+    'Используйте команду:\n'
+    '<code>/add [заголовок] | [содержание]</code>\n\n'
+    'Пример:\n'
+    '<code>/add AI | Искусственный интеллект - это...</code>'
+)
+
+
+async def _cb_admin_search(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Explain the /search command."""
+    await query.edit_message_text(_ADMIN_SEARCH_TEXT, parse_mode='HTML')
+    return ConversationHandler.END
+
+
+async def _cb_admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Explain the /add command."""
+    await query.edit_message_text(_ADMIN_ADD_TEXT, parse_mode='HTML')
+    return ConversationHandler.END
+
+
+async def _cb_admin_test_ocr(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Start an OCR test on a payment screenshot."""
+    user_id = user.id
     
-    if data == "topup_custom":
-        # User wants to enter custom amount
+    if not PIL_AVAILABLE or not _ensure_tesseract():
         await query.edit_message_text(
-            "💳 <b>Введите сумму пополнения</b>\n\n"
-            "Отправьте число (например: 1500)\n"
-            "Минимальная сумма: 50 ₽\n"
-            "Максимальная сумма: 50000 ₽",
+            '❌ <b>OCR недоступен</b>\n\n'
+            'Tesseract OCR не установлен или библиотеки не найдены.\n\n'
+            'Установите:\n'
+            '1. pip install Pillow pytesseract\n'
+            '2. Tesseract OCR (см. TESSERACT_INSTALL.txt)',
             parse_mode='HTML'
         )
-        user_sessions[user_id] = {
-            'waiting_for': 'topup_amount_input'
-        }
-        return SELECTING_AMOUNT
+        return ConversationHandler.END
     
-    # Admin functions (only for admin)
-    if user_id == ADMIN_ID:
-        if data == "admin_stats":
-            # Get statistics
-            total_models = len(KIE_MODELS)
-            categories = get_categories()
-            active_sessions = len(user_sessions)
-            
-            # Try to get balance
-            balance_info = ""
-            try:
-                balance_result = await kie.get_credits()
-                if balance_result.get('ok'):
-                    balance = balance_result.get('credits', 0)
-                    # Convert credits to rubles (no rounding)
-                    balance_rub = balance * CREDIT_TO_USD * USD_TO_RUB
-                    balance_rub_str = f"{balance_rub:.2f}".rstrip('0').rstrip('.')
-                    balance_info = f"💰 <b>Баланс:</b> {balance_rub_str} ₽\n<i>({balance} кредитов)</i>\n"
-            except:
-                balance_info = "💰 <b>Баланс:</b> Недоступен\n"
-            
-            stats_text = (
-                f'📊 <b>Статистика бота:</b>\n\n'
-                f'{balance_info}'
-                f'📦 <b>Моделей:</b> {total_models}\n'
-                f'📁 <b>Категорий:</b> {len(categories)}\n'
-                f'👥 <b>Активных сессий:</b> {active_sessions}\n\n'
-                f'🔄 Обновлено: {asyncio.get_event_loop().time():.0f}'
-            )
-            
-            keyboard = [
-                [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
-                [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-            ]
-            
-            await query.edit_message_text(
-                stats_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
-        
-        if data == "admin_settings":
-            # Get support contact info
-            support_telegram = os.getenv('SUPPORT_TELEGRAM', 'Не указано')
-            
-            settings_text = (
-                f'⚙️ <b>Настройки администратора:</b>\n\n'
-                f'🔧 <b>Доступные функции:</b>\n\n'
-                f'✅ Управление моделями\n'
-                f'✅ Просмотр статистики\n'
-                f'✅ Управление пользователями\n'
-                f'✅ Настройки API\n\n'
-                f'💡 <b>Команды:</b>\n'
-                f'/models - Управление моделями\n'
-                f'/balance - Проверка баланса\n'
-                f'/search - Поиск в базе знаний\n'
-                f'/add - Добавление знаний\n'
-                f'/payments - Просмотр платежей\n'
-                f'/block_user - Заблокировать пользователя\n'
-                f'/unblock_user - Разблокировать пользователя\n'
-                f'/user_balance - Баланс пользователя\n\n'
-                f'💬 <b>Настройки поддержки:</b>\n\n'
-                f'💬 Telegram: {support_telegram if support_telegram != "Не указано" else "Не указано"}\n\n'
-                f'💡 Для изменения настроек поддержки отредактируйте файл .env'
+    await query.edit_message_text(
+        '🧪 <b>Тест OCR</b>\n\n'
+        'Отправьте изображение со скриншотом платежа.\n\n'
+        'Система проверит:\n'
+        '✅ Распознавание текста\n'
+        '✅ Поиск сумм\n'
+        '✅ Работа Tesseract OCR\n\n'
+        'Или нажмите /cancel для отмены.',
+        parse_mode='HTML'
+    )
+    user_sessions[user_id] = UserSession(
+        waiting_for='admin_test_ocr'
+    )
+    return ADMIN_TEST_OCR
+
+
+# Help menu text; the admin also gets the admin commands between the two parts
+_HELP_COMMANDS_TEXT = (
+    '📋 <b>Доступные команды:</b>\n\n'
+    '/start - Главное меню\n'
+    '/models - Показать модели\n'
+    '/balance - Проверить баланс\n'
+    '/generate - Начать генерацию\n'
+    '/help - Справка\n\n'
+)
+_HELP_ADMIN_COMMANDS_TEXT = (
+    '👑 <b>Административные команды:</b>\n'
+    '/search - Поиск в базе знаний\n'
+    '/add - Добавление знаний\n'
+    '/payments - Просмотр платежей\n'
+    '/block_user - Заблокировать пользователя\n'
+    '/unblock_user - Разблокировать пользователя\n'
+    '/user_balance - Баланс пользователя\n\n'
+)
+_HELP_USAGE_TEXT = (
+    '💡 <b>Как использовать:</b>\n'
+    '1. Выберите модель из меню\n'
+    '2. Введите промпт (описание)\n'
+    '3. Выберите параметры через кнопки\n'
+    '4. Подтвердите генерацию\n'
+    '5. Получите результат!'
+)
+_HELP_TEXT_USER = _HELP_COMMANDS_TEXT + _HELP_USAGE_TEXT
+_HELP_TEXT_ADMIN = _HELP_COMMANDS_TEXT + _HELP_ADMIN_COMMANDS_TEXT + _HELP_USAGE_TEXT
+
+
+async def _cb_help_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the list of commands."""
+    help_text = _HELP_TEXT_ADMIN if user.id == ADMIN_ID else _HELP_TEXT_USER
+    
+    await query.edit_message_text(
+        help_text,
+        reply_markup=_BACK_MARKUP,
+        parse_mode='HTML'
+    )
+    return ConversationHandler.END
+
+
+async def _cb_support_contact(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show the support contact."""
+    support_info = get_support_contact()
+    await query.edit_message_text(
+        support_info,
+        reply_markup=_BACK_MARKUP,
+        parse_mode='HTML'
+    )
+    return ConversationHandler.END
+
+
+async def _cb_select_model(update: Update, context: ContextTypes.DEFAULT_TYPE, query, user, arg: str):
+    """Show a model and start collecting its parameters (arg is the model id)."""
+    user_id = user.id
+    
+    model_id = arg
+    
+    # Get model from static list
+    model_info = get_model_by_id(model_id)
+    
+    if not model_info:
+        await query.edit_message_text(f"❌ Модель {model_id} не найдена.")
+        return
+    
+    # Check user balance and calculate available generations
+    user_balance, is_admin, _ = get_user_context(user_id)
+    
+    # Calculate price for default parameters (minimum price)
+    min_price = min_price_rub(model_id, is_admin)
+    price_text = format_price_rub(min_price, is_admin)
+    
+    # Calculate how many generations available
+    if is_admin:
+        available_count = "Безлимит"
+    elif user_balance >= min_price:
+        available_count = available_generations(user_balance, min_price)
+    else:
+        available_count = 0
+    
+    # Show model info with price and available generations
+    model_name = model_info.get('name', model_id)
+    model_emoji = model_info.get('emoji', '🤖')
+    model_desc = model_info.get('description', '')
+    
+    model_info_text = (
+        f"{model_emoji} <b>{model_name}</b>\n\n"
+        f"{model_desc}\n\n"
+        f"💰 <b>Цена генерации:</b> {price_text} ₽\n"
+    )
+    
+    if is_admin:
+        model_info_text += f"✅ <b>Доступно:</b> Безлимит\n\n"
+    else:
+        if available_count > 0:
+            model_info_text += f"✅ <b>Доступно генераций:</b> {available_count}\n"
+            model_info_text += f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n\n"
+        else:
+            # Not enough balance - show warning
+            model_info_text += (
+                f"❌ <b>Недостаточно средств</b>\n"
+                f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
+                f"💵 <b>Требуется:</b> {price_text} ₽\n\n"
+                f"Пополните баланс для генерации."
             )
             
-            keyboard = [
-                [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-            ]
-            
-            await query.edit_message_text(
-                settings_text,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
-        
-        if data == "admin_search":
             await query.edit_message_text(
-                '🔍 <b>Поиск в базе знаний</b>\n\n'
-                'Используйте команду:\n'
-                '<code>/search [запрос]</code>\n\n'
-                'Пример:\n'
-                '<code>/search нейросети</code>',
+                model_info_text,
+                reply_markup=_INSUFFICIENT_BALANCE_MARKUP,
                 parse_mode='HTML'
             )
             return ConversationHandler.END
-        
-        if data == "admin_add":
-            await query.edit_message_text(
-                '📝 <b>Добавление знаний</b>\n\n'
-                'Используйте команду:\n'
-                '<code>/add [заголовок] | [содержание]</code>\n\n'
-                'Пример:\n'
-                '<code>/add AI | Искусственный интеллект - это...</code>',
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
-        
-        if data == "admin_test_ocr":
-            if not OCR_AVAILABLE or not PIL_AVAILABLE:
-                await query.edit_message_text(
-                    '❌ <b>OCR недоступен</b>\n\n'
-                    'Tesseract OCR не установлен или библиотеки не найдены.\n\n'
-                    'Установите:\n'
-                    '1. pip install Pillow pytesseract\n'
-                    '2. Tesseract OCR (см. TESSERACT_INSTALL.txt)',
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
-            
-            await query.edit_message_text(
-                '🧪 <b>Тест OCR</b>\n\n'
-                'Отправьте изображение со скриншотом платежа.\n\n'
-                'Система проверит:\n'
-                '✅ Распознавание текста\n'
-                '✅ Поиск сумм\n'
-                '✅ Работа Tesseract OCR\n\n'
-                'Или нажмите /cancel для отмены.',
-                parse_mode='HTML'
-            )
-            user_sessions[user_id] = {
-                'waiting_for': 'admin_test_ocr'
-            }
-            return ADMIN_TEST_OCR
-        
-        if data == "admin_test_ocr":
-            if not OCR_AVAILABLE or not PIL_AVAILABLE:
-                await query.edit_message_text(
-                    '❌ <b>OCR недоступен</b>\n\n'
-                    'Tesseract OCR не установлен или библиотеки не найдены.\n\n'
-                    'Установите:\n'
-                    '1. pip install Pillow pytesseract\n'
-                    '2. Tesseract OCR (см. TESSERACT_INSTALL.txt)',
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
-            
-            await query.edit_message_text(
-                '🧪 <b>Тест OCR</b>\n\n'
-                'Отправьте изображение со скриншотом платежа.\n\n'
-                'Система проверит:\n'
-                '✅ Распознавание текста\n'
-                '✅ Поиск суммы\n'
-                '✅ Работа Tesseract OCR\n\n'
-                'Или нажмите /cancel для отмены.',
-                parse_mode='HTML'
-            )
-            user_sessions[user_id] = {
-                'waiting_for': 'admin_test_ocr'
-            }
-            return ADMIN_TEST_OCR
     
-    if data == "help_menu":
-        help_text = '📋 <b>Доступные команды:</b>\n\n'
-        help_text += '/start - Главное меню\n'
-        help_text += '/models - Показать модели\n'
-        help_text += '/balance - Проверить баланс\n'
-        help_text += '/generate - Начать генерацию\n'
-        help_text += '/help - Справка\n\n'
-        
-        if user_id == ADMIN_ID:
-            help_text += '👑 <b>Административные команды:</b>\n'
-            help_text += '/search - Поиск в базе знаний\n'
-            help_text += '/add - Добавление знаний\n'
-            help_text += '/payments - Просмотр платежей\n'
-            help_text += '/block_user - Заблокировать пользователя\n'
-            help_text += '/unblock_user - Разблокировать пользователя\n'
-            help_text += '/user_balance - Баланс пользователя\n\n'
-        
-        help_text += '💡 <b>Как использовать:</b>\n'
-        help_text += '1. Выберите модель из меню\n'
-        help_text += '2. Введите промпт (описание)\n'
-        help_text += '3. Выберите параметры через кнопки\n'
-        help_text += '4. Подтвердите генерацию\n'
-        help_text += '5. Получите результат!'
-        
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]]
-        
+    # Check balance before starting generation
+    if not is_admin and user_balance < min_price:
         await query.edit_message_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            f"❌ <b>Недостаточно средств для генерации</b>\n\n"
+            f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
+            f"💵 <b>Требуется минимум:</b> {price_text} ₽\n\n"
+            f"Пополните баланс, чтобы начать генерацию.",
+            reply_markup=_INSUFFICIENT_BALANCE_MARKUP,
             parse_mode='HTML'
         )
         return ConversationHandler.END
     
-    if data == "support_contact":
-        support_info = get_support_contact()
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]]
-        
+    # Store selected model
+    user_sessions[user_id].model_id = model_id
+    user_sessions[user_id].model_info = model_info
+    
+    # Get input parameters from static definition
+    input_params = model_info.get('input_params', {})
+    
+    if not input_params:
+        # If no params defined, ask for simple text input
         await query.edit_message_text(
-            support_info,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            f"{model_info_text}"
+            f"Введите текст для генерации:",
             parse_mode='HTML'
         )
-        return ConversationHandler.END
+        user_sessions[user_id].params = {}
+        user_sessions[user_id].waiting_for = 'text'
+        return INPUTTING_PARAMS
     
-    if data.startswith("select_model:"):
-        model_id = data.split(":", 1)[1]
-        
-        # Get model from static list
-        model_info = get_model_by_id(model_id)
-        
-        if not model_info:
-            await query.edit_message_text(f"❌ Модель {model_id} не найдена.")
-            return
-        
-        # Check user balance and calculate available generations
-        user_balance = get_user_balance(user_id)
-        is_admin = get_is_admin(user_id)
-        
-        # Calculate price for default parameters (minimum price)
-        default_params = {}
-        if model_id == "nano-banana-pro":
-            default_params = {"resolution": "1K"}  # Cheapest option
-        elif model_id == "seedream/4.5-text-to-image" or model_id == "seedream/4.5-edit":
-            default_params = {"quality": "basic"}  # Basic quality (same price, but for consistency)
-        
-        min_price = calculate_price_rub(model_id, default_params, is_admin)
-        price_text = format_price_rub(min_price, is_admin)
-        
-        # Calculate how many generations available
-        if is_admin:
-            available_count = "Безлимит"
-        elif user_balance >= min_price:
-            available_count = int(user_balance / min_price)
-        else:
-            available_count = 0
-        
-        # Show model info with price and available generations
-        model_name = model_info.get('name', model_id)
-        model_emoji = model_info.get('emoji', '🤖')
-        model_desc = model_info.get('description', '')
+    # Store session data
+    user_sessions[user_id].params = {}
+    user_sessions[user_id].properties = input_params
+    user_sessions[user_id].required = model_info.get('_required_params', ())
+    user_sessions[user_id].current_param = None
+    
+    # Start with prompt parameter first
+    if 'prompt' in input_params:
+        # Check if model supports image input (image_input or image_urls)
+        has_image_input = 'image_input' in input_params or 'image_urls' in input_params
         
-        model_info_text = (
-            f"{model_emoji} <b>{model_name}</b>\n\n"
-            f"{model_desc}\n\n"
-            f"💰 <b>Цена генерации:</b> {price_text} ₽\n"
+        prompt_text = (
+            f"{model_info_text}"
         )
         
-        if is_admin:
-            model_info_text += f"✅ <b>Доступно:</b> Безлимит\n\n"
-        else:
-            if available_count > 0:
-                model_info_text += f"✅ <b>Доступно генераций:</b> {available_count}\n"
-                model_info_text += f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n\n"
-            else:
-                # Not enough balance - show warning
-                model_info_text += (
-                    f"❌ <b>Недостаточно средств</b>\n"
-                    f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
-                    f"💵 <b>Требуется:</b> {price_text} ₽\n\n"
-                    f"Пополните баланс для генерации."
-                )
-                
-                keyboard = [
-                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                    [InlineKeyboardButton("◀️ Назад к моделям", callback_data="back_to_menu")]
-                ]
-                
-                await query.edit_message_text(
-                    model_info_text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode='HTML'
-                )
-                return ConversationHandler.END
-        
-        # Check balance before starting generation
-        if not is_admin and user_balance < min_price:
-            keyboard = [
-                [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                [InlineKeyboardButton("◀️ Назад к моделям", callback_data="back_to_menu")]
-            ]
-            
-            await query.edit_message_text(
-                f"❌ <b>Недостаточно средств для генерации</b>\n\n"
-                f"💳 <b>Ваш баланс:</b> {format_price_rub(user_balance, is_admin)} ₽\n"
-                f"💵 <b>Требуется минимум:</b> {price_text} ₽\n\n"
-                f"Пополните баланс, чтобы начать генерацию.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='HTML'
-            )
-            return ConversationHandler.END
-        
-        # Store selected model
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {}
-        user_sessions[user_id]['model_id'] = model_id
-        user_sessions[user_id]['model_info'] = model_info
-        
-        # Get input parameters from static definition
-        input_params = model_info.get('input_params', {})
-        
-        if not input_params:
-            # If no params defined, ask for simple text input
-            await query.edit_message_text(
-                f"{model_info_text}"
-                f"Введите текст для генерации:",
-                parse_mode='HTML'
-            )
-            user_sessions[user_id]['params'] = {}
-            user_sessions[user_id]['waiting_for'] = 'text'
-            return INPUTTING_PARAMS
-        
-        # Store session data
-        user_sessions[user_id]['params'] = {}
-        user_sessions[user_id]['properties'] = input_params
-        user_sessions[user_id]['required'] = [p for p, info in input_params.items() if info.get('required', False)]
-        user_sessions[user_id]['current_param'] = None
-        
-        # Start with prompt parameter first
-        if 'prompt' in input_params:
-            # Check if model supports image input (image_input or image_urls)
-            has_image_input = 'image_input' in input_params or 'image_urls' in input_params
-            
-            prompt_text = (
-                f"{model_info_text}"
-            )
-            
-            if has_image_input:
-                prompt_text += (
-                    f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
-                    f"Опишите изображение, которое хотите сгенерировать.\n\n"
-                    f"💡 <i>После ввода промпта вы сможете добавить изображение (опционально)</i>"
-                )
-            else:
-                prompt_text += (
-                    f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
-                    f"Опишите изображение, которое хотите сгенерировать:"
-                )
-            
-            await query.edit_message_text(
-                prompt_text,
-                parse_mode='HTML'
+        if has_image_input:
+            prompt_text += (
+                f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
+                f"Опишите изображение, которое хотите сгенерировать.\n\n"
+                f"💡 <i>После ввода промпта вы сможете добавить изображение (опционально)</i>"
             )
-            user_sessions[user_id]['current_param'] = 'prompt'
-            user_sessions[user_id]['waiting_for'] = 'prompt'
-            user_sessions[user_id]['has_image_input'] = has_image_input
         else:
-            # If no prompt, start with first required parameter
-            await start_next_parameter(update, context, user_id)
+            prompt_text += (
+                f"📝 <b>Шаг 1: Введите промпт</b>\n\n"
+                f"Опишите изображение, которое хотите сгенерировать:"
+            )
         
-        return INPUTTING_PARAMS
+        await query.edit_message_text(
+            prompt_text,
+            parse_mode='HTML'
+        )
+        user_sessions[user_id].current_param = 'prompt'
+        user_sessions[user_id].waiting_for = 'prompt'
+        user_sessions[user_id].has_image_input = has_image_input
+    else:
+        # If no prompt, start with first required parameter
+        await start_next_parameter(update, context, user_id)
+    
+    return INPUTTING_PARAMS
+
+
+# Callback buttons handled by a dedicated function: exact callback_data,
+# and "prefix:argument" buttons keyed by prefix (see button_callback).
+# Handlers get the query and user already looked up by button_callback.
+CALLBACK_HANDLERS = {
+    'admin_user_mode': _cb_admin_user_mode,
+    'admin_back_to_admin': _cb_admin_back_to_admin,
+    'back_to_menu': _cb_back_to_menu,
+    'generate_again': _cb_generate_again,
+    'cancel': _cb_cancel,
+    'show_models': _cb_show_models,
+    'all_models': _cb_show_models,
+    'add_image': _cb_add_image,
+    'image_done': _cb_image_done,
+    'skip_image': _cb_skip_image,
+    'check_balance': _cb_check_balance,
+    'topup_balance': _cb_topup_balance,
+    'topup_custom': _cb_topup_custom,
+    'help_menu': _cb_help_menu,
+    'support_contact': _cb_support_contact,
+}
+PREFIX_CALLBACK_HANDLERS = {
+    'category': _cb_category,
+    'select_model': _cb_select_model,
+    'set_param': _cb_set_param,
+    'topup_amount': _cb_topup_amount,
+}
+# Admin panel buttons; only looked up for the admin, other users' presses are ignored
+ADMIN_CALLBACK_HANDLERS = {
+    'admin_stats': _cb_admin_stats,
+    'admin_settings': _cb_admin_settings,
+    'admin_search': _cb_admin_search,
+    'admin_add': _cb_admin_add,
+    'admin_test_ocr': _cb_admin_test_ocr,
+}
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle button callbacks."""
+    query = update.callback_query
+    user = update.effective_user
+    user_id = user.id
+    data = query.data
+    
+    # Checked before the first await so concurrent repeats can't both pass
+    if _recent_callbacks.get(user_id) == data:
+        await query.answer()
+        return None  # Keep the conversation state as it is
+    _recent_callbacks[user_id] = data
+    
+    await query.answer()
+    
+    # Exact callback_data first, then "prefix:argument" buttons
+    handler = CALLBACK_HANDLERS.get(data)
+    arg = ''
+    if handler is None:
+        prefix, separator, arg = data.partition(':')
+        if separator:
+            handler = PREFIX_CALLBACK_HANDLERS.get(prefix)
+    if handler is None and user_id == ADMIN_ID:
+        handler = ADMIN_CALLBACK_HANDLERS.get(data)
+    if handler is not None:
+        return await handler(update, context, query, user, arg)
+    return None
+
+
+async def _send_text(bot, chat_id: int, text: str):
+    """
+    Send an HTML text without a keyboard through the per-chat outbound batcher.
+    
+    Messages with a keyboard are sent directly; call outbound.flush(chat_id)
+    before them so they can't overtake texts still waiting in the batcher.
+    """
+    await outbound.send(chat_id, text, partial(bot.send_message, chat_id, parse_mode='HTML'))
 
 
 async def start_next_parameter(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """Start input for next parameter."""
     session = user_sessions[user_id]
-    properties = session.get('properties', {})
-    params = session.get('params', {})
-    required = session.get('required', [])
+    properties = session.properties
+    params = session.params
+    required = session.required
     
     # Find next unset parameter (skip prompt, image_input, and image_urls as they're handled separately)
     for param_name in required:
@@ -2174,7 +2682,7 @@ async def start_next_parameter(update: Update, context: ContextTypes.DEFAULT_TYP
             param_type = param_info.get('type', 'string')
             enum_values = param_info.get('enum')
             
-            session['current_param'] = param_name
+            session.current_param = param_name
             
             # Handle boolean parameters
             if param_type == 'boolean':
@@ -2200,6 +2708,7 @@ async def start_next_parameter(update: Update, context: ContextTypes.DEFAULT_TYP
                     logger.error("Cannot determine chat_id in start_next_parameter")
                     return None
                 
+                await outbound.flush(chat_id)
                 await context.bot.send_message(
                     chat_id=chat_id,
                     text=f"📝 <b>Выберите {param_name}:</b>\n\n{param_desc}\n\nПо умолчанию: {'Да' if default_value else 'Нет'}",
@@ -2239,6 +2748,7 @@ async def start_next_parameter(update: Update, context: ContextTypes.DEFAULT_TYP
                     logger.error("Cannot determine chat_id in start_next_parameter")
                     return None
                 
+                await outbound.flush(chat_id)
                 await context.bot.send_message(
                     chat_id=chat_id,
                     text=f"📝 <b>Выберите {param_name}:</b>\n\n{param_desc}",
@@ -2265,12 +2775,8 @@ async def start_next_parameter(update: Update, context: ContextTypes.DEFAULT_TYP
                     logger.error("Cannot determine chat_id in start_next_parameter")
                     return None
                 
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"📝 <b>Введите {param_name}:</b>\n\n{param_desc}{max_text}",
-                    parse_mode='HTML'
-                )
-                session['waiting_for'] = param_name
+                await _send_text(context.bot, chat_id, f"📝 <b>Введите {param_name}:</b>\n\n{param_desc}{max_text}")
+                session.waiting_for = param_name
                 return INPUTTING_PARAMS
     
     # All parameters collected
@@ -2281,28 +2787,24 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle parameter input."""
     user_id = update.effective_user.id
     
+    session = user_sessions.get(user_id)
+    waiting_for = session.waiting_for if session is not None else None
+    
     # Handle admin OCR test
-    if user_id == ADMIN_ID and user_id in user_sessions and user_sessions[user_id].get('waiting_for') == 'admin_test_ocr':
+    if user_id == ADMIN_ID and waiting_for == 'admin_test_ocr':
         if update.message.photo:
             photo = update.message.photo[-1]
-            loading_msg = await update.message.reply_text("🔍 Анализирую изображение...")
-            
+            # Download while the loading message is being sent
+            download = asyncio.create_task(download_telegram_file(context.bot, photo.file_id))
+            loading_msg = None
             try:
-                file = await context.bot.get_file(photo.file_id)
-                image_data = await file.download_as_bytearray()
+                loading_msg = await update.message.reply_text("🔍 Анализирую изображение...")
+                image_data = await download
                 
-                # Test OCR - extract text
+                # Test OCR - extract text with the same pipeline as payment checks;
+                # decoding and Tesseract run in a worker thread, not on the event loop
                 try:
-                    image = Image.open(BytesIO(image_data))
-                    try:
-                        extracted_text = pytesseract.image_to_string(image, lang='rus+eng')
-                    except Exception as e:
-                        logger.warning(f"Error with rus+eng, trying eng only: {e}")
-                        try:
-                            extracted_text = pytesseract.image_to_string(image, lang='eng')
-                        except Exception as e2:
-                            logger.warning(f"Error with eng, trying default: {e2}")
-                            extracted_text = pytesseract.image_to_string(image)
+                    extracted_text = await _ocr_batcher.extract_text(image_data)
                 except Exception as e:
                     error_msg = str(e)
                     if "tesseract is not installed" in error_msg.lower() or "not in your path" in error_msg.lower():
@@ -2312,42 +2814,12 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 extracted_text_lower = extracted_text.lower()
                 
-                # Find amounts in text (improved patterns)
-                amount_patterns = [
-                    # With currency symbols
-                    r'(\d+[.,]\d+)\s*[₽рубР]',
-                    r'(\d+)\s*[₽рубР]',
-                    r'[₽рубР]\s*(\d+[.,]\d+)',
-                    r'[₽рубР]\s*(\d+)',
-                    # Near payment keywords
-                    r'(?:сумма|итого|перевод|amount|total)[:\s]+(\d+[.,]?\d*)',
-                    r'(\d+[.,]?\d*)\s*(?:сумма|итого|перевод|amount|total)',
-                    # Misrecognized currency (B instead of Р, 2 instead of Р)
-                    r'(\d+)\s*[B2]',
-                    r'(\d+)\s*[₽рубРB2]',
-                    # Standalone numbers (filtered later)
-                    r'\b(\d{2,6})\b',
-                ]
-                
-                found_amounts = []
-                for pattern in amount_patterns:
-                    matches = re.findall(pattern, extracted_text, re.IGNORECASE)
-                    for match in matches:
-                        try:
-                            amount = float(match.replace(',', '.'))
-                            # Filter reasonable amounts (10-100000 rubles)
-                            if 10 <= amount <= 100000:
-                                found_amounts.append(amount)
-                        except:
-                            continue
+                # Find amounts the same way payment screenshots are checked,
+                # keeping reasonable ones (10-100000 rubles)
+                found_amounts = [amount for amount in _extract_amounts(extracted_text) if 10 <= amount <= 100000]
                 
-                # Check for payment keywords
-                payment_keywords = [
-                    'перевод', 'оплата', 'платеж', 'спб', 'сбп', 'payment', 'transfer',
-                    'отправлено', 'успешно', 'success', 'получатель', 'сумма', 'итого',
-                    'квитанция', 'receipt', 'статус', 'status', 'комиссия', 'commission'
-                ]
-                has_keywords = any(keyword in extracted_text_lower for keyword in payment_keywords)
+                # Check for payment keywords (single pass, same list as payment checks)
+                has_keywords = _has_payment_keywords(extracted_text_lower)
                 
                 # Prepare result
                 result_text = "🧪 <b>Результаты теста OCR:</b>\n\n"
@@ -2378,28 +2850,23 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 except:
                     pass
                 
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Тест еще раз", callback_data="admin_test_ocr")],
-                    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-                ]
-                
                 await update.message.reply_text(
                     result_text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=_OCR_TEST_AGAIN_MARKUP,
                     parse_mode='HTML'
                 )
                 
                 # Clean up session
-                if user_id in user_sessions:
-                    del user_sessions[user_id]
+                user_sessions.pop(user_id, None)
                 
                 return ConversationHandler.END
             except Exception as e:
-                logger.error(f"Error in admin OCR test: {e}", exc_info=True)
-                try:
-                    await loading_msg.delete()
-                except:
-                    pass
+                logger.error("Error in admin OCR test: %s", e, exc_info=True)
+                if loading_msg:
+                    try:
+                        await loading_msg.delete()
+                    except:
+                        pass
                 
                 error_msg = str(e)
                 help_text = ""
@@ -2412,18 +2879,16 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "4. Перезапустите бота после установки"
                     )
                 
-                keyboard = [
-                    [InlineKeyboardButton("🔄 Попробовать еще раз", callback_data="admin_test_ocr")],
-                    [InlineKeyboardButton("◀️ Назад", callback_data="back_to_menu")]
-                ]
-                
                 await update.message.reply_text(
                     f"❌ <b>Ошибка теста OCR:</b>\n\n{error_msg}{help_text}\n\n"
                     f"Попробуйте еще раз или нажмите /cancel.",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=_OCR_RETRY_MARKUP,
                     parse_mode='HTML'
                 )
                 return ADMIN_TEST_OCR
+            finally:
+                # Not awaited if sending the loading message failed
+                download.cancel()
         else:
             await update.message.reply_text(
                 "❌ Пожалуйста, отправьте изображение (фото).\n\n"
@@ -2432,32 +2897,30 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ADMIN_TEST_OCR
     
     # Handle payment screenshot
-    if user_id in user_sessions and user_sessions[user_id].get('waiting_for') == 'payment_screenshot':
+    if waiting_for == 'payment_screenshot':
         if update.message.photo:
             # User sent payment screenshot
             photo = update.message.photo[-1]
             screenshot_file_id = photo.file_id
             
             session = user_sessions[user_id]
-            amount = session.get('topup_amount', 0)
-            
-            # Download and analyze screenshot (if OCR available)
-            if OCR_AVAILABLE and PIL_AVAILABLE:
-                loading_msg = await update.message.reply_text("🔍 Анализирую скриншот...")
-            else:
-                loading_msg = await update.message.reply_text("⏳ Обрабатываю платеж...")
+            amount = session.topup_amount
             
+            # Download and analyze screenshot (if OCR available); the download
+            # runs while the loading message is being sent
+            download = asyncio.create_task(download_telegram_file(context.bot, photo.file_id))
+            loading_msg = None
             try:
-                file = await context.bot.get_file(photo.file_id)
-                image_data = await file.download_as_bytearray()
-                
-                # Get expected phone from .env
-                expected_phone = os.getenv('PAYMENT_PHONE', '')
+                if PIL_AVAILABLE and _ensure_tesseract():
+                    loading_msg = await update.message.reply_text("🔍 Анализирую скриншот...")
+                else:
+                    loading_msg = await update.message.reply_text("⏳ Обрабатываю платеж...")
+                image_data = await download
                 
                 # Analyze screenshot (only if OCR available)
                 analysis_msg = None
-                if OCR_AVAILABLE and PIL_AVAILABLE:
-                    analysis = await analyze_payment_screenshot(image_data, amount, expected_phone if expected_phone else None)
+                if PIL_AVAILABLE and _ensure_tesseract():
+                    analysis = await analyze_payment_screenshot(image_data, amount, PAYMENT_PHONE or None)
                     
                     # Delete loading message
                     try:
@@ -2494,7 +2957,7 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # Add payment and auto-credit balance
                 payment = add_payment(user_id, amount, screenshot_file_id)
                 new_balance = get_user_balance(user_id)
-                balance_str = f"{new_balance:.2f}".rstrip('0').rstrip('.')
+                balance_str = format_rub(new_balance)
                 
                 # Delete analysis message (if exists)
                 if analysis_msg:
@@ -2516,11 +2979,12 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return ConversationHandler.END
                 
             except Exception as e:
-                logger.error(f"Error processing payment screenshot: {e}", exc_info=True)
-                try:
-                    await loading_msg.delete()
-                except:
-                    pass
+                logger.error("Error processing payment screenshot: %s", e, exc_info=True)
+                if loading_msg:
+                    try:
+                        await loading_msg.delete()
+                    except:
+                        pass
                 await update.message.reply_text(
                     f"❌ <b>Ошибка обработки скриншота</b>\n\n"
                     f"Попробуйте отправить скриншот еще раз.\n"
@@ -2528,6 +2992,9 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
                 return WAITING_PAYMENT_SCREENSHOT
+            finally:
+                # Not awaited if sending the loading message failed
+                download.cancel()
         else:
             await update.message.reply_text(
                 "❌ Пожалуйста, отправьте скриншот перевода (фото).\n\n"
@@ -2536,7 +3003,7 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return WAITING_PAYMENT_SCREENSHOT
     
     # Handle custom topup amount input
-    if user_id in user_sessions and user_sessions[user_id].get('waiting_for') == 'topup_amount_input':
+    if waiting_for == 'topup_amount_input':
         try:
             amount = float(update.message.text.replace(',', '.'))
             
@@ -2549,21 +3016,17 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return SELECTING_AMOUNT
             
             # Set amount and show payment details
-            user_sessions[user_id]['topup_amount'] = amount
-            user_sessions[user_id]['waiting_for'] = 'payment_screenshot'
+            user_sessions[user_id].topup_amount = amount
+            user_sessions[user_id].waiting_for = 'payment_screenshot'
             
             payment_details = get_payment_details()
             
-            keyboard = [
-                [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-            ]
-            
             await update.message.reply_text(
                 f"{payment_details}\n\n"
                 f"💵 <b>Сумма к оплате:</b> {amount:.2f} ₽\n\n"
                 f"После оплаты отправьте скриншот перевода в этот чат.\n\n"
                 f"✅ <b>Баланс начислится автоматически</b> после отправки скриншота.",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=_CANCEL_MARKUP,
                 parse_mode='HTML'
             )
             return WAITING_PAYMENT_SCREENSHOT
@@ -2574,20 +3037,20 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return SELECTING_AMOUNT
     
-    if user_id not in user_sessions:
+    session = user_sessions.get(user_id)
+    if session is None:
         await update.message.reply_text("❌ Сессия не найдена. Начните заново с /start")
         return ConversationHandler.END
     
-    session = user_sessions[user_id]
-    properties = session.get('properties', {})
+    properties = session.properties
     
     # Handle image input (for image_input or image_urls)
-    waiting_for_image = session.get('waiting_for') in ['image_input', 'image_urls']
+    waiting_for_image = session.waiting_for in ['image_input', 'image_urls']
     if update.message.photo and waiting_for_image:
         photo = update.message.photo[-1]  # Get largest photo
-        file = await context.bot.get_file(photo.file_id)
         
-        # Download image from Telegram
+        # Download image from Telegram while the loading message is being sent
+        download = asyncio.create_task(download_telegram_file(context.bot, photo.file_id))
         loading_msg = None
         try:
             # Show loading message
@@ -2595,9 +3058,9 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             # Download image
             try:
-                image_data = await file.download_as_bytearray()
+                image_data = await download
             except Exception as e:
-                logger.error(f"Error downloading file from Telegram: {e}", exc_info=True)
+                logger.error("Error downloading file from Telegram: %s", e, exc_info=True)
                 if loading_msg:
                     try:
                         await loading_msg.delete()
@@ -2640,7 +3103,7 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return INPUTTING_PARAMS
             
-            logger.info(f"Downloaded image: {len(image_data)} bytes")
+            logger.info("Downloaded image: %s bytes", len(image_data))
             
             # Upload to public hosting
             public_url = await upload_image_to_hosting(image_data, filename=f"image_{user_id}_{photo.file_id[:8]}.jpg")
@@ -2661,17 +3124,13 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return INPUTTING_PARAMS
             
-            logger.info(f"Successfully uploaded image to: {public_url}")
+            logger.info("Successfully uploaded image to: %s", public_url)
             
-            # Add to image_input array
-            # Determine which parameter name to use
-            image_param_name = session.get('waiting_for', 'image_input')  # image_input or image_urls
-            if image_param_name not in session:
-                session[image_param_name] = []
-            session[image_param_name].append(public_url)
+            # Add to the image array (stored under waiting_for: image_input or image_urls)
+            session.images.append(public_url)
             
         except Exception as e:
-            logger.error(f"Error processing image: {e}", exc_info=True)
+            logger.error("Error processing image: %s", e, exc_info=True)
             # Try to delete loading message if exists
             if loading_msg:
                 try:
@@ -2686,35 +3145,35 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='HTML'
             )
             return INPUTTING_PARAMS
+        finally:
+            # Not awaited if sending the loading message failed
+            download.cancel()
         
-        image_param_name = session.get('waiting_for', 'image_input')
-        image_count = len(session[image_param_name])
+        image_param_name = session.waiting_for or 'image_input'  # image_input or image_urls
+        image_count = len(session.images)
         
         if image_count < 8:
-            keyboard = [
-                [InlineKeyboardButton("📷 Добавить еще", callback_data="add_image")],
-                [InlineKeyboardButton("✅ Готово", callback_data="image_done")]
-            ]
             await update.message.reply_text(
                 f"✅ Изображение {image_count} добавлено!\n\n"
                 f"Загружено: {image_count}/8\n\n"
                 f"Добавить еще изображение или продолжить?",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=_MORE_IMAGES_MARKUP
             )
         else:
-            await update.message.reply_text(
+            await _send_text(
+                context.bot, update.message.chat_id,
                 f"✅ Изображение {image_count} добавлено!\n\n"
                 f"Достигнут максимум (8 изображений). Продолжаю..."
             )
-            session['params'][image_param_name] = session[image_param_name]
-            session['waiting_for'] = None
+            session.params[image_param_name] = session.images
+            session.waiting_for = None
             # Move to next parameter
             try:
                 next_param_result = await start_next_parameter(update, context, user_id)
                 if next_param_result:
                     return next_param_result
             except Exception as e:
-                logger.error(f"Error after image input: {e}")
+                logger.error("Error after image input: %s", e)
         
         return INPUTTING_PARAMS
     
@@ -2726,9 +3185,9 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     
     # If waiting for text input (prompt or other text parameter)
-    waiting_for = session.get('waiting_for')
+    waiting_for = session.waiting_for
     if waiting_for:
-        current_param = session.get('current_param', waiting_for)
+        current_param = session.current_param or waiting_for
         param_info = properties.get(current_param, {})
         max_length = param_info.get('max_length')
         
@@ -2740,20 +3199,22 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return INPUTTING_PARAMS
         
         # Set parameter value
-        session['params'][current_param] = text
-        session['waiting_for'] = None
-        session['current_param'] = None
-        
-        # Confirm parameter was set
-        await update.message.reply_text(
+        session.params[current_param] = text
+        session.waiting_for = None
+        session.current_param = None
+        
+        # Confirm parameter was set; a text prompt for the next parameter
+        # sent right after it is batched with it
+        chat_id = update.message.chat_id
+        await _send_text(
+            context.bot, chat_id,
             f"✅ <b>{current_param}</b> установлен!\n\n"
-            f"Значение: {text[:100]}{'...' if len(text) > 100 else ''}",
-            parse_mode='HTML'
+            f"Значение: {text[:100]}{'...' if len(text) > 100 else ''}"
         )
         
         # If prompt was entered and model supports image input, offer to add image
-        if current_param == 'prompt' and session.get('has_image_input'):
-            model_info = session.get('model_info', {})
+        if current_param == 'prompt' and session.has_image_input:
+            model_info = session.model_info
             input_params = model_info.get('input_params', {})
             # Check if image is required (for image_urls or image_input)
             image_required = False
@@ -2762,67 +3223,49 @@ async def input_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif 'image_input' in input_params:
                 image_required = input_params['image_input'].get('required', False)
             
+            await outbound.flush(chat_id)
             if image_required:
                 # Image is required - show button without skip option
-                keyboard = [
-                    [InlineKeyboardButton("📷 Загрузить изображение", callback_data="add_image")]
-                ]
                 await update.message.reply_text(
                     "📷 <b>Загрузите изображение для редактирования</b>\n\n"
                     "Отправьте фото, которое хотите отредактировать.",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=_UPLOAD_IMAGE_MARKUP,
                     parse_mode='HTML'
                 )
             else:
                 # Image is optional - show button with skip option
-                keyboard = [
-                    [InlineKeyboardButton("📷 Добавить изображение", callback_data="add_image")],
-                    [InlineKeyboardButton("⏭️ Пропустить", callback_data="skip_image")]
-                ]
                 await update.message.reply_text(
                     "📷 <b>Хотите добавить изображение?</b>\n\n"
                     "Вы можете загрузить изображение для использования как референс или для трансформации.\n"
                     "Или пропустите этот шаг.",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=_ADD_OR_SKIP_IMAGE_MARKUP,
                     parse_mode='HTML'
                 )
             return INPUTTING_PARAMS
         
         # Check if there are more parameters
-        required = session.get('required', [])
-        params = session.get('params', {})
+        required = session.required
+        params = session.params
         missing = [p for p in required if p not in params and p not in ['prompt', 'image_input', 'image_urls']]
         
         if missing:
             # Move to next parameter
             try:
-                # Small delay to show confirmation
-                await asyncio.sleep(0.5)
                 next_param_result = await start_next_parameter(update, context, user_id)
                 if next_param_result:
                     return next_param_result
             except Exception as e:
-                logger.error(f"Error starting next parameter: {e}", exc_info=True)
+                logger.error("Error starting next parameter: %s", e, exc_info=True)
                 await update.message.reply_text(
                     f"❌ Ошибка при переходе к следующему параметру: {str(e)}"
                 )
                 return INPUTTING_PARAMS
         else:
             # All parameters collected, show confirmation
-            model_name = session.get('model_info', {}).get('name', 'Unknown')
-            params_text = "\n".join([f"  • {k}: {str(v)[:50]}..." for k, v in params.items()])
-            
-            keyboard = [
-                [InlineKeyboardButton("✅ Генерировать", callback_data="confirm_generate")],
-                [InlineKeyboardButton("❌ Отмена", callback_data="cancel")]
-            ]
-            
+            await outbound.flush(chat_id)
             await update.message.reply_text(
-                f"📋 <b>Подтверждение:</b>\n\n"
-                f"Модель: <b>{model_name}</b>\n"
-                f"Параметры:\n{params_text}\n\n"
-                f"Продолжить генерацию?",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                _confirmation_text(session),
+                reply_markup=_CONFIRM_MARKUP,
                 parse_mode='HTML'
             )
             return CONFIRMING_GENERATION
@@ -2843,10 +3286,10 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     
     user_id = update.effective_user.id
-    is_admin_user = get_is_admin(user_id)
+    user_balance, is_admin_user, blocked = get_user_context(user_id)
     
     # Check if user is blocked
-    if not is_admin_user and is_user_blocked(user_id):
+    if not is_admin_user and blocked:
         await query.edit_message_text(
             "❌ <b>Ваш аккаунт заблокирован</b>\n\n"
             "Обратитесь к администратору для разблокировки.",
@@ -2854,14 +3297,14 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return ConversationHandler.END
     
-    if user_id not in user_sessions:
+    session = user_sessions.get(user_id)
+    if session is None:
         await query.edit_message_text("❌ Сессия не найдена.")
         return ConversationHandler.END
     
-    session = user_sessions[user_id]
-    model_id = session.get('model_id')
-    params = session.get('params', {})
-    model_info = session.get('model_info', {})
+    model_id = session.model_id
+    params = session.params
+    model_info = session.model_info
     
     # Calculate price (admins pay admin price, users pay user price)
     price = calculate_price_rub(model_id, params, is_admin_user)
@@ -2869,10 +3312,9 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Check balance/limit before generation
     if not is_admin_user:
         # Regular user - check balance
-        user_balance = get_user_balance(user_id)
         if user_balance < price:
-            price_str = f"{price:.2f}".rstrip('0').rstrip('.')
-            balance_str = f"{user_balance:.2f}".rstrip('0').rstrip('.')
+            price_str = format_rub(price)
+            balance_str = format_rub(user_balance)
             await query.edit_message_text(
                 f"❌ <b>Недостаточно средств</b>\n\n"
                 f"💰 <b>Требуется:</b> {price_str} ₽\n"
@@ -2885,8 +3327,8 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Limited admin - check limit
         remaining = get_admin_remaining(user_id)
         if remaining < price:
-            price_str = f"{price:.2f}".rstrip('0').rstrip('.')
-            remaining_str = f"{remaining:.2f}".rstrip('0').rstrip('.')
+            price_str = format_rub(price)
+            remaining_str = format_rub(remaining)
             limit = get_admin_limit(user_id)
             spent = get_admin_spent(user_id)
             await query.edit_message_text(
@@ -2916,9 +3358,9 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
             task_id = result.get('taskId')
             
             # Store task ID for polling
-            session['task_id'] = task_id
-            session['poll_attempts'] = 0
-            session['max_poll_attempts'] = 60  # Poll for up to 5 minutes (60 * 5 seconds)
+            session.task_id = task_id
+            session.poll_attempts = 0
+            session.max_poll_attempts = 60  # Poll for up to 5 minutes (60 * 5 seconds)
             
             # Show Task ID only for admin
             if is_admin_user:
@@ -2947,18 +3389,16 @@ async def confirm_generation(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 parse_mode='HTML'
             )
             # Clean up session
-            if user_id in user_sessions:
-                del user_sessions[user_id]
+            user_sessions.pop(user_id, None)
     
     except Exception as e:
-        logger.error(f"Error during generation: {e}", exc_info=True)
+        logger.error("Error during generation: %s", e, exc_info=True)
         await query.edit_message_text(
             f"❌ <b>Произошла ошибка:</b>\n\n{str(e)}",
             parse_mode='HTML'
         )
         # Clean up session
-        if user_id in user_sessions:
-            del user_sessions[user_id]
+        user_sessions.pop(user_id, None)
     
     return ConversationHandler.END
 
@@ -2967,7 +3407,7 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
     """Poll task status until completion."""
     max_attempts = 60  # 5 minutes max
     attempt = 0
-    start_time = asyncio.get_event_loop().time()
+    start_time = time.monotonic()
     last_status_message = None
     
     while attempt < max_attempts:
@@ -2991,22 +3431,19 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
             if state == 'success':
                 # Task completed successfully - deduct balance
                 # Save session data before cleanup (for "generate again" button)
-                saved_session_data = None
                 model_id = ''
                 params = {}
-                if user_id in user_sessions:
-                    session = user_sessions[user_id]
-                    saved_session_data = {
-                        'model_id': session.get('model_id'),
-                        'model_info': session.get('model_info'),
-                        'params': session.get('params', {}).copy(),
-                        'properties': session.get('properties', {}).copy(),
-                        'required': session.get('required', []).copy()
-                    }
+                session = user_sessions.get(user_id)
+                if session is not None:
+                    if session.model_id:
+                        try:
+                            saved_generations.save(user_id, session.model_id, session.params)
+                        except Exception as e:
+                            logger.error("Error saving generation of user %s: %s", user_id, e)
                     
                     # Get price and deduct from balance or limit
-                    model_id = session.get('model_id', '')
-                    params = session.get('params', {})
+                    model_id = session.model_id or ''
+                    params = session.params
                     is_admin_user = get_is_admin(user_id)
                     price = calculate_price_rub(model_id, params, is_admin_user)
                     
@@ -3044,103 +3481,100 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
                         result_urls = result_data.get('resultUrls', [])
                     
                     # Prepare buttons for last message
-                    keyboard = [
-                        [InlineKeyboardButton("◀️ Вернуться в меню", callback_data="back_to_menu")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
+                    reply_markup = _RETURN_TO_MENU_MARKUP
                     
                     if result_urls:
                         # Send media (video or image) directly
                         for i, url in enumerate(result_urls[:5]):  # Limit to 5 items
                             try:
                                 # Try to download media and send it
-                                async with aiohttp.ClientSession() as session_http:
-                                    async with session_http.get(url, timeout=aiohttp.ClientTimeout(total=60)) as resp:
-                                        if resp.status == 200:
-                                            media_data = await resp.read()
+                                session_http = await get_http_session()
+                                async with session_http.get(url, timeout=aiohttp.ClientTimeout(total=60)) as resp:
+                                    if resp.status == 200:
+                                        media_data = await resp.read()
+                                        
+                                        # Add buttons only to the last item
+                                        is_last = (i == len(result_urls[:5]) - 1)
+                                        caption = "✅ <b>Генерация завершена!</b>" if i == 0 else None
+                                        
+                                        if is_video_model:
+                                            # Send as video
+                                            video_file = io.BytesIO(media_data)
+                                            video_file.name = f"generated_video_{i+1}.mp4"
                                             
-                                            # Add buttons only to the last item
-                                            is_last = (i == len(result_urls[:5]) - 1)
-                                            caption = "✅ <b>Генерация завершена!</b>" if i == 0 else None
+                                            if is_last:
+                                                last_message = await context.bot.send_video(
+                                                    chat_id=update.effective_chat.id,
+                                                    video=video_file,
+                                                    caption=caption,
+                                                    reply_markup=reply_markup,
+                                                    parse_mode='HTML'
+                                                )
+                                            else:
+                                                await context.bot.send_video(
+                                                    chat_id=update.effective_chat.id,
+                                                    video=video_file,
+                                                    caption=caption,
+                                                    parse_mode='HTML'
+                                                )
+                                        else:
+                                            # Send as image
+                                            photo_file = io.BytesIO(media_data)
+                                            photo_file.name = f"generated_image_{i+1}.png"
                                             
-                                            if is_video_model:
-                                                # Send as video
-                                                video_file = io.BytesIO(media_data)
-                                                video_file.name = f"generated_video_{i+1}.mp4"
-                                                
-                                                if is_last:
-                                                    last_message = await context.bot.send_video(
-                                                        chat_id=update.effective_chat.id,
-                                                        video=video_file,
-                                                        caption=caption,
-                                                        reply_markup=reply_markup,
-                                                        parse_mode='HTML'
-                                                    )
-                                                else:
-                                                    await context.bot.send_video(
-                                                        chat_id=update.effective_chat.id,
-                                                        video=video_file,
-                                                        caption=caption,
-                                                        parse_mode='HTML'
-                                                    )
+                                            if is_last:
+                                                last_message = await context.bot.send_photo(
+                                                    chat_id=update.effective_chat.id,
+                                                    photo=photo_file,
+                                                    caption=caption,
+                                                    reply_markup=reply_markup,
+                                                    parse_mode='HTML'
+                                                )
                                             else:
-                                                # Send as image
-                                                photo_file = io.BytesIO(media_data)
-                                                photo_file.name = f"generated_image_{i+1}.png"
-                                                
-                                                if is_last:
-                                                    last_message = await context.bot.send_photo(
-                                                        chat_id=update.effective_chat.id,
-                                                        photo=photo_file,
-                                                        caption=caption,
-                                                        reply_markup=reply_markup,
-                                                        parse_mode='HTML'
-                                                    )
-                                                else:
-                                                    await context.bot.send_photo(
-                                                        chat_id=update.effective_chat.id,
-                                                        photo=photo_file,
-                                                        caption=caption,
-                                                        parse_mode='HTML'
-                                                    )
+                                                await context.bot.send_photo(
+                                                    chat_id=update.effective_chat.id,
+                                                    photo=photo_file,
+                                                    caption=caption,
+                                                    parse_mode='HTML'
+                                                )
+                                    else:
+                                        # If download fails, try sending URL directly
+                                        if is_video_model:
+                                            if i == len(result_urls[:5]) - 1:
+                                                last_message = await context.bot.send_video(
+                                                    chat_id=update.effective_chat.id,
+                                                    video=url,
+                                                    caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
+                                                    reply_markup=reply_markup,
+                                                    parse_mode='HTML'
+                                                )
+                                            else:
+                                                await context.bot.send_video(
+                                                    chat_id=update.effective_chat.id,
+                                                    video=url,
+                                                    caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
+                                                    parse_mode='HTML'
+                                                )
                                         else:
-                                            # If download fails, try sending URL directly
-                                            if is_video_model:
-                                                if i == len(result_urls[:5]) - 1:
-                                                    last_message = await context.bot.send_video(
-                                                        chat_id=update.effective_chat.id,
-                                                        video=url,
-                                                        caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
-                                                        reply_markup=reply_markup,
-                                                        parse_mode='HTML'
-                                                    )
-                                                else:
-                                                    await context.bot.send_video(
-                                                        chat_id=update.effective_chat.id,
-                                                        video=url,
-                                                        caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
-                                                        parse_mode='HTML'
-                                                    )
+                                            if i == len(result_urls[:5]) - 1:
+                                                last_message = await context.bot.send_photo(
+                                                    chat_id=update.effective_chat.id,
+                                                    photo=url,
+                                                    caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
+                                                    reply_markup=reply_markup,
+                                                    parse_mode='HTML'
+                                                )
                                             else:
-                                                if i == len(result_urls[:5]) - 1:
-                                                    last_message = await context.bot.send_photo(
-                                                        chat_id=update.effective_chat.id,
-                                                        photo=url,
-                                                        caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
-                                                        reply_markup=reply_markup,
-                                                        parse_mode='HTML'
-                                                    )
-                                                else:
-                                                    await context.bot.send_photo(
-                                                        chat_id=update.effective_chat.id,
-                                                        photo=url,
-                                                        caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
-                                                        parse_mode='HTML'
-                                                    )
+                                                await context.bot.send_photo(
+                                                    chat_id=update.effective_chat.id,
+                                                    photo=url,
+                                                    caption="✅ <b>Генерация завершена!</b>" if i == 0 else None,
+                                                    parse_mode='HTML'
+                                                )
                             except Exception as e:
                                 # If all methods fail, try sending URL directly as last resort
                                 media_type = "video" if is_video_model else "photo"
-                                logger.warning(f"Failed to send {media_type} {url}: {e}")
+                                logger.warning("Failed to send %s %s: %s", media_type, url, e)
                                 try:
                                     is_last = (i == len(result_urls[:5]) - 1)
                                     if is_video_model:
@@ -3176,7 +3610,7 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
                                                 parse_mode='HTML'
                                             )
                                 except Exception as e2:
-                                    logger.error(f"Failed to send {media_type} even via URL: {e2}")
+                                    logger.error("Failed to send %s even via URL: %s", media_type, e2)
                                     # Last resort: send as message
                                     is_last = (i == len(result_urls[:5]) - 1)
                                     media_name = "Видео" if is_video_model else "Изображение"
@@ -3209,8 +3643,7 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
                     )
                 
                 # Clean up session
-                if user_id in user_sessions:
-                    del user_sessions[user_id]
+                user_sessions.pop(user_id, None)
                 break
             
             elif state == 'fail':
@@ -3230,15 +3663,14 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
                 )
                 
                 # Clean up session
-                if user_id in user_sessions:
-                    del user_sessions[user_id]
+                user_sessions.pop(user_id, None)
                 break
             
             elif state in ['waiting', 'queuing', 'generating']:
                 # Still processing, continue polling
                 # Update status every 30 seconds (6 attempts * 5 seconds)
                 if attempt % 6 == 0:
-                    elapsed_time = int(asyncio.get_event_loop().time() - start_time)
+                    elapsed_time = int(time.monotonic() - start_time)
                     minutes = elapsed_time // 60
                     seconds = elapsed_time % 60
                     
@@ -3283,7 +3715,7 @@ async def poll_task_status(update: Update, context: ContextTypes.DEFAULT_TYPE, t
                 continue
         
         except Exception as e:
-            logger.error(f"Error polling task status: {e}", exc_info=True)
+            logger.error("Error polling task status: %s", e, exc_info=True)
             if attempt >= max_attempts:
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
@@ -3311,44 +3743,35 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Check if limited admin
     is_limited_admin = is_admin(user_id) and not is_main_admin
-    balance_str = f"{user_balance:.2f}".rstrip('0').rstrip('.')
+    balance_str = format_rub(user_balance)
     
     if is_limited_admin:
         # Limited admin - show limit info
         limit = get_admin_limit(user_id)
         spent = get_admin_spent(user_id)
         remaining = get_admin_remaining(user_id)
-        keyboard = [
-            [InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_menu")]
-        ]
-        
         await update.message.reply_text(
             f'👑 <b>Админ с лимитом</b>\n\n'
             f'💳 <b>Лимит:</b> {limit:.2f} ₽\n'
             f'💸 <b>Потрачено:</b> {spent:.2f} ₽\n'
             f'✅ <b>Осталось:</b> {remaining:.2f} ₽\n\n'
             f'💰 <b>Баланс пользователя:</b> {balance_str} ₽',
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_BACK_TO_MENU_MARKUP,
             parse_mode='HTML'
         )
     elif is_main_admin:
         # Main admin sees both user balance and KIE credits
         try:
-            result = await kie.get_credits()
+            result = await get_kie_credits()
             if result.get('ok'):
                 credits = result.get('credits', 0)
-                credits_rub = credits * CREDIT_TO_USD * USD_TO_RUB
-                credits_rub_str = f"{credits_rub:.2f}".rstrip('0').rstrip('.')
-                keyboard = [
-                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-                    [InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_menu")]
-                ]
-                
+                credits_rub = credits * CREDIT_RATE
+                credits_rub_str = format_rub(credits_rub)
                 await update.message.reply_text(
                     f'💳 <b>Ваш баланс:</b> {balance_str} ₽\n\n'
                     f'🔧 <b>API баланс:</b> {credits_rub_str} ₽\n'
                     f'<i>({credits} кредитов)</i>',
-                    reply_markup=InlineKeyboardMarkup(keyboard),
+                    reply_markup=_TOPUP_OR_MENU_MARKUP,
                     parse_mode='HTML'
                 )
             else:
@@ -3358,7 +3781,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     parse_mode='HTML'
                 )
         except Exception as e:
-            logger.error(f"Error checking KIE balance: {e}")
+            logger.error("Error checking KIE balance: %s", e)
             await update.message.reply_text(
                 f'💳 <b>Ваш баланс:</b> {balance_str} ₽\n\n'
                     f'⚠️ API баланс недоступен',
@@ -3366,15 +3789,10 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     else:
         # Regular user sees only their balance
-        keyboard = [
-            [InlineKeyboardButton("💳 Пополнить баланс", callback_data="topup_balance")],
-            [InlineKeyboardButton("◀️ Назад в меню", callback_data="back_to_menu")]
-        ]
-        
         await update.message.reply_text(
             f'💳 <b>Ваш баланс:</b> {balance_str} ₽\n\n'
             f'Доступно для генерации контента.',
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_TOPUP_OR_MENU_MARKUP,
             parse_mode='HTML'
         )
 
@@ -3382,8 +3800,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the current operation."""
     user_id = update.effective_user.id
-    if user_id in user_sessions:
-        del user_sessions[user_id]
+    user_sessions.pop(user_id, None)
     
     await update.message.reply_text("❌ Операция отменена.")
     return ConversationHandler.END
@@ -3398,7 +3815,7 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('Пожалуйста, укажите запрос. Использование: /search [запрос]')
         return
     
-    results = storage.search_entries(query)
+    results = await storage.search_entries_async(context.args)
     
     if results:
         response = f'Найдено {len(results)} результат(ов) для "{query}":\n\n'
@@ -3418,7 +3835,7 @@ async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('Пожалуйста, задайте вопрос. Использование: /ask [вопрос]')
         return
     
-    results = storage.search_entries(question)
+    results = await storage.search_entries_async(context.args)
     
     if results:
         response = f'По вашему вопросу "{question}":\n\n'
@@ -3455,7 +3872,7 @@ async def add_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('Пожалуйста, укажите знание для добавления. Использование: /add [знание]')
         return
     
-    success = storage.add_entry(knowledge, update.effective_user.id)
+    success = await storage.add_entry_async(knowledge, update.effective_user.id)
     
     if success:
         await update.message.reply_text(f'✅ Знание добавлено: "{knowledge[:50]}..."')
@@ -3463,6 +3880,27 @@ async def add_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('❌ Не удалось добавить знание.')
 
 
+async def _post_stop(application):
+    """Send texts still waiting in the outbound batcher while the bot can still send."""
+    await outbound.flush_all()
+
+
+async def _post_shutdown(application):
+    """Release resources held outside of the Application."""
+    if _json_flush_task is not None:
+        _json_flush_task.cancel()
+    if _json_write is not None:
+        # Let a write already running in its thread finish first, so it can't
+        # replace a file with an older snapshot after the final flush
+        failed = await _json_write
+        _json_dirty.update(failed)
+    flush_json_files()
+    await kie.close()
+    await close_http_session()
+    storage.close()
+    saved_generations.close()
+
+
 def main():
     """Start the bot."""
     if not BOT_TOKEN:
@@ -3470,16 +3908,30 @@ def main():
         return
     
     # Verify models are loaded correctly
-    categories = get_categories()
+    categories = CATEGORIES
     sora_models = [m for m in KIE_MODELS if m['id'] == 'sora-watermark-remover']
-    logger.info(f"Bot starting with {len(KIE_MODELS)} models in {len(categories)} categories: {categories}")
+    logger.info("Bot starting with %s models in %s categories: %s", TOTAL_MODELS, len(categories), categories)
     if sora_models:
-        logger.info(f"✅ Sora model loaded: {sora_models[0]['name']} ({sora_models[0]['category']})")
+        logger.info("✅ Sora model loaded: %s (%s)", sora_models[0]['name'], sora_models[0]['category'])
     else:
-        logger.warning(f"⚠️  Sora model NOT found! Available models: {[m['id'] for m in KIE_MODELS]}")
+        logger.warning("⚠️  Sora model NOT found! Available models: %s", [m['id'] for m in KIE_MODELS])
+    
+    if UVLOOP_AVAILABLE:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(TelegramRateLimiter())
+        # Handle updates from different users in parallel, so one user's OCR
+        # or image upload doesn't hold up everyone else; each user's own
+        # updates still run one at a time
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
     
     # Create conversation handler for generation
     generation_handler = ConversationHandler(
@@ -3580,7 +4032,7 @@ def main():
         # Show last 10 payments
         total_amount = stats['total_amount']
         total_count = stats['total_count']
-        total_str = f"{total_amount:.2f}".rstrip('0').rstrip('.')
+        total_str = format_rub(total_amount)
         
         text = f"📊 <b>Статистика платежей:</b>\n\n"
         text += f"💰 <b>Всего:</b> {total_str} ₽\n"
@@ -3592,7 +4044,7 @@ def main():
             user_id = payment.get('user_id', 0)
             amount = payment.get('amount', 0)
             timestamp = payment.get('timestamp', 0)
-            amount_str = f"{amount:.2f}".rstrip('0').rstrip('.')
+            amount_str = format_rub(amount)
             
             if timestamp:
                 dt = datetime.datetime.fromtimestamp(timestamp)
@@ -3653,15 +4105,14 @@ def main():
         
         try:
             user_id = int(context.args[0])
-            balance = get_user_balance(user_id)
-            balance_str = f"{balance:.2f}".rstrip('0').rstrip('.')
-            is_blocked = is_user_blocked(user_id)
+            balance, _, is_blocked = get_user_context(user_id)
+            balance_str = format_rub(balance)
             blocked_text = "🔒 Заблокирован" if is_blocked else "✅ Активен"
             
             # Get user payments
             user_payments = get_user_payments(user_id)
             total_paid = sum(p.get('amount', 0) for p in user_payments)
-            total_paid_str = f"{total_paid:.2f}".rstrip('0').rstrip('.')
+            total_paid_str = format_rub(total_paid)
             
             # Check if user is limited admin
             admin_info = ""
@@ -3713,7 +4164,6 @@ def main():
                 return
             
             # Add admin with 100 rubles limit
-            import time
             admin_limits[str(new_admin_id)] = {
                 'limit': 100.0,
                 'spent': 0.0,
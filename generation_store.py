@@ -0,0 +1,90 @@
+"""
+Persistent storage of each user's last generation for the "generate again" button
+Kept in SQLite so the data survives bot restarts
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationStore:
+    """
+    user_id -> model_id and params of the user's last successful generation.
+
+    Only the model id and the user's params are stored; the model description
+    comes from KIE_MODELS when the row is read back. Rows older than ttl
+    seconds are ignored and deleted on the next sweep.
+    """
+
+    # Run an expiry sweep every this many saves
+    SWEEP_EVERY = 500
+
+    def __init__(self, path: str = "saved_generations.db", ttl: float = 86400):
+        self.path = path
+        self.ttl = ttl
+        self._saves = 0
+        # One connection shared under a lock; statements are single-row
+        # primary key lookups, so they are fast enough to run inline
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS saved_generations ("
+            "user_id INTEGER PRIMARY KEY, model_id TEXT NOT NULL, "
+            "params TEXT NOT NULL, saved_at REAL NOT NULL)"
+        )
+        self.expire()
+
+    def save(self, user_id: int, model_id: str, params: Dict):
+        """Remember the model and params of a user's generation."""
+        payload = json.dumps(params, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO saved_generations (user_id, model_id, params, saved_at) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, model_id, payload, time.time())
+            )
+            self._saves += 1
+            sweep = self._saves % self.SWEEP_EVERY == 0
+        if sweep:
+            self.expire()
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """Return {'model_id', 'params'} of the user's last generation, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT model_id, params FROM saved_generations WHERE user_id = ? AND saved_at >= ?",
+                (user_id, time.time() - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            params = json.loads(row[1])
+        except ValueError as e:
+            logger.warning("Discarding unreadable saved generation of user %s: %s", user_id, e)
+            return None
+        return {'model_id': row[0], 'params': params}
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def expire(self) -> int:
+        """Delete rows older than ttl; returns how many were removed."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM saved_generations WHERE saved_at < ?",
+                (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._conn.close()
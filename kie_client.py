@@ -9,12 +9,15 @@ Configure the API endpoint and API key via environment variables:
 The exact endpoints may vary for your KIE deployment; this client keeps
 URLs configurable and handles common operations: list models, get model,
 invoke model. If no API key is present, methods return helpful messages
-instead of raising.
+instead of raising. Errors of requests that got no response from KIE
+(timeouts, connection failures) are marked with 'network': True.
 """
 import os
+import time
 import aiohttp
 import asyncio
 import logging
+from collections import deque
 from typing import Any, Dict, List, Optional
 from dotenv import load_dotenv
 
@@ -24,11 +27,102 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+class CircuitBreaker:
+    """
+    Fail fast while a remote service keeps failing.
+
+    After failure_threshold failures within failure_window seconds the breaker
+    opens and allow() returns False for reset_timeout seconds. After that a
+    single trial call is let through (half-open); its outcome closes the
+    breaker again or keeps it open for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int = 5, failure_window: float = 30.0,
+                 reset_timeout: float = 15.0):
+        self.failure_threshold = failure_threshold
+        self.failure_window = failure_window
+        self.reset_timeout = reset_timeout
+        self._failures = deque()
+        self._opened_at: Optional[float] = None
+        self._trial_started: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self) -> bool:
+        """Return True if a call may be attempted now."""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'open':
+            return False
+        # Only one trial at a time; a trial that never reported back (e.g. a
+        # cancelled call) stops blocking new ones after reset_timeout
+        now = time.monotonic()
+        if self._trial_started is not None and now - self._trial_started < self.reset_timeout:
+            return False
+        self._trial_started = now
+        return True
+
+    def record_success(self):
+        self._failures.clear()
+        self._opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        now = time.monotonic()
+        self._trial_started = None
+        if self._opened_at is not None:
+            # The half-open trial failed, stay open for another period
+            self._opened_at = now
+            return
+        self._failures.append(now)
+        while self._failures and now - self._failures[0] > self.failure_window:
+            self._failures.popleft()
+        if len(self._failures) >= self.failure_threshold:
+            logger.warning("KIE circuit breaker opened after %d failures", len(self._failures))
+            self._opened_at = now
+            self._failures.clear()
+
+
 class KIEClient:
     def __init__(self):
         self.base_url = os.getenv('KIE_API_URL', 'https://api.kie.ai').rstrip('/')
         self.api_key = os.getenv('KIE_API_KEY')
         self.timeout = int(os.getenv('KIE_TIMEOUT_SECONDS', '30'))
+        # Long-lived HTTP session so repeated calls reuse pooled keep-alive
+        # connections instead of paying a new TCP + TLS handshake each time
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_loop = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=50,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=30
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """Close the shared HTTP session (call on application shutdown)."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
 
     def _headers(self) -> Dict[str, str]:
         headers = {
@@ -56,53 +150,53 @@ class KIEClient:
         last_error = None
         for url, method in endpoints:
             try:
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                    if method == "POST":
-                        async with s.post(url, headers=self._headers(), json={}) as resp:
-                            text = await resp.text()
-                            status = resp.status
-                    else:
-                        async with s.get(url, headers=self._headers()) as resp:
-                            text = await resp.text()
-                            status = resp.status
-                    
-                    if status == 200:
-                        # Success! Parse response
-                        try:
-                            data = await resp.json()
-                            # Check if response is a list or dict with models
-                            if isinstance(data, list):
-                                return data
-                            elif isinstance(data, dict):
-                                # Some APIs return models in a 'data' or 'models' field
-                                if 'data' in data:
-                                    return data['data']
-                                elif 'models' in data:
-                                    return data['models']
-                                elif 'items' in data:
-                                    return data['items']
-                                elif 'result' in data:
-                                    result = data['result']
-                                    if isinstance(result, list):
-                                        return result
-                                else:
-                                    # Return as single item in list
-                                    return [data]
-                            return []
-                        except Exception as e:
-                            raise RuntimeError(f'Failed to parse response: {e} - Response: {text[:200]}')
-                    elif status == 404:
-                        # Try next endpoint
-                        continue
-                    else:
-                        # Try to parse error
-                        try:
-                            error_json = await resp.json()
-                            error_msg = str(error_json)
-                        except:
-                            error_msg = text[:200]
-                        last_error = f'Status {status}: {error_msg}'
-                        continue
+                s = await self._get_session()
+                if method == "POST":
+                    async with s.post(url, headers=self._headers(), json={}) as resp:
+                        text = await resp.text()
+                        status = resp.status
+                else:
+                    async with s.get(url, headers=self._headers()) as resp:
+                        text = await resp.text()
+                        status = resp.status
+
+                if status == 200:
+                    # Success! Parse response
+                    try:
+                        data = await resp.json()
+                        # Check if response is a list or dict with models
+                        if isinstance(data, list):
+                            return data
+                        elif isinstance(data, dict):
+                            # Some APIs return models in a 'data' or 'models' field
+                            if 'data' in data:
+                                return data['data']
+                            elif 'models' in data:
+                                return data['models']
+                            elif 'items' in data:
+                                return data['items']
+                            elif 'result' in data:
+                                result = data['result']
+                                if isinstance(result, list):
+                                    return result
+                            else:
+                                # Return as single item in list
+                                return [data]
+                        return []
+                    except Exception as e:
+                        raise RuntimeError(f'Failed to parse response: {e} - Response: {text[:200]}')
+                elif status == 404:
+                    # Try next endpoint
+                    continue
+                else:
+                    # Try to parse error
+                    try:
+                        error_json = await resp.json()
+                        error_msg = str(error_json)
+                    except:
+                        error_msg = text[:200]
+                    last_error = f'Status {status}: {error_msg}'
+                    continue
             except aiohttp.ClientError as e:
                 last_error = f'Network error: {str(e)}'
                 continue
@@ -112,7 +206,7 @@ class KIEClient:
         
         # All endpoints failed - return empty list instead of raising
         # This allows bot to work even if API is temporarily unavailable
-        logger.warning(f'KIE list_models failed on all endpoints. Last error: {last_error}')
+        logger.warning('KIE list_models failed on all endpoints. Last error: %s', last_error)
         return []
 
     async def get_model(self, model_id: str) -> Optional[Dict[str, Any]]:
@@ -126,13 +220,13 @@ class KIEClient:
         ]
         for url in endpoints:
             try:
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                    async with s.get(url, headers=self._headers()) as resp:
-                        if resp.status == 200:
-                            return await resp.json()
-                        elif resp.status != 404:
-                            # Try next endpoint
-                            continue
+                s = await self._get_session()
+                async with s.get(url, headers=self._headers()) as resp:
+                    if resp.status == 200:
+                        return await resp.json()
+                    elif resp.status != 404:
+                        # Try next endpoint
+                        continue
             except Exception:
                 continue
         return None
@@ -147,34 +241,34 @@ class KIEClient:
         
         url = f"{self.base_url}/api/v1/chat/credit"
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                async with s.get(url, headers=self._headers()) as resp:
-                    text = await resp.text()
-                    if resp.status == 200:
-                        try:
-                            data = await resp.json()
-                            # Handle response format: {"code": 200, "msg": "success", "data": 100}
-                            if isinstance(data, dict):
-                                if data.get('code') == 200:
-                                    credits = data.get('data', 0)
-                                    return {'ok': True, 'credits': credits}
-                                else:
-                                    return {'ok': False, 'error': data.get('msg', 'Unknown error')}
+            s = await self._get_session()
+            async with s.get(url, headers=self._headers()) as resp:
+                text = await resp.text()
+                if resp.status == 200:
+                    try:
+                        data = await resp.json()
+                        # Handle response format: {"code": 200, "msg": "success", "data": 100}
+                        if isinstance(data, dict):
+                            if data.get('code') == 200:
+                                credits = data.get('data', 0)
+                                return {'ok': True, 'credits': credits}
                             else:
-                                return {'ok': True, 'credits': data if isinstance(data, (int, float)) else 0}
-                        except Exception as e:
-                            return {'ok': False, 'error': f'Failed to parse response: {e}'}
-                    else:
-                        try:
-                            error_data = await resp.json()
-                            error_msg = error_data.get('msg', text)
-                        except:
-                            error_msg = text
-                        return {'ok': False, 'status': resp.status, 'error': error_msg}
+                                return {'ok': False, 'error': data.get('msg', 'Unknown error')}
+                        else:
+                            return {'ok': True, 'credits': data if isinstance(data, (int, float)) else 0}
+                    except Exception as e:
+                        return {'ok': False, 'error': f'Failed to parse response: {e}'}
+                else:
+                    try:
+                        error_data = await resp.json()
+                        error_msg = error_data.get('msg', text)
+                    except:
+                        error_msg = text
+                    return {'ok': False, 'status': resp.status, 'error': error_msg}
         except asyncio.TimeoutError:
-            return {'ok': False, 'error': 'Request to KIE timed out'}
+            return {'ok': False, 'network': True, 'error': 'Request to KIE timed out'}
         except Exception as e:
-            return {'ok': False, 'error': str(e)}
+            return {'ok': False, 'network': True, 'error': str(e)}
 
     async def create_task(self, model_id: str, input_data: Any, callback_url: str = None) -> Dict[str, Any]:
         """Create a generation task. Returns task ID for status polling."""
@@ -193,33 +287,33 @@ class KIEClient:
             payload["callBackUrl"] = callback_url
         
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                async with s.post(url, headers=self._headers(), json=payload) as resp:
-                    text = await resp.text()
-                    if resp.status == 200:
-                        try:
-                            data = await resp.json()
-                            if isinstance(data, dict) and data.get('code') == 200:
-                                task_id = data.get('data', {}).get('taskId')
-                                if task_id:
-                                    return {'ok': True, 'taskId': task_id}
-                                else:
-                                    return {'ok': False, 'error': 'No taskId in response'}
+            s = await self._get_session()
+            async with s.post(url, headers=self._headers(), json=payload) as resp:
+                text = await resp.text()
+                if resp.status == 200:
+                    try:
+                        data = await resp.json()
+                        if isinstance(data, dict) and data.get('code') == 200:
+                            task_id = data.get('data', {}).get('taskId')
+                            if task_id:
+                                return {'ok': True, 'taskId': task_id}
                             else:
-                                return {'ok': False, 'error': data.get('msg', 'Unknown error')}
-                        except Exception as e:
-                            return {'ok': False, 'error': f'Failed to parse response: {e}'}
-                    else:
-                        try:
-                            error_data = await resp.json()
-                            error_msg = error_data.get('msg', text)
-                        except:
-                            error_msg = text
-                        return {'ok': False, 'status': resp.status, 'error': error_msg}
+                                return {'ok': False, 'error': 'No taskId in response'}
+                        else:
+                            return {'ok': False, 'error': data.get('msg', 'Unknown error')}
+                    except Exception as e:
+                        return {'ok': False, 'error': f'Failed to parse response: {e}'}
+                else:
+                    try:
+                        error_data = await resp.json()
+                        error_msg = error_data.get('msg', text)
+                    except:
+                        error_msg = text
+                    return {'ok': False, 'status': resp.status, 'error': error_msg}
         except asyncio.TimeoutError:
-            return {'ok': False, 'error': 'Request to KIE timed out'}
+            return {'ok': False, 'network': True, 'error': 'Request to KIE timed out'}
         except Exception as e:
-            return {'ok': False, 'error': str(e)}
+            return {'ok': False, 'network': True, 'error': str(e)}
     
     async def get_task_status(self, task_id: str) -> Dict[str, Any]:
         """Get task status and results by task ID."""
@@ -233,39 +327,39 @@ class KIEClient:
         params = {"taskId": task_id}
         
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                async with s.get(url, headers=self._headers(), params=params) as resp:
-                    text = await resp.text()
-                    if resp.status == 200:
-                        try:
-                            data = await resp.json()
-                            if isinstance(data, dict) and data.get('code') == 200:
-                                task_data = data.get('data', {})
-                                return {
-                                    'ok': True,
-                                    'taskId': task_data.get('taskId'),
-                                    'state': task_data.get('state'),  # waiting, success, fail
-                                    'resultJson': task_data.get('resultJson'),
-                                    'failCode': task_data.get('failCode'),
-                                    'failMsg': task_data.get('failMsg'),
-                                    'completeTime': task_data.get('completeTime'),
-                                    'createTime': task_data.get('createTime')
-                                }
-                            else:
-                                return {'ok': False, 'error': data.get('msg', 'Unknown error')}
-                        except Exception as e:
-                            return {'ok': False, 'error': f'Failed to parse response: {e}'}
-                    else:
-                        try:
-                            error_data = await resp.json()
-                            error_msg = error_data.get('msg', text)
-                        except:
-                            error_msg = text
-                        return {'ok': False, 'status': resp.status, 'error': error_msg}
+            s = await self._get_session()
+            async with s.get(url, headers=self._headers(), params=params) as resp:
+                text = await resp.text()
+                if resp.status == 200:
+                    try:
+                        data = await resp.json()
+                        if isinstance(data, dict) and data.get('code') == 200:
+                            task_data = data.get('data', {})
+                            return {
+                                'ok': True,
+                                'taskId': task_data.get('taskId'),
+                                'state': task_data.get('state'),  # waiting, success, fail
+                                'resultJson': task_data.get('resultJson'),
+                                'failCode': task_data.get('failCode'),
+                                'failMsg': task_data.get('failMsg'),
+                                'completeTime': task_data.get('completeTime'),
+                                'createTime': task_data.get('createTime')
+                            }
+                        else:
+                            return {'ok': False, 'error': data.get('msg', 'Unknown error')}
+                    except Exception as e:
+                        return {'ok': False, 'error': f'Failed to parse response: {e}'}
+                else:
+                    try:
+                        error_data = await resp.json()
+                        error_msg = error_data.get('msg', text)
+                    except:
+                        error_msg = text
+                    return {'ok': False, 'status': resp.status, 'error': error_msg}
         except asyncio.TimeoutError:
-            return {'ok': False, 'error': 'Request to KIE timed out'}
+            return {'ok': False, 'network': True, 'error': 'Request to KIE timed out'}
         except Exception as e:
-            return {'ok': False, 'error': str(e)}
+            return {'ok': False, 'network': True, 'error': str(e)}
 
     async def invoke_model(self, model_id: str, input_data: Any) -> Dict[str, Any]:
         """Invoke a model with given input_data. Returns parsed JSON or error dict."""
@@ -288,35 +382,35 @@ class KIEClient:
         
         for url in endpoints:
             try:
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as s:
-                    async with s.post(url, headers=self._headers(), json=payload) as resp:
-                        text = await resp.text()
-                        if resp.status == 200:
-                            try:
-                                data = await resp.json()
-                                # Handle response format: {"code": 200, "msg": "success", "data": {...}}
-                                if isinstance(data, dict) and data.get('code') == 200:
-                                    return {'ok': True, 'result': data.get('data', data)}
-                                return {'ok': True, 'result': data}
-                            except Exception:
-                                return {'ok': True, 'result': text}
-                        elif resp.status == 404:
-                            # Try next endpoint
-                            continue
-                        else:
-                            try:
-                                error_data = await resp.json()
-                                error_msg = error_data.get('msg', text)
-                            except:
-                                error_msg = text
-                            last_error = {'ok': False, 'status': resp.status, 'error': error_msg}
-                            if resp.status != 404:
-                                # For non-404 errors, return immediately
-                                return last_error
+                s = await self._get_session()
+                async with s.post(url, headers=self._headers(), json=payload) as resp:
+                    text = await resp.text()
+                    if resp.status == 200:
+                        try:
+                            data = await resp.json()
+                            # Handle response format: {"code": 200, "msg": "success", "data": {...}}
+                            if isinstance(data, dict) and data.get('code') == 200:
+                                return {'ok': True, 'result': data.get('data', data)}
+                            return {'ok': True, 'result': data}
+                        except Exception:
+                            return {'ok': True, 'result': text}
+                    elif resp.status == 404:
+                        # Try next endpoint
+                        continue
+                    else:
+                        try:
+                            error_data = await resp.json()
+                            error_msg = error_data.get('msg', text)
+                        except:
+                            error_msg = text
+                        last_error = {'ok': False, 'status': resp.status, 'error': error_msg}
+                        if resp.status != 404:
+                            # For non-404 errors, return immediately
+                            return last_error
             except asyncio.TimeoutError:
-                return {'ok': False, 'error': 'Request to KIE timed out'}
+                return {'ok': False, 'network': True, 'error': 'Request to KIE timed out'}
             except Exception as e:
-                last_error = {'ok': False, 'error': str(e)}
+                last_error = {'ok': False, 'network': True, 'error': str(e)}
                 continue
         
         # All endpoints failed
@@ -3,6 +3,8 @@ Static list of KIE AI models available in the bot
 These models are shown in the menu instead of fetching from API
 """
 
+from types import MappingProxyType
+
 # Available KIE AI models with their details
 KIE_MODELS = [
     {
@@ -191,24 +193,57 @@ KIE_MODELS = [
     }
 ]
 
+# Params the minimum (shown) price of a model is calculated with; models not
+# listed here are priced with no params
+DEFAULT_PARAMS_BY_MODEL = {
+    "nano-banana-pro": {"resolution": "1K"},  # Cheapest option
+    "seedream/4.5-text-to-image": {"quality": "basic"},
+    "seedream/4.5-edit": {"quality": "basic"},
+}
+
+# Names of each model's required input params, shared by all sessions of the model.
+# input_params is frozen since sessions reference it directly instead of copying it.
+for _model in KIE_MODELS:
+    _model["input_params"] = MappingProxyType(_model.get("input_params", {}))
+    _model["_required_params"] = tuple(
+        name for name, info in _model.get("input_params", {}).items() if info.get("required", False)
+    )
+del _model
+
+
+# KIE_MODELS is static, so the lookup tables below are built once
+MODELS_BY_ID = {model["id"]: model for model in KIE_MODELS}
+MODELS_BY_CATEGORY = {}
+for _model in KIE_MODELS:
+    MODELS_BY_CATEGORY.setdefault(_model["category"], []).append(_model)
+del _model
+
+TOTAL_MODELS = len(KIE_MODELS)
+CATEGORIES = sorted(MODELS_BY_CATEGORY)
+
 
 def get_model_by_id(model_id: str) -> dict:
     """Get model by ID"""
-    for model in KIE_MODELS:
-        if model["id"] == model_id:
-            return model
-    return None
+    return MODELS_BY_ID.get(model_id)
 
 
 def get_models_by_category(category: str = None) -> list:
-    """Get models filtered by category"""
+    """Get models filtered by category (shared lists, don't modify the result)"""
     if category:
-        return [m for m in KIE_MODELS if m["category"] == category]
+        return MODELS_BY_CATEGORY.get(category, [])
     return KIE_MODELS
 
 
 def get_categories() -> list:
-    """Get list of available categories"""
-    categories = list(set([m["category"] for m in KIE_MODELS]))
-    return sorted(categories)
+    """Get list of available categories (shared list, don't modify the result)"""
+    return CATEGORIES
+
+
+# category -> (emoji of its first model, number of models) for the menu buttons,
+# in CATEGORIES order
+CATEGORY_META = {
+    category: (models[0]["emoji"] if models else "📦", len(models))
+    for category in CATEGORIES
+    for models in (get_models_by_category(category),)
+}
 
@@ -3,16 +3,30 @@ Knowledge storage module for KIE Telegram Bot
 Handles storage and retrieval of knowledge entries
 """
 
+import asyncio
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence, Set, Tuple, Union
 
 
 class KnowledgeStorage:
-    def __init__(self, storage_path: str = "./knowledge_store"):
+    def __init__(self, storage_path: str = "./knowledge_store", max_workers: int = 4):
         self.storage_path = storage_path
         self.entries_file = os.path.join(storage_path, "entries.json")
+        # In-memory copy of entries.json plus a trigram inverted index over the
+        # lowercased content; both are built lazily on first access.
+        self._entries: Optional[List[Dict]] = None
+        self._lowered: List[str] = []
+        self._trigrams: Dict[str, Set[int]] = {}
+        # Guards the cache and index; the async wrappers run in worker threads
+        self._lock = threading.RLock()
+        # Dedicated pool for the async wrappers so storage work never queues
+        # behind (or starves) other users of the loop's default executor
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
         self.ensure_storage_exists()
         
     def ensure_storage_exists(self):
@@ -26,44 +40,110 @@ class KnowledgeStorage:
     
     def add_entry(self, content: str, author_id: Optional[str] = None) -> bool:
         """Add a new knowledge entry."""
+        return self.add_entries([(content, author_id)])
+    
+    def add_entries(self, items: List[Tuple[str, Optional[str]]]) -> bool:
+        """Add several (content, author_id) entries with a single file write."""
+        with self._lock:
+            return self._add_entries(items)
+    
+    def search_entries(self, query: Union[str, Sequence[str]]) -> List[Dict]:
+        """
+        Search for entries containing the query.
+        
+        The query is either a phrase or a list of tokens (e.g. command
+        arguments); with tokens an entry matches when it contains all of them.
+        """
+        with self._lock:
+            return self._search_entries(query)
+    
+    async def add_entry_async(self, content: str, author_id: Optional[str] = None) -> bool:
+        """Add a new knowledge entry without blocking the event loop."""
+        return await self._run_in_executor(self.add_entry, content, author_id)
+    
+    async def add_entries_async(self, items: List[Tuple[str, Optional[str]]]) -> bool:
+        """Add several entries without blocking the event loop."""
+        return await self._run_in_executor(self.add_entries, items)
+    
+    async def search_entries_async(self, query: Union[str, Sequence[str]]) -> List[Dict]:
+        """Search for entries without blocking the event loop."""
+        return await self._run_in_executor(self.search_entries, query)
+    
+    def close(self):
+        """Shut down the worker threads used by the async methods."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+    
+    async def _run_in_executor(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._max_workers,
+                thread_name_prefix="knowledge-storage"
+            )
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    
+    def _add_entries(self, items: List[Tuple[str, Optional[str]]]) -> bool:
         try:
             # Load existing entries
-            entries = self._load_entries()
+            entries = self._get_entries()
             
-            # Create new entry
-            entry = {
-                "id": len(entries) + 1,
-                "content": content,
-                "author_id": author_id,
-                "timestamp": datetime.now().isoformat(),
-                "tags": []  # Placeholder for future tagging functionality
-            }
+            # Create new entries
+            timestamp = datetime.now().isoformat()
+            new_entries = []
+            for content, author_id in items:
+                new_entries.append({
+                    "id": len(entries) + len(new_entries) + 1,
+                    "content": content,
+                    "author_id": author_id,
+                    "timestamp": timestamp,
+                    "tags": []  # Placeholder for future tagging functionality
+                })
             
             # Add to entries
-            entries.append(entry)
+            entries.extend(new_entries)
             
             # Save back to file
-            self._save_entries(entries)
+            try:
+                self._save_entries(entries)
+            except Exception:
+                del entries[len(entries) - len(new_entries):]
+                raise
+            for entry in new_entries:
+                self._index_entry(entry)
             
             return True
         except Exception as e:
             print(f"Error adding entry: {e}")
             return False
     
-    def search_entries(self, query: str) -> List[Dict]:
-        """Search for entries containing the query."""
+    def _search_entries(self, query: Union[str, Sequence[str]]) -> List[Dict]:
         try:
-            entries = self._load_entries()
+            entries = self._get_entries()
+            if isinstance(query, str):
+                terms = [query.lower()]
+            else:
+                terms = [token.lower() for token in query if token]
             
-            # Simple text search (to be improved with more advanced search later)
-            query_lower = query.lower()
-            results = []
+            candidates = None
+            for term in terms:
+                if len(term) >= 3:
+                    term_candidates = self._trigram_candidates(term)
+                    candidates = term_candidates if candidates is None else candidates & term_candidates
+                    if not candidates:
+                        return []
+            if candidates is None:
+                # No term is long enough to produce a trigram, fall back to a
+                # scan over the cached lowercase content
+                positions = range(len(entries))
+            else:
+                positions = sorted(candidates)
             
-            for entry in entries:
-                if query_lower in entry["content"].lower():
-                    results.append(entry)
-            
-            return results
+            # Trigram hits are only candidates; confirm the actual substrings
+            return [
+                entries[i] for i in positions
+                if all(term in self._lowered[i] for term in terms)
+            ]
         except Exception as e:
             print(f"Error searching entries: {e}")
             return []
@@ -71,11 +151,52 @@ class KnowledgeStorage:
     def get_all_entries(self) -> List[Dict]:
         """Get all knowledge entries."""
         try:
-            return self._load_entries()
+            with self._lock:
+                return list(self._get_entries())
         except Exception as e:
             print(f"Error getting entries: {e}")
             return []
     
+    def _get_entries(self) -> List[Dict]:
+        """Return cached entries, loading and indexing the file on first use."""
+        if self._entries is None:
+            entries = self._load_entries()
+            self._lowered = []
+            self._trigrams = {}
+            self._entries = entries
+            for entry in entries:
+                self._index_entry(entry)
+        return self._entries
+    
+    def _index_entry(self, entry: Dict):
+        """Add an entry (already appended to the cache) to the trigram index."""
+        position = len(self._lowered)
+        content_lower = entry["content"].lower()
+        self._lowered.append(content_lower)
+        for gram in self._trigrams_of(content_lower):
+            self._trigrams.setdefault(gram, set()).add(position)
+    
+    @staticmethod
+    def _trigrams_of(text: str) -> Set[str]:
+        """Return the set of 3-character substrings of text."""
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+    
+    def _trigram_candidates(self, term: str) -> Set[int]:
+        """Positions of entries containing every trigram of the term."""
+        postings = []
+        for gram in self._trigrams_of(term):
+            positions = self._trigrams.get(gram)
+            if not positions:
+                return set()
+            postings.append(positions)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for positions in postings[1:]:
+            candidates &= positions
+            if not candidates:
+                break
+        return candidates
+    
     def _load_entries(self) -> List[Dict]:
         """Load entries from the JSON file."""
         with open(self.entries_file, 'r', encoding='utf-8') as f:
@@ -84,4 +205,47 @@ class KnowledgeStorage:
     def _save_entries(self, entries: List[Dict]):
         """Save entries to the JSON file."""
         with open(self.entries_file, 'w', encoding='utf-8') as f:
-            json.dump(entries, f, ensure_ascii=False, indent=2)
\ No newline at end of file
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+
+
+class EntryWriteBatcher:
+    """
+    Group-commit writer in front of KnowledgeStorage.
+
+    add() queues an entry and returns once it has been saved. Entries queued
+    while a write is in progress are saved together by the next write, so a
+    burst of additions costs one file rewrite per batch rather than per entry.
+    """
+    
+    def __init__(self, storage: KnowledgeStorage, max_batch: int = 100, max_queue: int = 1000):
+        self.storage = storage
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self._pending: List[Tuple[str, Optional[str], asyncio.Future]] = []
+        self._writer: Optional[asyncio.Task] = None
+    
+    def is_full(self) -> bool:
+        """True when the queue is at capacity and new entries should be refused."""
+        return len(self._pending) >= self.max_queue
+    
+    async def add(self, content: str, author_id: Optional[str] = None) -> bool:
+        """Queue an entry and wait until the batch containing it is written."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((content, author_id, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+        return await asyncio.shield(future)
+    
+    async def close(self):
+        """Wait for queued entries to be written."""
+        if self._writer is not None:
+            await self._writer
+    
+    async def _write_pending(self):
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            success = await self.storage.add_entries_async([(content, author_id) for content, author_id, _ in batch])
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(success)
@@ -0,0 +1,248 @@
+"""
+Outbound message helpers for the Telegram bots
+Coalesces bursts of text replies sent to the same chat and keeps Bot API
+calls under Telegram's flood limits
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects text messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+SendFn = Callable[[str], Awaitable]
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Split text into chunks no longer than limit, preferring line breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class _ChatBatch:
+    """Pending texts for one chat while its batching window is open."""
+
+    __slots__ = ('texts', 'send_fn', 'dropped', 'task')
+
+    def __init__(self, send_fn: SendFn):
+        self.texts: List[str] = []
+        self.send_fn = send_fn
+        self.dropped = 0
+        self.task = None
+
+
+class OutboundBatcher:
+    """
+    Per-chat outbound message batcher.
+
+    The first message to a chat is sent right away and opens a window;
+    messages queued while the window is open are joined with the separator
+    and sent together when it closes, split at Telegram's message limit.
+    """
+
+    def __init__(self, window: float = 0.5, long_window: float = 2.0,
+                 max_pending: int = 50, separator: str = '\n'):
+        self.window = window
+        # Used instead of window when the last queued text is close to the
+        # message limit, since more output is likely to follow it
+        self.long_window = long_window
+        self.max_pending = max_pending
+        self.separator = separator
+        self._chats: Dict[int, _ChatBatch] = {}
+
+    async def send(self, chat_id: int, text: str, send_fn: SendFn):
+        """Send text to a chat now, or queue it if a window is already open."""
+        batch = self._chats.get(chat_id)
+        if batch is not None:
+            self._queue(batch, text, send_fn)
+            return
+
+        batch = _ChatBatch(send_fn)
+        self._chats[chat_id] = batch
+        batch.task = asyncio.create_task(self._drain(chat_id, batch))
+        for chunk in split_message(text):
+            await send_fn(chunk)
+
+    async def flush(self, chat_id: int):
+        """Send whatever is queued for a chat without waiting for the window."""
+        batch = self._chats.get(chat_id)
+        if batch is not None and batch.texts:
+            await self._send_batch(batch)
+
+    async def flush_all(self):
+        """Flush every chat and close all windows (call before the bot stops)."""
+        for chat_id, batch in list(self._chats.items()):
+            if batch.task is not None:
+                batch.task.cancel()
+            self._chats.pop(chat_id, None)
+            if batch.texts:
+                try:
+                    await self._send_batch(batch)
+                except Exception as e:
+                    logger.error("Error flushing outbound messages for chat %s: %s", chat_id, e)
+
+    def _queue(self, batch: _ChatBatch, text: str, send_fn: SendFn):
+        batch.texts.append(text)
+        batch.send_fn = send_fn
+        if len(batch.texts) > self.max_pending:
+            # Drop the oldest queued text rather than growing without bound
+            batch.texts.pop(0)
+            batch.dropped += 1
+
+    def _delay(self, batch: _ChatBatch) -> float:
+        if batch.texts and len(batch.texts[-1]) >= TELEGRAM_MESSAGE_LIMIT - 96:
+            return self.long_window
+        return self.window
+
+    async def _drain(self, chat_id: int, batch: _ChatBatch):
+        """Keep the window open until a full interval passes with nothing queued."""
+        try:
+            while True:
+                await asyncio.sleep(self._delay(batch))
+                if not batch.texts:
+                    break
+                try:
+                    await self._send_batch(batch)
+                except Exception as e:
+                    logger.error("Error sending batched messages to chat %s: %s", chat_id, e)
+        finally:
+            if self._chats.get(chat_id) is batch:
+                del self._chats[chat_id]
+
+    async def _send_batch(self, batch: _ChatBatch):
+        texts, batch.texts = batch.texts, []
+        if batch.dropped:
+            texts.insert(0, f'…{batch.dropped} message(s) dropped')
+            batch.dropped = 0
+        for chunk in split_message(self.separator.join(texts)):
+            await batch.send_fn(chunk)
+
+
+class TokenBucket:
+    """Async token bucket refilled continuously at rate tokens per second."""
+
+    __slots__ = ('rate', 'capacity', '_tokens', '_updated', '_lock')
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter for the Application's bot, see Application.builder().rate_limiter().
+
+    Requests addressed to a chat take a token from a global bucket (30/s, the
+    Bot API broadcast limit) and from that chat's bucket (1/s for private
+    chats, 20/min for groups, each with a small burst). At most
+    max_concurrent such requests are in flight at once. A RetryAfter
+    response pauses every request for the given time before retrying.
+    """
+
+    # Requests that are not messages to a chat and must never wait here
+    _BYPASS_ENDPOINTS = frozenset({'getUpdates', 'getMe', 'deleteWebhook', 'setWebhook'})
+    _MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, overall_rate: float = 30, chat_rate: float = 1,
+                 group_rate: float = 20 / 60, burst: float = 3,
+                 max_concurrent: int = 5, max_retries: int = 2):
+        self._overall = TokenBucket(overall_rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._burst = burst
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._max_concurrent = max_concurrent
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._max_retries = max_retries
+        self._resume = None
+
+    async def initialize(self):
+        self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        self._resume = asyncio.Event()
+        self._resume.set()
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._MAX_CHAT_BUCKETS:
+                # Forget chats whose buckets have fully refilled (idle chats)
+                for key in [k for k, b in self._chats.items() if b.is_full()]:
+                    del self._chats[key]
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self._group_rate if is_group else self._chat_rate, self._burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if self._semaphore is None:
+            await self.initialize()
+
+        chat_id = data.get('chat_id')
+        if endpoint in self._BYPASS_ENDPOINTS or chat_id is None:
+            return await callback(*args, **kwargs)
+
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        max_retries = rate_limit_args if rate_limit_args is not None else self._max_retries
+        for attempt in range(max_retries + 1):
+            await self._resume.wait()
+            await self._overall.acquire()
+            await self._chat_bucket(chat_id).acquire()
+            try:
+                async with self._semaphore:
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                logger.info("Telegram flood limit hit, pausing sends for %.1fs", retry_after)
+                self._resume.clear()
+                try:
+                    await asyncio.sleep(retry_after + 0.1)
+                finally:
+                    self._resume.set()
+        return None
@@ -41,6 +41,14 @@ def test_knowledge_storage():
     for result in results:
         print(f"     - {result['content']}")
     
+    # Test searching with command-style tokens (all must match)
+    results = storage.search_entries(["capital", "PARIS"])
+    print(f"   Found {len(results)} result(s) for tokens ['capital', 'PARIS']:")
+    for result in results:
+        print(f"     - {result['content']}")
+    assert results and all("paris" in r["content"].lower() for r in results)
+    assert not storage.search_entries(["capital", "python"])
+    
     # Test getting all entries
     print("\n3. Getting all entries...")
     all_entries = storage.get_all_entries()